@@ -0,0 +1,162 @@
+import numpy as np
+import os
+
+__all__ = ["get_basis", "get_illum_basis", "poly_basis", "green_basis"]
+
+
+# Cache of the change of basis matrices, keyed on `ydeg`
+_BASIS = {}
+
+# Cache of the illumination basis matrices, keyed on `ydeg`
+_ILLUM = {}
+
+
+def get_basis(ydeg, cache_dir=None):
+    """
+    Return the change of basis matrices `A1`, `A1Inv`, and `A2` for a map
+    of degree `ydeg` as sparse CSR matrices.
+
+    `A1` is the transform from Ylms to polynomials (up to degree `ydeg`),
+    `A1Inv` is the transform from polynomials to Ylms and `A2` is the
+    transform from polynomials to Green's polynomials (both up to degree
+    `ydeg + 1`). The matrices are computed once per `ydeg` and shared by
+    all callers. If `cache_dir` is given, they are also saved to (and
+    subsequently loaded from) `.npz` files in that directory.
+
+    """
+    basis = _BASIS.get(ydeg, None)
+    if basis is not None:
+        return basis
+    from scipy.sparse import csr_matrix, load_npz, save_npz
+
+    # Try the on-disk cache
+    names = ["A1", "A1Inv", "A2"]
+    if cache_dir is not None:
+        files = [
+            os.path.join(cache_dir, "{}_{}.npz".format(name, ydeg)) for name in names
+        ]
+        if all([os.path.exists(file) for file in files]):
+            basis = tuple([csr_matrix(load_npz(file)) for file in files])
+            _BASIS[ydeg] = basis
+            return basis
+
+    # Compute them
+    from starry._c_ops import Ops
+
+    ops = Ops(ydeg + 1, 0, 0, 0)
+    N = (ydeg + 1) ** 2
+    A1 = csr_matrix(ops.A1)[:N, :N]
+    A1Inv = csr_matrix(ops.A1Inv)
+    A2 = csr_matrix(ops.A) @ A1Inv
+    basis = (A1, A1Inv, A2)
+
+    # Save them
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for file, matrix in zip(files, basis):
+            save_npz(file, matrix)
+
+    _BASIS[ydeg] = basis
+    return basis
+
+
+def get_illum_basis(ydeg):
+    """
+    Return the array `I` of shape `(3, (ydeg + 2) ** 2, (ydeg + 1) ** 2)`
+    such that the illumination matrix for the polynomial illumination
+    profile `p = [0, x, z, y]` is
+
+        p[1] * I[0] + p[2] * I[1] + p[3] * I[2]
+
+    This maps a polynomial of degree `ydeg` to its product with `p`, a
+    polynomial of degree `ydeg + 1`. The array is computed once per `ydeg`.
+
+    """
+    I = _ILLUM.get(ydeg, None)
+    if I is not None:
+        return I
+
+    I = np.zeros((3, (ydeg + 2) ** 2, (ydeg + 1) ** 2))
+    n1 = 0
+    for l1 in range(ydeg + 1):
+        for m1 in range(-l1, l1 + 1):
+            odd1 = (l1 + m1) % 2 != 0
+            n2 = 0
+            for m2 in range(-1, 2):
+                l = l1 + 1
+                n = l * l + l + m1 + m2
+                if odd1 and ((1 + m2) % 2 != 0):
+                    I[n2, n - 4 * l + 2, n1] += 1
+                    I[n2, n - 2, n1] -= 1
+                    I[n2, n + 2, n1] -= 1
+                else:
+                    I[n2, n, n1] += 1
+                n2 += 1
+            n1 += 1
+
+    _ILLUM[ydeg] = I
+    return I
+
+
+def poly_basis(ydeg, x, y, z):
+    """
+    Return the polynomial basis of degree `ydeg` evaluated at the points
+    `(x, y, z)` on the unit sphere, as an array of shape
+    `(npts, (ydeg + 1) ** 2)`.
+
+    """
+    x = np.atleast_1d(x)
+    y = np.atleast_1d(y)
+    z = np.atleast_1d(z)
+    xn = x[:, None] ** np.arange(ydeg + 1)
+    yn = y[:, None] ** np.arange(ydeg + 1)
+    pT = np.empty((len(x), (ydeg + 1) ** 2))
+    n = 0
+    for l in range(ydeg + 1):
+        for m in range(-l, l + 1):
+            mu = l - m
+            nu = l + m
+            if nu % 2 == 0:
+                pT[:, n] = xn[:, mu // 2] * yn[:, nu // 2]
+            else:
+                pT[:, n] = xn[:, (mu - 1) // 2] * yn[:, (nu - 1) // 2] * z
+            n += 1
+    return pT
+
+
+def green_basis(ydeg, x, y, z):
+    """
+    Return the Green's basis of degree `ydeg` evaluated at the points
+    `(x, y, z)` on the unit sphere, as an array of shape
+    `(npts, (ydeg + 1) ** 2)`. Each term is the curl of the corresponding
+    vector field `G_lm` in the `P`, `Q`, and `T` integrals.
+
+    """
+    x = np.atleast_1d(x)
+    y = np.atleast_1d(y)
+    z = np.atleast_1d(z)
+    xn = x[:, None] ** np.arange(ydeg + 1)
+    yn = y[:, None] ** np.arange(ydeg + 1)
+    z2 = z ** 2
+    gT = np.zeros((len(x), (ydeg + 1) ** 2))
+    n = 0
+    for l in range(ydeg + 1):
+        for m in range(-l, l + 1):
+            mu = l - m
+            nu = l + m
+            if nu % 2 == 0:
+                gT[:, n] = 0.5 * (mu + 2) * xn[:, mu // 2] * yn[:, nu // 2]
+            elif (l == 1) and (m == 0):
+                gT[:, n] = z
+            elif (mu == 1) and (l % 2 == 0):
+                gT[:, n] = 3 * xn[:, l - 2] * y * z
+            elif (mu == 1) and (l % 2 != 0):
+                gT[:, n] = xn[:, l - 3] * z * (3 * y ** 2 - z2)
+            else:
+                i = (mu - 3) // 2
+                j = (nu - 1) // 2
+                gT[:, n] = -3 * xn[:, i + 1] * yn[:, j] * z
+                if i > 0:
+                    gT[:, n] += 0.5 * (mu - 3) * xn[:, i - 1] * yn[:, j] * z * z2
+            n += 1
+    return gT
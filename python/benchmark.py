@@ -0,0 +1,228 @@
+"""
+Benchmarks for the `StarryNight` solver.
+
+Times each stage of the computation of the design matrix (the integration
+code & limits, the `P`, `Q`, and `T` integrals, the illumination matrix,
+and the final products) for each integration code and each `ydeg`. The
+results are saved as JSON and may be compared against a baseline file, in
+which case any stage that got slower than a given tolerance is flagged.
+Pass `--imports` to also time the import of the main modules::
+
+    python benchmark.py --ydeg 2 5 10 --imports --output bench.json
+    python benchmark.py --ydeg 2 5 10 --imports --baseline bench.json
+
+"""
+from utils import *
+from geometry import get_angles, get_angles_batch
+from primitive import compute_P, compute_Q, compute_T
+from starrynight import StarryNight, TERMS
+import numpy as np
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import warnings
+
+__all__ = ["sample_geometries", "benchmark", "import_times", "compare"]
+
+
+def sample_geometries(npts=10, nsamples=100000, seed=0):
+    """
+    Return a dictionary mapping each integration code to an array of shape
+    `(n, 4)` of up to `npts` random geometries `(b, theta, bo, ro)` with
+    that code. Codes that are not found among the `nsamples` random draws
+    are absent from the dictionary.
+
+    """
+    rng = np.random.default_rng(seed)
+    b = rng.uniform(-1, 1, nsamples)
+    theta = rng.uniform(0, 2 * np.pi, nsamples)
+    ro = rng.uniform(0.01, 2, nsamples)
+    bo = rng.uniform(0, 1, nsamples) * (1 + 2 * ro)
+    _, _, _, code = get_angles_batch(b, theta, np.cos(theta), np.sin(theta), bo, ro)
+    geometries = {}
+    for c in np.unique(code):
+        idx = np.flatnonzero(code == c)[:npts]
+        geometries[int(c)] = np.transpose([b[idx], theta[idx], bo[idx], ro[idx]])
+    return geometries
+
+
+def _time(func, args, repeat):
+    """Return the best over `repeat` trials of the mean time per call."""
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            func(*arg)
+        best = min(best, (time.perf_counter() - start) / len(args))
+    return best
+
+
+def benchmark(ydegs=[2, 5, 10], npts=10, repeat=3, seed=0):
+    """
+    Time each of the stages of the computation of the design matrix for
+    each integration code and each value of `ydeg`. Returns a dictionary
+    of the form `{ydeg: {code: {stage: seconds per call}}}`, with string
+    keys (so it can be serialized as JSON).
+
+    """
+    geometries = sample_geometries(npts=npts, seed=seed)
+    results = {}
+    for ydeg in ydegs:
+        S = StarryNight(ydeg)
+        results[str(ydeg)] = {}
+        for code, g in sorted(geometries.items()):
+            stages = {}
+
+            # Integration code & limits
+            args = [
+                (b, theta, np.cos(theta), np.sin(theta), bo, ro)
+                for b, theta, bo, ro in g
+            ]
+            stages["get_angles"] = _time(get_angles, args, repeat)
+            angles = [get_angles(*arg)[:3] for arg in args]
+
+            # The primitive integrals
+            if TERMS[code][3]:
+                args = [
+                    (ydeg + 1, bo, ro, kappa)
+                    for (b, theta, bo, ro), (kappa, lam, xi) in zip(g, angles)
+                ]
+                stages["compute_P"] = _time(compute_P, args, repeat)
+                args = [(ydeg + 1, lam) for kappa, lam, xi in angles]
+                stages["compute_Q"] = _time(compute_Q, args, repeat)
+                args = [
+                    (ydeg + 1, b, theta, xi)
+                    for (b, theta, bo, ro), (kappa, lam, xi) in zip(g, angles)
+                ]
+                stages["compute_T"] = _time(compute_T, args, repeat)
+
+            # The illumination matrix
+            args = [(b, theta) for b, theta, bo, ro in g]
+            stages["illum"] = _time(S.illum_A1, args, repeat)
+
+            # The final products
+            sT = np.ones((ydeg + 2) ** 2)
+            IA1 = S.illum_A1(g[0, 0], g[0, 1])
+            stages["products"] = _time(
+                lambda: (sT @ S.A2).dot(IA1), [()] * len(g), repeat
+            )
+
+            # The whole thing
+            stages["design_matrix"] = _time(S.design_matrix, g, repeat)
+            stages["design_matrix_batch"] = (
+                _time(S.design_matrix, [g.T], repeat) / len(g)
+            )
+
+            results[str(ydeg)][FLUX_NAMES[code]] = stages
+
+    return results
+
+
+def import_times(
+    modules=["utils", "special", "geometry", "primitive", "starrynight"], repeat=3
+):
+    """
+    Time the import of each of `modules` in a fresh interpreter. Returns a
+    dictionary of the form `{"imports": {module: {"import": seconds}}}`,
+    which may be merged with the output of `benchmark`.
+
+    """
+    code = (
+        "import time; start = time.perf_counter(); import {}; "
+        "print(time.perf_counter() - start)"
+    )
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules:
+        best = np.inf
+        for i in range(repeat):
+            out = subprocess.check_output(
+                [sys.executable, "-c", code.format(module)], cwd=cwd
+            )
+            best = min(best, float(out.decode().split()[-1]))
+        results[module] = {"import": best}
+    return {"imports": results}
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare benchmark `results` against a `baseline` and return a list of
+    `(ydeg, code, stage, time, baseline time)` tuples for all the stages
+    that are slower than the baseline by more than a fraction `tolerance`.
+    Entries missing from either dictionary are ignored.
+
+    """
+    slower = []
+    for ydeg, codes in results.items():
+        for code, stages in codes.items():
+            for stage, t in stages.items():
+                t0 = baseline.get(ydeg, {}).get(code, {}).get(stage, None)
+                if t0 is not None and t > (1 + tolerance) * t0:
+                    slower.append((ydeg, code, stage, t, t0))
+    return slower
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--ydeg", type=int, nargs="+", default=[2, 5, 10])
+    parser.add_argument("--npts", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="save the results here")
+    parser.add_argument("--baseline", default=None, help="compare against this")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--imports", action="store_true", help="time the imports")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    results = benchmark(
+        ydegs=args.ydeg, npts=args.npts, repeat=args.repeat, seed=args.seed
+    )
+    if args.imports:
+        results.update(import_times(repeat=args.repeat))
+
+    # Print a summary
+    for ydeg, codes in results.items():
+        print("ydeg = {}".format(ydeg) if ydeg != "imports" else ydeg)
+        for code, stages in codes.items():
+            print(
+                "  {:22s} ".format(code)
+                + "  ".join(
+                    "{}: {:.2e}".format(stage, t) for stage, t in stages.items()
+                )
+            )
+
+    # Save it
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                dict(
+                    date=datetime.datetime.now().isoformat(),
+                    python=platform.python_version(),
+                    numpy=np.__version__,
+                    machine=platform.machine(),
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+
+    # Compare to the baseline
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        slower = compare(results, baseline, tolerance=args.tolerance)
+        for ydeg, code, stage, t, t0 in slower:
+            print(
+                "SLOWER: {}, {}, {}: {:.2e} s (baseline {:.2e} s)".format(
+                    ydeg, code, stage, t, t0
+                )
+            )
+        if len(slower):
+            sys.exit(1)
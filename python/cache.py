@@ -0,0 +1,94 @@
+"""
+A bounded least-recently-used cache keyed on tuples of floats.
+
+The floats are rounded to a tolerance `tol` before being used as keys, so
+values computed at (nearly) the same point are shared. This is used by
+`StarryNight` to memoize the (expensive) results of `precompute` and the
+illumination matrices when the same geometry comes up repeatedly::
+
+    cache = LRUCache(maxsize=1024, tol=1e-10)
+    key = cache.key(b, theta, bo, ro)
+    value = cache.get(key)
+    if value is None:
+        value = ...
+        cache.put(key, value)
+
+A cache with `maxsize = 0` (the default) is disabled: `get` always
+returns None, `put` does nothing, and no statistics are recorded.
+
+"""
+from collections import OrderedDict
+
+__all__ = ["LRUCache"]
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=0, tol=1e-10):
+        self.maxsize = maxsize
+        self.tol = tol
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def key(self, *args):
+        """Return the key for the point `args`, rounded to `tol`."""
+        if self.tol > 0:
+            return tuple([round(float(arg) / self.tol) for arg in args])
+        else:
+            return tuple([float(arg) for arg in args])
+
+    def get(self, key):
+        """Return the value for `key` (marking it as recent), or None."""
+        if not self.maxsize:
+            return None
+        value = self._data.get(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Store `value` under `key`, evicting the oldest entry if needed."""
+        if not self.maxsize:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def evict(self, key=None):
+        """Remove the entry for `key`, or the oldest entry if `key` is None."""
+        if key is None:
+            if len(self._data):
+                self._data.popitem(last=False)
+                self.evictions += 1
+        elif self._data.pop(key, None) is not None:
+            self.evictions += 1
+
+    def clear(self, stats=True):
+        """Remove all entries and, unless `stats` is False, reset the stats."""
+        self._data.clear()
+        if stats:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Return a dictionary with the hit/miss statistics of the cache."""
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._data),
+            maxsize=self.maxsize,
+        )
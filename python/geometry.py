@@ -1,5 +1,6 @@
 import numpy as np
 from utils import *
+from timing import timed
 
 
 def on_dayside(b, theta, costheta, sintheta, x, y):
@@ -85,6 +86,32 @@ def sort_lam(b, theta, costheta, sintheta, bo, ro, lam):
     return lam
 
 
+def get_quartic_coeffs(b, xo, yo, ro):
+    """
+    Return the coefficients of the quartic whose roots are the `x` coordinates
+    of the occultor-terminator intersections in the frame where the semi-major
+    axis of the terminator ellipse is aligned with the x axis.
+
+    """
+    A = (1 - b ** 2) ** 2
+    B = -4 * xo * (1 - b ** 2)
+    C = -2 * (
+        b ** 4
+        + ro ** 2
+        - 3 * xo ** 2
+        - yo ** 2
+        - b ** 2 * (1 + ro ** 2 - xo ** 2 + yo ** 2)
+    )
+    D = -4 * xo * (b ** 2 - ro ** 2 + xo ** 2 + yo ** 2)
+    E = (
+        b ** 4
+        - 2 * b ** 2 * (ro ** 2 - xo ** 2 + yo ** 2)
+        + (ro ** 2 - xo ** 2 - yo ** 2) ** 2
+    )
+    return np.array([A, B, C, D, E])
+
+
+@timed
 def get_roots(b, theta, costheta, sintheta, bo, ro, gradient=False):
     # We'll solve for occultor-terminator intersections
     # in the frame where the semi-major axis of the
@@ -120,22 +147,7 @@ def get_roots(b, theta, costheta, sintheta, bo, ro, gradient=False):
     else:
 
         # Get the roots (eigenvalue problem)
-        A = (1 - b ** 2) ** 2
-        B = -4 * xo * (1 - b ** 2)
-        C = -2 * (
-            b ** 4
-            + ro ** 2
-            - 3 * xo ** 2
-            - yo ** 2
-            - b ** 2 * (1 + ro ** 2 - xo ** 2 + yo ** 2)
-        )
-        D = -4 * xo * (b ** 2 - ro ** 2 + xo ** 2 + yo ** 2)
-        E = (
-            b ** 4
-            - 2 * b ** 2 * (ro ** 2 - xo ** 2 + yo ** 2)
-            + (ro ** 2 - xo ** 2 - yo ** 2) ** 2
-        )
-        roots = np.roots([A, B, C, D, E]) + 0j
+        roots = np.roots(get_quartic_coeffs(b, xo, yo, ro)) + 0j
 
         # Polish the roots using Newton's method on the *original*
         # function, which is more stable than the quartic expression.
@@ -269,7 +281,307 @@ def get_roots(b, theta, costheta, sintheta, bo, ro, gradient=False):
         return x
 
 
-def get_angles(b, theta, costheta, sintheta, bo, ro):
+def _polish_roots(r, b, xo, yo, ro):
+    """
+    Polish the candidate roots `r` of the quartic in `get_roots_batch`
+    using Newton's method on the *original* function, all at once.
+    Returns the polished roots, the value of |f| there, and the half of
+    the occultor each one is a solution to.
+
+    """
+    # Figure out which of the two halves of the occultor each root is
+    # a solution to, and only move forward if |f| is decently small
+    # (see `get_roots` for details)
+    r = np.array(r)
+    A = np.sqrt(1 - r ** 2)
+    B = np.sqrt(ro ** 2 - (r - xo) ** 2)
+    absfp = np.abs(b * A - yo + B)
+    absfm = np.abs(b * A - yo - B)
+    s = np.where(absfm < absfp, -1.0, 1.0)
+    active = np.minimum(absfp, absfm) < STARRY_ROOT_TOL_LOW
+
+    # Newton's method
+    minf = np.full(len(r), np.inf)
+    minx = np.array(r)
+    for k in range(STARRY_ROOT_MAX_ITER):
+        i = np.flatnonzero(active)
+        if len(i) == 0:
+            break
+        A = np.sqrt(1 - r[i] ** 2)
+        B = np.sqrt(ro[i] ** 2 - (r[i] - xo[i]) ** 2)
+        f = b[i] * A + s[i] * B - yo[i]
+        absf = np.abs(f)
+        better = absf < minf[i]
+        minf[i[better]] = absf[better]
+        minx[i[better]] = r[i[better]]
+        done = better & (absf <= STARRY_ROOT_TOL_HIGH)
+        df = -(b[i] * r[i] / A + s[i] * (r[i] - xo[i]) / B)
+        r[i[~done]] -= (f / df)[~done]
+        active[i[done]] = False
+
+    return minx, minf, s
+
+
+def _check_tracked_roots(
+    roots, seeded, minf, coeffs, b, xo, yo, ro, costheta, sintheta, bo
+):
+    """
+    Return True for the rows in which the roots polished from a guess in
+    `get_roots_batch` can be trusted. All the guesses must have converged
+    to distinct real roots, the number of roots must be consistent with
+    the number of terminator extrema that are occulted, and no other root
+    of the quartic may be a candidate intersection.
+
+    """
+    x = roots.real
+    nseeds = np.count_nonzero(seeded, axis=1)
+    ok = (nseeds > 0) & (nseeds < 3)
+
+    # Convergence
+    converged = (
+        (minf < STARRY_ROOT_TOL_MED)
+        & (np.abs(roots.imag) < STARRY_ROOT_TOL_HIGH)
+        & (np.abs(x) <= 1)
+    )
+    ok &= np.all(converged | ~seeded, axis=1)
+    for j in range(1, 4):
+        for k in range(j):
+            close = np.abs(x[:, k] - x[:, j]) < STARRY_ROOT_TOL_DUP
+            ok &= ~(seeded[:, k] & seeded[:, j] & close)
+
+    # Parity: an odd number of roots iff exactly one extremum is occulted
+    e1 = costheta ** 2 + (sintheta - bo) ** 2 < ro ** 2 + STARRY_ROOT_TOL_HIGH
+    e2 = costheta ** 2 + (sintheta + bo) ** 2 < ro ** 2 + STARRY_ROOT_TOL_HIGH
+    ok &= (nseeds % 2 == 1) == (e1 ^ e2)
+
+    # Deflate the quartic by the roots we found (synthetic division)
+    x = np.where(seeded, x, 0)
+    for j in range(4):
+        q = np.zeros_like(coeffs)
+        q[:, 1] = coeffs[:, 0]
+        for k in range(2, 5):
+            q[:, k] = coeffs[:, k - 1] + x[:, j] * q[:, k - 1]
+        coeffs = np.where(seeded[:, j, None], q, coeffs)
+
+    # Roots of what's left (a quadratic or a cubic)
+    rest = np.full((len(x), 3), np.nan + 0j)
+    i = ok & (nseeds == 2)
+    A, B, C = coeffs[i, 2], coeffs[i, 3], coeffs[i, 4]
+    disc = np.sqrt(B ** 2 - 4 * A * C + 0j)
+    rest[i, 0] = (-B + disc) / (2 * A)
+    rest[i, 1] = (-B - disc) / (2 * A)
+    i = ok & (nseeds == 1)
+    companion = np.zeros((np.count_nonzero(i), 3, 3))
+    companion[:, 0] = -coeffs[i, 2:] / coeffs[i, 1:2]
+    companion[:, 1, 0] = companion[:, 2, 1] = 1
+    rest[i] = np.linalg.eigvals(companion)
+
+    # Are any of them potentially valid roots? If so, don't trust the guess
+    xr = rest.real
+    b, xo, yo, ro = [arg.reshape(-1, 1) for arg in (b, xo, yo, ro)]
+    A = np.sqrt(1 - xr ** 2)
+    B = np.sqrt(ro ** 2 - (xr - xo) ** 2)
+    absf = np.minimum(np.abs(b * A - yo + B), np.abs(b * A - yo - B))
+    suspicious = (
+        (np.abs(rest.imag) < STARRY_ROOT_TOL_LOW)
+        & (np.abs(xr) <= 1 + STARRY_ROOT_TOL_LOW)
+        & ~(absf >= STARRY_ROOT_TOL_LOW)
+    )
+    ok &= ~np.any(suspicious, axis=1)
+
+    return ok
+
+
+@timed
+def get_roots_batch(
+    b, theta, costheta, sintheta, bo, ro, gradient=False, guess=None
+):
+    """
+    Vectorized version of `get_roots` for arrays of geometries.
+
+    The companion matrices of all the quartics are diagonalized at once and
+    the candidate roots are polished simultaneously with Newton's method,
+    following the same rules as `get_roots`. Returns an array of shape
+    `(N, 4)` containing the roots of each point (padded with NaNs) and an
+    array with the number of roots of each point.
+
+    If `guess` is provided (an array of up to four NaN-padded roots per
+    point, usually the roots at a nearby geometry), the guesses are used as
+    seeds for Newton's method and the quartic is only solved from scratch
+    for the points where that fails or where the number of roots changed.
+
+    """
+    b, theta, costheta, sintheta, bo, ro = np.broadcast_arrays(
+        *[
+            np.atleast_1d(np.array(arg, dtype=float)).flatten()
+            for arg in (b, theta, costheta, sintheta, bo, ro)
+        ]
+    )
+    npts = len(b)
+    xo = bo * sintheta
+    yo = bo * costheta
+
+    # Candidate roots & which half of the occultor they're on
+    roots = np.full((npts, 4), np.nan + 0j)
+    s = np.ones((npts, 4))
+    keep = np.zeros((npts, 4), dtype=bool)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        # Special case: b = 0
+        zero = np.abs(b) < STARRY_B_ZERO_TOL
+        term = np.sqrt(ro ** 2 - yo ** 2)
+        roots[zero, 0] = (xo + term)[zero]
+        roots[zero, 1] = (xo - term)[zero]
+        keep[zero, :2] = np.abs(roots[zero, :2]) < 1
+        keep[zero, 1] &= roots[zero, 0] != roots[zero, 1]
+        s[zero] = np.where(yo[zero] < 0, 1, -1).reshape(-1, 1)
+
+        # Note that `np.roots` trims leading and trailing zeros, so
+        # we let it handle those (rare) cases below
+        coeffs = get_quartic_coeffs(b, xo, yo, ro).T
+        trim = ~zero & ((coeffs[:, 0] == 0) | (coeffs[:, -1] == 0))
+
+        # Warm start: polish the guesses (if any) and check we didn't miss
+        # any roots. The rows for which this fails are solved from scratch.
+        tracked = np.zeros(npts, dtype=bool)
+        if guess is not None:
+            seeds = np.full((npts, 4), np.nan)
+            guess = np.array(guess, dtype=float).reshape(npts, -1)
+            seeds[:, : guess.shape[1]] = guess
+            seeded = np.isfinite(seeds)
+            idx = np.flatnonzero(~zero & ~trim & np.any(seeded, axis=1))
+            minx, minf, ss = _polish_roots(
+                seeds[idx].flatten() + 0j,
+                *[np.repeat(arg[idx], 4) for arg in (b, xo, yo, ro)]
+            )
+            roots[idx] = minx.reshape(-1, 4)
+            s[idx] = ss.reshape(-1, 4)
+            keep[idx] = seeded[idx]
+            tracked[idx] = _check_tracked_roots(
+                roots[idx],
+                seeded[idx],
+                minf.reshape(-1, 4),
+                coeffs[idx],
+                b[idx],
+                xo[idx],
+                yo[idx],
+                ro[idx],
+                costheta[idx],
+                sintheta[idx],
+                bo[idx],
+            )
+            roots[~zero & ~tracked] = np.nan
+            keep[~zero & ~tracked] = False
+
+        # Need to solve a quartic
+        for n in np.flatnonzero(trim):
+            r = np.roots(coeffs[n])
+            roots[n, : len(r)] = r
+        quartic = ~zero & ~tracked & ~trim
+        companion = np.zeros((np.count_nonzero(quartic), 4, 4))
+        companion[:, 0] = -coeffs[quartic, 1:] / coeffs[quartic, :1]
+        companion[:, 1, 0] = companion[:, 2, 1] = companion[:, 3, 2] = 1
+        roots[quartic] = np.linalg.eigvals(companion)
+
+        # Polish all the roots at once
+        idx = np.flatnonzero(~zero & ~tracked)
+        minx, minf, ss = _polish_roots(
+            roots[idx].flatten(), *[np.repeat(arg[idx], 4) for arg in (b, xo, yo, ro)]
+        )
+
+        # Only keep the roots that converged and are real
+        roots[idx] = minx.reshape(-1, 4)
+        s[idx] = ss.reshape(-1, 4)
+        keep[idx] = (
+            (minf < STARRY_ROOT_TOL_MED)
+            & (np.abs(minx.imag) < STARRY_ROOT_TOL_HIGH)
+            & (np.abs(minx.real) <= 1)
+        ).reshape(-1, 4)
+        x = roots.real
+
+        # Check that we haven't included any root already
+        for j in range(1, 4):
+            for k in range(j):
+                close = np.abs(x[:, k] - x[:, j]) < STARRY_ROOT_TOL_DUP
+                keep[:, j] &= ~(keep[:, k] & close)
+
+        # Derivatives
+        if gradient:
+            dxdb = np.empty((npts, 4))
+            dxdtheta = np.empty((npts, 4))
+            dxdbo = np.empty((npts, 4))
+            dxdro = np.empty((npts, 4))
+            bo_ = bo.reshape(-1, 1)
+            ro_ = ro.reshape(-1, 1)
+            xo_ = xo.reshape(-1, 1)
+            c = costheta.reshape(-1, 1)
+            sn = sintheta.reshape(-1, 1)
+
+            # Special case: b = 0
+            q = np.sqrt(ro_ ** 2 - (x - xo_) ** 2)
+            dxdb[zero] = (s * np.sqrt(1 - x ** 2) * q / (x - xo_))[zero]
+            dxdtheta[zero] = (bo_ * (c - s * q / (x - xo_) * sn))[zero]
+            dxdbo[zero] = (sn + s * q / (x - xo_) * c)[zero]
+            dxdro[zero] = (ro_ / (x - xo_))[zero]
+
+            # Quartic
+            p = np.sqrt(1 - x ** 2)
+            v = (x - xo_) / q
+            w = b.reshape(-1, 1) / p
+            t = 1 / (-w * x - s * v)
+            dxdb[~zero] = (-t * p)[~zero]
+            dxdtheta[~zero] = (-t * bo_ * (sn + s * v * c))[~zero]
+            dxdbo[~zero] = (t * (c - s * v * sn))[~zero]
+            dxdro[~zero] = (-t * s * ro_ / q)[~zero]
+
+    # Move the roots we're keeping to the front
+    order = np.argsort(~keep, axis=1, kind="stable")
+    keep = np.take_along_axis(keep, order, axis=1)
+    x = np.where(keep, np.take_along_axis(x, order, axis=1), np.nan)
+    nroots = np.count_nonzero(keep, axis=1)
+    if gradient:
+        dx = [
+            np.where(keep, np.take_along_axis(dx, order, axis=1), np.nan)
+            for dx in (dxdb, dxdtheta, dxdbo, dxdro)
+        ]
+
+    # Check if the extrema of the terminator ellipse are occulted
+    e1 = costheta ** 2 + (sintheta - bo) ** 2 < ro ** 2 + STARRY_ROOT_TOL_HIGH
+    e2 = costheta ** 2 + (sintheta + bo) ** 2 < ro ** 2 + STARRY_ROOT_TOL_HIGH
+
+    # Let `get_roots` deal with the cases where the solver
+    # did not find the correct number of roots
+    for n in np.flatnonzero(e2 & ~e1 & ((nroots == 0) | (nroots == 2))):
+        res = get_roots(
+            b[n], theta[n], costheta[n], sintheta[n], bo[n], ro[n], gradient=True
+        )
+        nroots[n] = len(res[0])
+        x[n] = np.nan
+        x[n, : nroots[n]] = res[0]
+        if gradient:
+            for dx_, res_ in zip(dx, res[1]):
+                dx_[n] = np.nan
+                dx_[n, : nroots[n]] = res_
+
+    # Delete single roots if none of the extrema are occulted
+    # (see `get_roots`)
+    single = (nroots == 1) & ~e1 & ~e2
+    nroots[single] = 0
+    x[single] = np.nan
+    if gradient:
+        for dx_ in dx:
+            dx_[single] = np.nan
+
+    # Return the value of the roots
+    if gradient:
+        return x, nroots, dx
+    else:
+        return x, nroots
+
+
+@timed
+def get_angles(b, theta, costheta, sintheta, bo, ro, roots=None):
 
     # Trivial cases
     if bo <= ro - 1 + STARRY_COMPLETE_OCC_TOL:
@@ -298,10 +610,14 @@ def get_angles(b, theta, costheta, sintheta, bo, ro):
         bo = 1 - ro + STARRY_GRAZING_TOL
 
     # Get the points of intersection between the occultor & terminator
-    # These are the roots to a quartic equation.
+    # These are the roots to a quartic equation (unless the caller
+    # already computed them).
     xo = bo * sintheta
     yo = bo * costheta
-    x = get_roots(b, theta, costheta, sintheta, bo, ro)
+    if roots is None:
+        x = get_roots(b, theta, costheta, sintheta, bo, ro)
+    else:
+        x = np.array(roots)
 
     # P-Q
     if len(x) == 0:
@@ -652,3 +968,133 @@ def get_angles(b, theta, costheta, sintheta, bo, ro):
         code,
     )
 
+
+@timed
+def get_angles_batch(b, theta, costheta, sintheta, bo, ro, track=False):
+    """
+    Vectorized version of `get_angles` for arrays of geometries.
+
+    The trivial cases (complete occultation, no occultation, and occultors
+    that cannot intersect the terminator) are classified with array masks;
+    only the remaining points are sent to the (batched) root solver.
+    Returns lists of the `kappa`, `lam` and `xi` arrays for each point and
+    an array of integration codes.
+
+    If `track` is True, the points are assumed to be ordered in time, and
+    the roots at each point are used as the initial guess for the roots at
+    the next one (see `get_roots_batch`). This is only faster for long
+    series, so it is ignored unless at least `STARRY_TRACK_MIN_POINTS`
+    points need the root solver.
+
+    """
+    b, theta, costheta, sintheta, bo, ro = np.broadcast_arrays(
+        *[
+            np.atleast_1d(np.array(arg, dtype=float)).flatten()
+            for arg in (b, theta, costheta, sintheta, bo, ro)
+        ]
+    )
+    npts = len(b)
+    kappa = [np.array([]) for i in range(npts)]
+    lam = [np.array([]) for i in range(npts)]
+    xi = [np.array([]) for i in range(npts)]
+    code = np.full(npts, -1, dtype=int)
+
+    # Complete occultation
+    code[bo <= ro - 1 + STARRY_COMPLETE_OCC_TOL] = FLUX_ZERO
+
+    # No occultation
+    code[(code < 0) & (bo >= 1 + ro - STARRY_NO_OCC_TOL)] = FLUX_SIMPLE_REFL
+
+    # Grazing hack (see `get_angles`)
+    bo_ = np.where(
+        (1 - ro < bo) & (bo < 1 - ro + STARRY_GRAZING_TOL),
+        1 - ro + STARRY_GRAZING_TOL,
+        bo,
+    )
+
+    # NOTE: Not all of the quantities below are defined for
+    # every point, so we silence the warnings
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        # Occultors that can't possibly intersect the terminator. In the
+        # frame where the semi-major axis of the terminator is along the x
+        # axis, the terminator lies in the band 0 < y / b < 1 and inside an
+        # ellipse of semi-minor axis |b|, so the distance from the occultor
+        # center to it is at least |b| times its distance in "ellipse units".
+        xo = bo_ * sintheta
+        yo = bo_ * costheta
+        tol = ro + STARRY_TERMINATOR_TOL
+        rho = np.sqrt(xo ** 2 + (yo / b) ** 2)
+        notrm = (
+            (yo - np.maximum(b, 0) > tol)
+            | (yo - np.minimum(b, 0) < -tol)
+            | (np.abs(xo) > 1 + tol)
+            | (np.abs(b) * np.abs(rho - 1) > tol)
+        )
+
+        # These are classified just like the case with no
+        # roots in `get_angles`
+        i = (code < 0) & notrm
+        limb = i & (np.abs(1 - ro) <= bo_) & (bo_ <= 1 + ro)
+        q = (1 - ro ** 2 + bo_ ** 2) / (2 * bo_)
+        x = (1 - STARRY_ANGLE_TOL) * np.sqrt(1 - q ** 2)
+        y = (1 - STARRY_ANGLE_TOL) * q
+        day = on_dayside(b, theta, costheta, sintheta, x, y)
+
+        # The limb point is on the dayside; check the night side
+        x = (1 - STARRY_ANGLE_TOL) * np.cos(theta + 3 * np.pi / 2)
+        y = (1 - STARRY_ANGLE_TOL) * np.sin(theta + 3 * np.pi / 2)
+        night_occ = x ** 2 + (y - bo_) ** 2 <= ro ** 2
+        code[limb & day & night_occ] = FLUX_SIMPLE_OCC
+        code[limb & day & ~night_occ] = FLUX_SIMPLE_OCC_REFL
+
+        # The limb point is on the night side; check the dayside
+        x = (1 - STARRY_ANGLE_TOL) * np.cos(theta + np.pi / 2)
+        y = (1 - STARRY_ANGLE_TOL) * np.sin(theta + np.pi / 2)
+        day_occ = x ** 2 + (y - bo_) ** 2 <= ro ** 2
+        code[limb & ~day & day_occ] = FLUX_ZERO
+        code[limb & ~day & ~day_occ] = FLUX_SIMPLE_REFL
+
+        # The occultor does not intersect the limb
+        center_day = on_dayside(b, theta, costheta, sintheta, 0, bo_)
+        code[i & ~limb & center_day] = FLUX_SIMPLE_OCC_REFL
+        code[i & ~limb & ~center_day] = FLUX_SIMPLE_REFL
+
+    # The rest may intersect the terminator, so we need the roots
+    idx = np.flatnonzero(code < 0)
+    args = [arg[idx] for arg in (b, theta, costheta, sintheta, bo_, ro)]
+    if track and len(idx) >= STARRY_TRACK_MIN_POINTS:
+
+        # Seed each point with the roots at the previous point. To keep
+        # things vectorized, we split each run of consecutive points into
+        # interleaved chains and advance all of them at once. The first
+        # point in each chain is solved from scratch.
+        x = np.full((len(idx), 4), np.nan)
+        nroots = np.zeros(len(idx), dtype=int)
+        follows = np.append(False, np.diff(idx) == 1)
+        start = np.maximum.accumulate(np.where(follows, 0, np.arange(len(idx))))
+        step = (np.arange(len(idx)) - start) % STARRY_TRACK_STRIDE
+        for n in range(STARRY_TRACK_STRIDE):
+            k = np.flatnonzero(step == n)
+            if len(k) == 0:
+                continue
+            x[k], nroots[k] = get_roots_batch(
+                *[arg[k] for arg in args], guess=x[k - 1] if n > 0 else None
+            )
+
+    else:
+
+        x, nroots = get_roots_batch(*args)
+
+    for k, n in enumerate(idx):
+        kappa[n], lam[n], xi[n], code[n] = get_angles(
+            b[n],
+            theta[n],
+            costheta[n],
+            sintheta[n],
+            bo[n],
+            ro[n],
+            roots=x[k, : nroots[k]],
+        )
+
+    return kappa, lam, xi, code
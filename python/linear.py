@@ -14,6 +14,10 @@ def dP2(bo, ro, k2, kappa, s1, s2, c1, F, E, PIprime):
 
     for i = 0, 2, 4, ...
 
+    If `bo`, `ro`, `k2` and the elliptic integrals have shape `(N,)` and
+    the limits have shape `(N, 2k)`, the `N` differences are computed at
+    once; the special cases below must then be handled by the caller.
+
     """
 
     # Useful variables
@@ -25,42 +29,47 @@ def dP2(bo, ro, k2, kappa, s1, s2, c1, F, E, PIprime):
     d2 = r2 + b2 - 2 * br
     term = 0.5 / np.sqrt(br * k2)
     p0 = 4.0 - 7.0 * r2 - b2
-    q2 = r2 + b2 - 2 * br * (1 - 2 * s2)
 
-    # Special cases
-    if bo == 0.0:
+    # Special cases (for arrays of geometries, these are handled by the caller)
+    if np.ndim(bo) == 0:
+
+        if bo == 0.0:
 
-        # Analytic limit
-        if ro < 1.0:
-            return (1 - (1 - r2) * np.sqrt(1 - r2)) * pairdiff(kappa) / 3.0
-        else:
-            return pairdiff(kappa) / 3.0
+            # Analytic limit
+            if ro < 1.0:
+                return (1 - (1 - r2) * np.sqrt(1 - r2)) * pairdiff(kappa) / 3.0
+            else:
+                return pairdiff(kappa) / 3.0
 
-    elif np.abs(bo - ro) < STARRY_PAL_BO_EQUALS_RO_TOL:
+        elif np.abs(bo - ro) < STARRY_PAL_BO_EQUALS_RO_TOL:
 
-        # Solve numerically
-        return pal(bo, ro, kappa)
+            # Solve numerically
+            return pal(bo, ro, kappa)
 
-    elif np.abs(bo - (ro - 1)) < STARRY_PAL_BO_EQUALS_RO_MINUS_ONE_TOL:
+        elif np.abs(bo - (ro - 1)) < STARRY_PAL_BO_EQUALS_RO_MINUS_ONE_TOL:
 
-        # Solve numerically
-        return pal(bo, ro, kappa)
+            # Solve numerically
+            return pal(bo, ro, kappa)
 
-    elif np.abs(bo - (1 - ro)) < STARRY_PAL_BO_EQUALS_ONE_MINUS_RO_TOL:
+        elif np.abs(bo - (1 - ro)) < STARRY_PAL_BO_EQUALS_ONE_MINUS_RO_TOL:
 
-        # Solve numerically
-        return pal(bo, ro, kappa)
+            # Solve numerically
+            return pal(bo, ro, kappa)
 
     # Constant term
-    if bo == ro:
+    if np.ndim(bo) == 0 and bo == ro:
         a0 = 0
     else:
+        bmr_ = np.expand_dims(bmr, -1)
         a0 = -pairdiff(
-            np.arctan2(-bmr * c1, bpr * s1)
-            + 2 * np.pi * np.sign(bmr) * (kappa > 3 * np.pi)
+            np.arctan2(-bmr_ * c1, np.expand_dims(bpr, -1) * s1)
+            + 2 * np.pi * np.sign(bmr_) * (kappa > 3 * np.pi),
+            axis=-1,
         )
-    a1 = 0.5 * pairdiff(kappa)
-    a2 = -2.0 * pairdiff(s1 * c1 * np.sqrt(1 - np.minimum(1.0, q2)))
+    a1 = 0.5 * pairdiff(kappa, axis=-1)
+    # NOTE: 1 - q^2 = 4 bo ro (k^2 - s^2), which is exactly zero on the limb
+    z2 = 4 * np.expand_dims(br, -1) * np.maximum(0.0, np.expand_dims(k2, -1) - s2)
+    a2 = -2.0 * pairdiff(s1 * c1 * np.sqrt(z2), axis=-1)
     A = a0 + a1 + TWOTHIRDS * br * a2
 
     # Carlson RD term
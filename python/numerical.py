@@ -1,66 +1,281 @@
 from starrynight import StarryNight
 from geometry import get_angles
+from basis import poly_basis
 import numpy as np
-from starry._core.ops.polybasis import pTOp
-from scipy.integrate import quad
-import theano
 
 
 __all__ = ["Brute", "Numerical"]
 
 
+# Cache of the Gauss-Legendre nodes and weights, keyed on the order
+_LEGGAUSS = {}
+
+
 class Brute(StarryNight):
-    """Compute the flux using brute force grid integration."""
+    """
+    Compute the flux using brute force grid integration.
+
+    The grid has `res` x `res` points and is processed a few rows at a
+    time, so that the polynomial basis evaluated on each chunk occupies
+    at most (roughly) `max_memory` bytes.
 
-    def __init__(self, *args, res=4999, **kwargs):
+    """
+
+    def __init__(self, *args, res=4999, max_memory=2 ** 28, **kwargs):
 
         # Initialize
         super().__init__(*args, **kwargs)
 
         # Extra args
         self.res = res
-
-        # Poly basis op
-        x = theano.tensor.dvector()
-        y = theano.tensor.dvector()
-        z = theano.tensor.dvector()
-        self.pT = theano.function([x, y, z], pTOp(self.ops.pT, self.ydeg + 1)(x, y, z),)
+        self.max_memory = max_memory
 
     def precompute(self, b, theta, bo, ro):
         # Ingest
         self.ingest(b, theta, bo, ro)
 
         # Illumination matrix
-        self.IA1 = self.illum().dot(self.A1)
+        self.IA1 = self.illum_A1()
 
     def design_matrix(self, b, theta, bo, ro):
 
         # Pre-compute expensive stuff
         self.precompute(b, theta, bo, ro)
 
-        # Grid up
+        # Number of grid rows per chunk
+        nrows = int(self.max_memory // (8 * self.res * (self.ydeg + 2) ** 2))
+        nrows = min(self.res, max(1, nrows))
+
+        # Sum the polynomial basis over the visible dayside, one chunk
+        # of the grid at a time
         p = np.linspace(-1, 1, self.res)
-        xpt, ypt = np.meshgrid(p, p)
-        xpt = xpt.flatten()
-        ypt = ypt.flatten()
-        zpt = np.sqrt(1 - xpt ** 2 - ypt ** 2)
-        cond1 = xpt ** 2 + (ypt - self.bo) ** 2 > self.ro ** 2  # outside occultor
-        cond2 = xpt ** 2 + ypt ** 2 < 1  # inside occulted
-        xr = xpt * np.cos(self.theta) + ypt * np.sin(self.theta)
-        yr = -xpt * np.sin(self.theta) + ypt * np.cos(self.theta)
-        cond3 = yr > self.b * np.sqrt(1 - xr ** 2)  # above terminator
-        X = self.pT(xpt, ypt, zpt).dot(self.IA1)
-        return 4 * np.sum(X[cond1 & cond2 & cond3], axis=0) / (self.res ** 2)
+        pT = np.zeros((self.ydeg + 2) ** 2)
+        for i in range(0, self.res, nrows):
+            xpt, ypt = np.meshgrid(p, p[i : i + nrows])
+            xpt = xpt.flatten()
+            ypt = ypt.flatten()
+            cond1 = xpt ** 2 + (ypt - self.bo) ** 2 > self.ro ** 2  # outside occultor
+            cond2 = xpt ** 2 + ypt ** 2 < 1  # inside occulted
+            xr = xpt * self.costheta + ypt * self.sintheta
+            yr = -xpt * self.sintheta + ypt * self.costheta
+            cond3 = yr > self.b * np.sqrt(1 - xr ** 2)  # above terminator
+            idx = cond1 & cond2 & cond3
+            xpt = xpt[idx]
+            ypt = ypt[idx]
+            zpt = np.sqrt(1 - xpt ** 2 - ypt ** 2)
+            pT += np.sum(poly_basis(self.ydeg + 1, xpt, ypt, zpt), axis=0)
+
+        return 4 * pT.dot(self.IA1) / (self.res ** 2)
+
+
+def _z(x, y):
+    # NOTE: The abs prevents NaNs when the argument of the sqrt is
+    # zero but floating point error causes it to be ~ -eps.
+    return np.maximum(1e-12, np.sqrt(np.abs(1 - x ** 2 - y ** 2)))
+
+
+def _Glm(l, m):
+    """Return the two components of the Green's basis vector field G_lm."""
+    mu = l - m
+    nu = l + m
+    z = _z
+
+    if nu % 2 == 0:
+        G = [lambda x, y: 0, lambda x, y: x ** (0.5 * (mu + 2)) * y ** (0.5 * nu)]
+    elif (l == 1) and (m == 0):
+
+        def G0(x, y):
+            z_ = z(x, y)
+            if z_ > 1 - 1e-8:
+                return -0.5 * y
+            else:
+                return (1 - z_ ** 3) / (3 * (1 - z_ ** 2)) * (-y)
+
+        def G1(x, y):
+            z_ = z(x, y)
+            if z_ > 1 - 1e-8:
+                return 0.5 * x
+            else:
+                return (1 - z_ ** 3) / (3 * (1 - z_ ** 2)) * x
+
+        G = [G0, G1]
+
+    elif (mu == 1) and (l % 2 == 0):
+        G = [lambda x, y: x ** (l - 2) * z(x, y) ** 3, lambda x, y: 0]
+    elif (mu == 1) and (l % 2 != 0):
+        G = [lambda x, y: x ** (l - 3) * y * z(x, y) ** 3, lambda x, y: 0]
+    else:
+        G = [
+            lambda x, y: 0,
+            lambda x, y: x ** (0.5 * (mu - 3)) * y ** (0.5 * (nu - 1)) * z(x, y) ** 3,
+        ]
+    return G
+
+
+def _G(ydeg, x, y):
+    """
+    Return the two components of all the Green's basis vector fields up to
+    degree `ydeg` at the points `(x, y)`, each of shape
+    `(npts, (ydeg + 1) ** 2)`.
+
+    """
+    z = _z(x, y)
+    z3 = z ** 3
+    G0 = np.zeros((len(x), (ydeg + 1) ** 2))
+    G1 = np.zeros((len(x), (ydeg + 1) ** 2))
+    n = 0
+    for l in range(ydeg + 1):
+        for m in range(-l, l + 1):
+            mu = l - m
+            nu = l + m
+            if nu % 2 == 0:
+                G1[:, n] = x ** (0.5 * (mu + 2)) * y ** (0.5 * nu)
+            elif (l == 1) and (m == 0):
+                f = np.where(
+                    z > 1 - 1e-8,
+                    0.5,
+                    (1 - z3) / (3 * np.maximum(1e-8, 1 - z ** 2)),
+                )
+                G0[:, n] = -f * y
+                G1[:, n] = f * x
+            elif (mu == 1) and (l % 2 == 0):
+                G0[:, n] = x ** (l - 2) * z3
+            elif (mu == 1) and (l % 2 != 0):
+                G0[:, n] = x ** (l - 3) * y * z3
+            else:
+                G1[:, n] = x ** (0.5 * (mu - 3)) * y ** (0.5 * (nu - 1)) * z3
+            n += 1
+    return G0, G1
+
+
+def _curve(kind, b, theta, bo, ro):
+    """
+    Return the functions `x`, `y`, `dx`, and `dy` parametrizing the
+    occultor limb (`kind = "P"`), the occulted body's limb (`"Q"`) or
+    the terminator (`"T"`).
+
+    """
+    if kind == "P":
+        x = lambda phi: ro * np.cos(phi)
+        y = lambda phi: bo + ro * np.sin(phi)
+        dx = lambda phi: -ro * np.sin(phi)
+        dy = lambda phi: ro * np.cos(phi)
+    elif kind == "Q":
+        x = lambda lam: np.cos(lam)
+        y = lambda lam: np.sin(lam)
+        dx = lambda lam: -np.sin(lam)
+        dy = lambda lam: np.cos(lam)
+    elif kind == "T":
+        x = lambda xi: np.cos(theta) * np.cos(xi) - b * np.sin(theta) * np.sin(xi)
+        y = lambda xi: np.sin(theta) * np.cos(xi) + b * np.cos(theta) * np.sin(xi)
+        dx = lambda xi: -np.cos(theta) * np.sin(xi) - b * np.sin(theta) * np.cos(xi)
+        dy = lambda xi: -np.sin(theta) * np.sin(xi) + b * np.cos(theta) * np.cos(xi)
+    else:
+        raise ValueError("Unknown curve `{}`.".format(kind))
+    return x, y, dx, dy
+
+
+def _primitive_quad(l, m, kind, b, theta, bo, ro, theta1, theta2, epsabs, epsrel):
+    """A single primitive integral computed with adaptive quadrature."""
+    from scipy.integrate import quad
+
+    G = _Glm(l, m)
+    x, y, dx, dy = _curve(kind, b, theta, bo, ro)
+    func = lambda t: G[0](x(t), y(t)) * dx(t) + G[1](x(t), y(t)) * dy(t)
+    res, _ = quad(func, theta1, theta2, epsabs=epsabs, epsrel=epsrel)
+    return res
+
+
+def _primitive_fixed(ydeg, kind, b, theta, bo, ro, theta1, theta2, order):
+    """
+    All primitive integrals up to degree `ydeg` along a single arc,
+    computed on a fixed Gauss-Legendre grid with `order` nodes.
+
+    """
+    if order not in _LEGGAUSS:
+        _LEGGAUSS[order] = np.polynomial.legendre.leggauss(order)
+    t, w = _LEGGAUSS[order]
+    t = 0.5 * (theta2 - theta1) * t + 0.5 * (theta2 + theta1)
+    w = 0.5 * (theta2 - theta1) * w
+    x, y, dx, dy = _curve(kind, b, theta, bo, ro)
+    G0, G1 = _G(ydeg, x(t), y(t))
+    return (w * dx(t)) @ G0 + (w * dy(t)) @ G1
+
+
+def _star(args):
+    """Unpack the arguments of a pool task."""
+    func, args = args
+    return func(*args)
 
 
 class Numerical(StarryNight):
-    """Compute the flux using Green's theorem and numerically solving the primitive integrals."""
+    """
+    Compute the flux using Green's theorem and numerically solving the
+    primitive integrals.
+
+    By default, each primitive integral is computed separately using
+    adaptive quadrature with tolerances `epsabs` and `epsrel`. If `order`
+    is given, all of the integrals along each arc are instead computed
+    at once on a fixed Gauss-Legendre grid with `order` nodes. If
+    `processes` is given, the integrals (or the arcs, for the fixed grid)
+    are spread over a pool of that many worker processes. The pool is
+    started on first use and kept until `close` is called (or terminated
+    when the instance is garbage collected); the instance may also be used
+    as a context manager, in which case the pool is closed on exit.
+
+    """
 
-    def __init__(self, *args, epsabs=1e-12, epsrel=1e-12, **kwargs):
+    def __init__(
+        self, *args, epsabs=1e-12, epsrel=1e-12, order=None, processes=None, **kwargs
+    ):
         self.epsabs = epsabs
         self.epsrel = epsrel
+        self.order = order
+        self.processes = processes
+        self.pool = None
         super().__init__(*args, **kwargs)
 
+    def map(self, func, tasks):
+        """Evaluate `func` on each of the argument tuples in `tasks`."""
+        if self.processes is None:
+            return [func(*args) for args in tasks]
+        if self.pool is None:
+            from multiprocessing import Pool
+
+            self.pool = Pool(self.processes)
+        return self.pool.map(_star, [(func, args) for args in tasks])
+
+    def close(self):
+        """Shut down the pool of worker processes, if any."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # Joining the workers can hang at interpreter shutdown, so we only
+        # terminate them here. The pool may also be gone already.
+        try:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+        except Exception:
+            pass
+
+    def arcs(self):
+        """Return the type and limits of each of the arcs in the boundary."""
+        return (
+            [("P", phi1, phi2) for phi1, phi2 in self.phi.reshape(-1, 2)]
+            + [("Q", lam1, lam2) for lam1, lam2 in self.lam.reshape(-1, 2)]
+            + [("T", xi1, xi2) for xi1, xi2 in self.xi.reshape(-1, 2)]
+        )
+
     def precompute(self, b, theta, bo, ro):
         # Ingest
         self.ingest(b, theta, bo, ro)
@@ -72,107 +287,59 @@ class Numerical(StarryNight):
         self.phi = self.kappa - np.pi / 2
 
         # Illumination matrix
-        self.IA1 = self.illum().dot(self.A1)
+        self.IA1 = self.illum_A1()
 
         # Compute the three primitive integrals
-        self.P = np.zeros((self.ydeg + 2) ** 2)
-        self.Q = np.zeros((self.ydeg + 2) ** 2)
-        self.T = np.zeros((self.ydeg + 2) ** 2)
-        n = 0
-        for l in range(self.ydeg + 2):
-            for m in range(-l, l + 1):
-                self.P[n] = self.Plm(l, m)
-                self.Q[n] = self.Qlm(l, m)
-                self.T[n] = self.Tlm(l, m)
-                n += 1
-
-    def Glm(self, l, m):
-        mu = l - m
-        nu = l + m
-
-        # NOTE: The abs prevents NaNs when the argument of the sqrt is
-        # zero but floating point error causes it to be ~ -eps.
-        z = lambda x, y: np.maximum(1e-12, np.sqrt(np.abs(1 - x ** 2 - y ** 2)))
-
-        if nu % 2 == 0:
-            G = [lambda x, y: 0, lambda x, y: x ** (0.5 * (mu + 2)) * y ** (0.5 * nu)]
-        elif (l == 1) and (m == 0):
-
-            def G0(x, y):
-                z_ = z(x, y)
-                if z_ > 1 - 1e-8:
-                    return -0.5 * y
-                else:
-                    return (1 - z_ ** 3) / (3 * (1 - z_ ** 2)) * (-y)
-
-            def G1(x, y):
-                z_ = z(x, y)
-                if z_ > 1 - 1e-8:
-                    return 0.5 * x
-                else:
-                    return (1 - z_ ** 3) / (3 * (1 - z_ ** 2)) * x
-
-            G = [G0, G1]
-
-        elif (mu == 1) and (l % 2 == 0):
-            G = [lambda x, y: x ** (l - 2) * z(x, y) ** 3, lambda x, y: 0]
-        elif (mu == 1) and (l % 2 != 0):
-            G = [lambda x, y: x ** (l - 3) * y * z(x, y) ** 3, lambda x, y: 0]
+        geo = (self.b, self.theta, self.bo, self.ro)
+        arcs = self.arcs()
+        if self.order is None:
+            tasks = [
+                (l, m, kind) + geo + (t1, t2, self.epsabs, self.epsrel)
+                for kind, t1, t2 in arcs
+                for l in range(self.ydeg + 2)
+                for m in range(-l, l + 1)
+            ]
+            res = np.reshape(self.map(_primitive_quad, tasks), (len(arcs), -1))
         else:
-            G = [
-                lambda x, y: 0,
-                lambda x, y: x ** (0.5 * (mu - 3))
-                * y ** (0.5 * (nu - 1))
-                * z(x, y) ** 3,
+            tasks = [
+                (self.ydeg + 1, kind) + geo + (t1, t2, self.order)
+                for kind, t1, t2 in arcs
             ]
-        return G
-
-    def primitive(self, l, m, x, y, dx, dy, theta1, theta2):
-        """A general primitive integral computed numerically."""
-        G = self.Glm(l, m)
-        func = lambda theta: G[0](x(theta), y(theta)) * dx(theta) + G[1](
-            x(theta), y(theta)
-        ) * dy(theta)
-        res, _ = quad(func, theta1, theta2, epsabs=self.epsabs, epsrel=self.epsrel,)
-        return res
+            res = np.reshape(self.map(_primitive_fixed, tasks), (len(arcs), -1))
+        kinds = np.array([kind for kind, _, _ in arcs])
+        self.P = np.sum(res[kinds == "P"], axis=0)
+        self.Q = np.sum(res[kinds == "Q"], axis=0)
+        self.T = np.sum(res[kinds == "T"], axis=0)
+
+    def Glm(self, l, m):
+        return _Glm(l, m)
 
     def Qlm(self, l, m):
         """Compute the Q integral numerically from its integral definition."""
+        geo = (self.b, self.theta, self.bo, self.ro)
         res = 0
         for lam1, lam2 in self.lam.reshape(-1, 2):
-            x = lambda lam: np.cos(lam)
-            y = lambda lam: np.sin(lam)
-            dx = lambda lam: -np.sin(lam)
-            dy = lambda lam: np.cos(lam)
-            res += self.primitive(l, m, x, y, dx, dy, lam1, lam2)
+            res += _primitive_quad(
+                l, m, "Q", *geo, lam1, lam2, self.epsabs, self.epsrel
+            )
         return res
 
     def Tlm(self, l, m):
         """Compute the T integral numerically from its integral definition."""
+        geo = (self.b, self.theta, self.bo, self.ro)
         res = 0
         for xi1, xi2 in self.xi.reshape(-1, 2):
-            x = lambda xi: np.cos(self.theta) * np.cos(xi) - self.b * np.sin(
-                self.theta
-            ) * np.sin(xi)
-            y = lambda xi: np.sin(self.theta) * np.cos(xi) + self.b * np.cos(
-                self.theta
-            ) * np.sin(xi)
-            dx = lambda xi: -np.cos(self.theta) * np.sin(xi) - self.b * np.sin(
-                self.theta
-            ) * np.cos(xi)
-            dy = lambda xi: -np.sin(self.theta) * np.sin(xi) + self.b * np.cos(
-                self.theta
-            ) * np.cos(xi)
-            res += self.primitive(l, m, x, y, dx, dy, xi1, xi2)
+            res += _primitive_quad(
+                l, m, "T", *geo, xi1, xi2, self.epsabs, self.epsrel
+            )
         return res
 
     def Plm(self, l, m):
         """Compute the P integral numerically from its integral definition."""
+        geo = (self.b, self.theta, self.bo, self.ro)
         res = 0
         for phi1, phi2 in self.phi.reshape(-1, 2):
-            x = lambda phi: self.ro * np.cos(phi)
-            y = lambda phi: self.bo + self.ro * np.sin(phi)
-            dx = lambda phi: -self.ro * np.sin(phi)
-            dy = lambda phi: self.ro * np.cos(phi)
-            res += self.primitive(l, m, x, y, dx, dy, phi1, phi2)
+            res += _primitive_quad(
+                l, m, "P", *geo, phi1, phi2, self.epsabs, self.epsrel
+            )
         return res
@@ -1,14 +1,19 @@
-from special import hyp2f1, J, ellip
+from special import hyp2f1, J, ellip, tanh_sinh
 from utils import *
-from vieta import Vieta
+from timing import timed
+from vieta import vieta_table
 from linear import dP2
-import matplotlib.pyplot as plt
+from basis import green_basis
 import numpy as np
 
 
 __ALL__ = ["compute_P", "compute_Q", "comput_T"]
 
 
+# Tanh-sinh rule for the boundary integrals in the gradients
+GRAD_QUAD_X, GRAD_QUAD_W = tanh_sinh(STARRY_GRAD_QUAD_STEP, STARRY_GRAD_QUAD_HALF_NODES)
+
+
 def compute_U(vmax, s1):
     """
     Given s1 = sin(0.5 * kappa), compute the integral of
@@ -17,13 +22,14 @@ def compute_U(vmax, s1):
 
     from 0.5 * kappa1 to 0.5 * kappa2 recursively and return an array 
     containing the values of this function from v = 0 to v = vmax.
+    If `s1` has shape `(N, 2k)`, the result has shape `(N, vmax + 1)`.
 
     """
-    U = np.empty(vmax + 1)
-    U[0] = pairdiff(s1)
+    U = np.empty(np.shape(s1)[:-1] + (vmax + 1,))
+    U[..., 0] = pairdiff(s1, axis=-1)
     term = s1 ** 2
     for v in range(1, vmax + 1):
-        U[v] = pairdiff(term) / (v + 1)
+        U[..., v] = pairdiff(term, axis=-1) / (v + 1)
         term *= s1
     return U
 
@@ -31,19 +37,70 @@ def compute_U(vmax, s1):
 def compute_I(nmax, kappa, s1, c1):
 
     # Lower boundary
-    I = np.empty(nmax + 1)
-    I[0] = 0.5 * pairdiff(kappa)
+    I = np.empty(np.shape(kappa)[:-1] + (nmax + 1,))
+    I[..., 0] = 0.5 * pairdiff(kappa, axis=-1)
 
     # Recurse upward
     s2 = s1 ** 2
     term = s1 * c1
     for v in range(1, nmax + 1):
-        I[v] = (1.0 / (2 * v)) * ((2 * v - 1) * I[v - 1] - pairdiff(term))
+        I[..., v] = (1.0 / (2 * v)) * (
+            (2 * v - 1) * I[..., v - 1] - pairdiff(term, axis=-1)
+        )
         term *= s2
 
     return I
 
 
+def _compute_W_down(nmax, s2, q2, q3):
+    """Compute `_compute_W_indef` by downward recursion."""
+    # Setup
+    invs2 = 1 / s2
+    z = (1 - q2) * invs2
+    s2nmax = s2 ** nmax
+    x = q2 * q3 * s2nmax
+    W = np.empty((nmax + 1,) + np.shape(s2))
+
+    # Upper boundary condition
+    W[nmax] = (
+        s2
+        * s2nmax
+        * (3 / (nmax + 1) * hyp2f1(-0.5, nmax + 1, nmax + 2, 1 - q2) + 2 * q3)
+        / (2 * nmax + 5)
+    )
+
+    # Recurse down
+    for b in range(nmax - 1, -1, -1):
+        f = 1 / (b + 1)
+        A = z * (1 + 2.5 * f)
+        B = x * f
+        W[b] = A * W[b + 1] + B
+        x *= invs2
+
+    return W
+
+
+def _compute_W_up(nmax, s2, q2, q3):
+    """Compute `_compute_W_indef` by upward recursion."""
+    # Setup
+    z = s2 / (1 - q2)
+    x = -2 * q3 * (z - s2) * s2
+    W = np.empty((nmax + 1,) + np.shape(s2))
+
+    # Lower boundary condition
+    W[0] = (2 / 5) * (z * (1 - q3) + s2 * q3)
+
+    # Recurse up
+    for b in range(1, nmax + 1):
+        f = 1 / (2 * b + 5)
+        A = z * (2 * b) * f
+        B = x * f
+        W[b] = A * W[b - 1] + B
+        x *= s2
+
+    return W
+
+
 def _compute_W_indef(nmax, s2, q2, q3):
     """
     Compute the expression
@@ -56,140 +113,139 @@ def _compute_W_indef(nmax, s2, q2, q3):
         q = (1 - s^2 / k^2)^1/2
 
     by either upward recursion (stable for |1 - q^2| > 1/2) or downward 
-    recursion (always stable).
+    recursion (always stable). The arguments may be arrays of any shape,
+    in which case the direction of the recursion is chosen separately for
+    each element and the result has shape `(nmax + 1,) + shape`.
 
     """
-    W = np.empty(nmax + 1)
-
-    if np.abs(1 - q2) < 0.5:
-
-        # Setup
-        invs2 = 1 / s2
-        z = (1 - q2) * invs2
-        s2nmax = s2 ** nmax
-        x = q2 * q3 * s2nmax
-
-        # Upper boundary condition
-        W[nmax] = (
-            s2
-            * s2nmax
-            * (3 / (nmax + 1) * hyp2f1(-0.5, nmax + 1, nmax + 2, 1 - q2) + 2 * q3)
-            / (2 * nmax + 5)
-        )
-
-        # Recurse down
-        for b in range(nmax - 1, -1, -1):
-            f = 1 / (b + 1)
-            A = z * (1 + 2.5 * f)
-            B = x * f
-            W[b] = A * W[b + 1] + B
-            x *= invs2
+    s2, q2, q3 = np.broadcast_arrays(s2, q2, q3)
+    down = np.abs(1 - q2) < 0.5
+    if np.all(down):
+        return _compute_W_down(nmax, s2, q2, q3)
+    elif not np.any(down):
+        return _compute_W_up(nmax, s2, q2, q3)
     else:
+        up = ~down
+        W = np.empty((nmax + 1,) + s2.shape)
+        W[:, down] = _compute_W_down(nmax, s2[down], q2[down], q3[down])
+        W[:, up] = _compute_W_up(nmax, s2[up], q2[up], q3[up])
+        return W
 
-        # Setup
-        z = s2 / (1 - q2)
-        x = -2 * q3 * (z - s2) * s2
-
-        # Lower boundary condition
-        W[0] = (2 / 5) * (z * (1 - q3) + s2 * q3)
 
-        # Recurse up
-        for b in range(1, nmax + 1):
-            f = 1 / (2 * b + 5)
-            A = z * (2 * b) * f
-            B = x * f
-            W[b] = A * W[b - 1] + B
-            x *= s2
+def compute_W(nmax, s2, q2, q3):
+    """
+    Return the array W[0 .. nmax] for the integration limits encoded in
+    `s2`, `q2`, and `q3`. If these have shape `(N, 2k)`, the recursions are
+    carried out for all `N` sets of limits at once and the result has shape
+    `(N, nmax + 1)`.
 
+    """
+    W = pairdiff(_compute_W_indef(nmax, s2, q2, q3), axis=-1)
+    if np.ndim(W) > 1:
+        W = np.moveaxis(W, 0, -1)
     return W
 
 
-def compute_W(nmax, s2, q2, q3):
-    return pairdiff(
-        np.array([_compute_W_indef(nmax, s2[i], q2[i], q3[i]) for i in range(len(s2))])
-    )
-
-
 def compute_J(nmax, k2, km2, kappa, s1, s2, c1, q2, dF, dE):
     """
     Return the array J[0 .. nmax], computed recursively using
     a tridiagonal solver and a lower boundary condition
     (analytic in terms of elliptic integrals) and an upper
-    boundary condition (computed numerically).
+    boundary condition (computed numerically). If `k2` has
+    shape `(N,)` and the limits have shape `(N, 2k)`, the `N`
+    systems are solved at once and the result has shape
+    `(N, nmax + 1)`.
     
     """
     # Boundary conditions
     z = s1 * c1 * np.sqrt(q2)
-    resid = km2 * pairdiff(z)
+    resid = km2 * pairdiff(z, axis=-1)
     f0 = (1 / 3) * (2 * (2 - km2) * dE + (km2 - 1) * dF + resid)
     fN = J(nmax, k2, kappa)
 
     # Set up the tridiagonal problem
-    a = np.empty(nmax - 1)
-    b = np.empty(nmax - 1)
-    c = np.empty(nmax - 1)
-    term = k2 * z * q2 ** 2
+    a = np.empty((nmax - 1,) + np.shape(k2))
+    b = np.empty((nmax - 1,) + np.shape(k2))
+    c = np.empty((nmax - 1,) + np.shape(k2))
+    term = np.expand_dims(k2, -1) * z * q2 ** 2
 
     for i, v in enumerate(range(2, nmax + 1)):
         amp = 1.0 / (2 * v + 3)
         a[i] = -2 * (v + (v - 1) * k2 + 1) * amp
         b[i] = (2 * v - 3) * k2 * amp
-        c[i] = pairdiff(term) * amp
+        c[i] = pairdiff(term, axis=-1) * amp
         term *= s2
 
     # Add the boundary conditions
     c[0] -= b[0] * f0
     c[-1] -= fN
 
-    # Construct the tridiagonal matrix
-    A = np.diag(a, 0) + np.diag(b[1:], -1) + np.diag(np.ones(nmax - 2), 1)
+    # Solve the tridiagonal system
+    soln = solve_tridiagonal(b, a, np.ones(nmax - 1), c)
+    return np.moveaxis(np.concatenate(([f0], soln, [fN])), 0, -1)
+
 
-    # Solve
-    soln = np.linalg.solve(A, c)
-    return np.concatenate(([f0], soln, [fN]))
+def _dot(a, b):
+    """Return the dot product of `a` and `b` along their last axis."""
+    if np.ndim(a) == 1:
+        return np.dot(a, b)
+    return (a[..., None, :] @ b[..., :, None])[..., 0, 0]
 
 
-def K(I, delta, u, v):
+def K(I, A, u, v):
     """Return the integral K, evaluated as a sum over I."""
-    return sum([Vieta(i, u, v, delta) * I[i + u] for i in range(u + v + 1)])
+    return _dot(A[..., u, v, : u + v + 1], I[..., u : 2 * u + v + 1])
 
 
-def L(J, k, delta, u, v, t):
+def L(J, k, A, u, v, t):
     """Return the integral L, evaluated as a sum over J."""
-    return k ** 3 * sum(
-        [Vieta(i, u, v, delta) * J[i + u + t] for i in range(u + v + 1)]
-    )
+    return k ** 3 * _dot(A[..., u, v, : u + v + 1], J[..., u + t : 2 * u + v + t + 1])
 
 
 def compute_H(uvmax, xi, gradient=False):
+    """
+    Return the array H[0 .. uvmax, 0 .. uvmax] for the integration
+    limits `xi`. If `xi` has shape `(N, 2k)`, the recursion is carried
+    out for all `N` sets of limits at once and the result has shape
+    `(N, uvmax + 1, uvmax + 1)`.
 
+    """
     c = np.cos(xi)
     s = np.sin(xi)
     cs = c * s
     cc = c ** 2
     ss = s ** 2
 
-    H = np.empty((uvmax + 1, uvmax + 1))
-    dH = np.empty((uvmax + 1, uvmax + 1, len(xi)))
-    H[0, 0] = pairdiff(xi)
+    H = np.empty((uvmax + 1, uvmax + 1) + np.shape(xi)[:-1])
+    dH = np.empty((uvmax + 1, uvmax + 1) + np.shape(xi))
+    H[0, 0] = pairdiff(xi, axis=-1)
     dH[0, 0] = 1
-    H[1, 0] = pairdiff(s)
+    H[1, 0] = pairdiff(s, axis=-1)
     dH[1, 0] = c
-    H[0, 1] = -pairdiff(c)
+    H[0, 1] = -pairdiff(c, axis=-1)
     dH[0, 1] = s
-    H[1, 1] = -0.5 * pairdiff(cc)
+    H[1, 1] = -0.5 * pairdiff(cc, axis=-1)
     dH[1, 1] = cs
 
     for u in range(2):
         for v in range(2, uvmax + 1 - u):
-            H[u, v] = (-pairdiff(dH[u, v - 2] * cs) + (v - 1) * H[u, v - 2]) / (u + v)
+            H[u, v] = (
+                -pairdiff(dH[u, v - 2] * cs, axis=-1) + (v - 1) * H[u, v - 2]
+            ) / (u + v)
             dH[u, v] = dH[u, v - 2] * ss
 
     for u in range(2, uvmax + 1):
         for v in range(uvmax + 1 - u):
-            H[u, v] = (pairdiff(dH[u - 2, v] * cs) + (u - 1) * H[u - 2, v]) / (u + v)
+            H[u, v] = (
+                pairdiff(dH[u - 2, v] * cs, axis=-1) + (u - 1) * H[u - 2, v]
+            ) / (u + v)
             dH[u, v] = dH[u - 2, v] * cc
 
+    # Move the batch axis to the front
+    if np.ndim(xi) > 1:
+        H = np.moveaxis(H, (0, 1), (-2, -1))
+        dH = np.moveaxis(dH, (0, 1), (-3, -2))
+
     if gradient:
         return H, dH
     else:
@@ -198,7 +254,8 @@ def compute_H(uvmax, xi, gradient=False):
 
 def _compute_T2_indef(b, xi):
     """
-    Note: requires b >= 0.
+    Note: requires b >= 0. The arguments may be arrays, which are
+    broadcast against each other.
     
     """
     s = np.sin(xi)
@@ -208,36 +265,70 @@ def _compute_T2_indef(b, xi):
     bc = np.sqrt(1 - b ** 2)
     bbc = b * bc
 
-    # Special cases
-    if xi == 0:
-        return -(np.arctan((2 * b ** 2 - 1) / (2 * bbc)) + bbc) / 3
-    elif xi == 0.5 * np.pi:
-        return (0.5 * np.pi - np.arctan(b / bc)) / 3
-    elif xi == np.pi:
-        return (0.5 * np.pi + bbc) / 3
-    elif xi == 1.5 * np.pi:
-        return (0.5 * np.pi + np.arctan(b / bc) + 2 * bbc) / 3
-
     # Figure out the offset
-    if xi < 0.5 * np.pi:
-        delta = 0
-    elif xi < np.pi:
-        delta = np.pi
-    elif xi < 1.5 * np.pi:
-        delta = 2 * bbc
-    else:
-        delta = np.pi + 2 * bbc
+    delta = np.where(
+        xi < np.pi,
+        np.where(xi < 0.5 * np.pi, 0, np.pi),
+        np.where(xi < 1.5 * np.pi, 2 * bbc, np.pi + 2 * bbc),
+    )
 
     # We're done
-    return (
-        np.arctan(b * t)
-        - sgn * (np.arctan(((s / (1 + c)) ** 2 + 2 * b ** 2 - 1) / (2 * bbc)) + bbc * c)
-        + delta
-    ) / 3
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res = (
+            np.arctan(b * t)
+            - sgn
+            * (np.arctan(((s / (1 + c)) ** 2 + 2 * b ** 2 - 1) / (2 * bbc)) + bbc * c)
+            + delta
+        ) / 3
+
+        # Special cases
+        res = np.where(
+            xi == 0, -(np.arctan((2 * b ** 2 - 1) / (2 * bbc)) + bbc) / 3, res
+        )
+        res = np.where(xi == 0.5 * np.pi, (0.5 * np.pi - np.arctan(b / bc)) / 3, res)
+        res = np.where(xi == np.pi, (0.5 * np.pi + bbc) / 3, res)
+        res = np.where(
+            xi == 1.5 * np.pi, (0.5 * np.pi + np.arctan(b / bc) + 2 * bbc) / 3, res
+        )
 
+    return res[()]
 
+
+@timed
 def compute_P(ydeg, bo, ro, kappa):
-    """Compute the P integral."""
+    """
+    Compute the P integral. If `bo` and `ro` have shape `(N,)` and `kappa`
+    has shape `(N, 2k)`, the integrals for all `N` geometries are
+    computed at once.
+
+    """
+    # Batched call: only the geometries at which the linear term must be
+    # computed numerically (see `dP2`) need to be done one at a time
+    if np.ndim(kappa) > 1:
+        special = (
+            (bo == 0.0)
+            | (np.abs(bo - ro) < STARRY_PAL_BO_EQUALS_RO_TOL)
+            | (np.abs(bo - (ro - 1)) < STARRY_PAL_BO_EQUALS_RO_MINUS_ONE_TOL)
+            | (np.abs(bo - (1 - ro)) < STARRY_PAL_BO_EQUALS_ONE_MINUS_RO_TOL)
+        )
+        P = np.empty((len(kappa), (ydeg + 1) ** 2))
+        for n in np.flatnonzero(special):
+            P[n] = compute_P(ydeg, bo[n], ro[n], kappa[n])
+        general = ~special
+        if np.any(general):
+            P[general] = _compute_P(ydeg, bo[general], ro[general], kappa[general])
+        return P
+
+    return _compute_P(ydeg, bo, ro, kappa)
+
+
+def _compute_P(ydeg, bo, ro, kappa):
+    """
+    Compute the P integral for a single geometry or, if `bo` and `ro` have
+    shape `(N,)` and `kappa` has shape `(N, 2k)`, for `N` geometries
+    that are not special cases of the linear term.
+
+    """
     # Basic variables
     delta = (bo - ro) / (2 * ro)
     k2 = (1 - ro ** 2 - bo ** 2 + 2 * bo * ro) / (4 * bo * ro)
@@ -245,17 +336,19 @@ def compute_P(ydeg, bo, ro, kappa):
     km2 = 1.0 / k2
     fourbr15 = (4 * bo * ro) ** 1.5
     k3fourbr15 = k ** 3 * fourbr15
-    tworo = np.empty(ydeg + 4)
-    tworo[0] = 1.0
+    tworo = np.empty(np.shape(ro) + (ydeg + 4,))
+    tworo[..., 0] = 1.0
     for i in range(1, ydeg + 4):
-        tworo[i] = tworo[i - 1] * 2 * ro
+        tworo[..., i] = tworo[..., i - 1] * 2 * ro
 
     # Pre-compute the helper integrals
     x = 0.5 * kappa
     s1 = np.sin(x)
     s2 = s1 ** 2
     c1 = np.cos(x)
-    q2 = 1 - np.minimum(1.0, s2 / k2)
+    k2_ = np.expand_dims(k2, -1)
+    s2 = np.where(np.abs(s2 - k2_) < STARRY_KAPPA_LIMB_TOL * k2_, k2_, s2)
+    q2 = 1 - np.minimum(1.0, s2 / k2_)
     q3 = q2 ** 1.5
     U = compute_U(2 * ydeg + 5, s1)
     I = compute_I(ydeg + 3, kappa, s1, c1)
@@ -265,8 +358,11 @@ def compute_P(ydeg, bo, ro, kappa):
     F, E, PIprime = ellip(bo, ro, kappa)
     J = compute_J(ydeg + 1, k2, km2, kappa, s1, s2, c1, q2, F, E)
 
+    # Tabulate the Vieta coefficients
+    A = vieta_table(ydeg, delta)
+
     # Now populate the P array
-    P = np.zeros((ydeg + 1) ** 2)
+    P = np.zeros(np.shape(bo) + ((ydeg + 1) ** 2,))
     n = 0
     for l in range(ydeg + 1):
         for m in range(-l, l + 1):
@@ -277,47 +373,47 @@ def compute_P(ydeg, bo, ro, kappa):
             if (mu / 2) % 2 == 0:
 
                 # Same as in starry
-                P[n] = 2 * tworo[l + 2] * K(I, delta, (mu + 4) // 4, nu // 2)
+                P[..., n] = 2 * tworo[..., l + 2] * K(I, A, (mu + 4) // 4, nu // 2)
 
             elif mu == 1:
 
                 if l == 1:
 
                     # Same as in starry, but using expression from Pal (2012)
-                    P[2] = dP2(bo, ro, k2, kappa, s1, s2, c1, F, E, PIprime)
+                    P[..., 2] = dP2(bo, ro, k2, kappa, s1, s2, c1, F, E, PIprime)
 
                 elif l % 2 == 0:
 
                     # Same as in starry
-                    P[n] = (
-                        tworo[l - 1]
+                    P[..., n] = (
+                        tworo[..., l - 1]
                         * fourbr15
                         * (
-                            L(J, k, delta, (l - 2) // 2, 0, 0)
-                            - 2 * L(J, k, delta, (l - 2) // 2, 0, 1)
+                            L(J, k, A, (l - 2) // 2, 0, 0)
+                            - 2 * L(J, k, A, (l - 2) // 2, 0, 1)
                         )
                     )
 
                 else:
 
                     # Same as in starry
-                    P[n] = (
-                        tworo[l - 1]
+                    P[..., n] = (
+                        tworo[..., l - 1]
                         * fourbr15
                         * (
-                            L(J, k, delta, (l - 3) // 2, 1, 0)
-                            - 2 * L(J, k, delta, (l - 3) // 2, 1, 1)
+                            L(J, k, A, (l - 3) // 2, 1, 0)
+                            - 2 * L(J, k, A, (l - 3) // 2, 1, 1)
                         )
                     )
 
             elif (mu - 1) / 2 % 2 == 0:
 
                 # Same as in starry
-                P[n] = (
+                P[..., n] = (
                     2
-                    * tworo[l - 1]
+                    * tworo[..., l - 1]
                     * fourbr15
-                    * L(J, k, delta, (mu - 1) // 4, (nu - 1) // 2, 0)
+                    * L(J, k, A, (mu - 1) // 4, (nu - 1) // 2, 0)
                 )
 
             else:
@@ -340,28 +436,33 @@ def compute_P(ydeg, bo, ro, kappa):
 
                 if nu % 2 == 0:
 
-                    res = 0
                     u = int((mu + 4.0) // 4)
                     v = int(nu / 2)
-                    for i in range(u + v + 1):
-                        res += Vieta(i, u, v, delta) * U[2 * (u + i) + 1]
-                    P[n] = 2 * tworo[l + 2] * res
+                    res = _dot(
+                        A[..., u, v, : u + v + 1],
+                        U[..., 2 * u + 1 : 4 * u + 2 * v + 2 : 2],
+                    )
+                    P[..., n] = 2 * tworo[..., l + 2] * res
 
                 else:
 
-                    res = 0
                     u = (mu - 1) // 4
                     v = (nu - 1) // 2
-                    for i in range(u + v + 1):
-                        res += Vieta(i, u, v, delta) * W[i + u]
-                    P[n] = tworo[l - 1] * k3fourbr15 * res
+                    res = _dot(A[..., u, v, : u + v + 1], W[..., u : 2 * u + v + 1])
+                    P[..., n] = tworo[..., l - 1] * k3fourbr15 * res
 
             n += 1
 
     return P
 
 
+@timed
 def compute_Q(ydeg, lam, gradient=False):
+    """
+    Compute the Q integral. If `lam` has shape `(N, 2k)`, the integrals
+    for all `N` sets of limits are computed at once.
+
+    """
 
     # Pre-compute H
     if gradient:
@@ -370,12 +471,12 @@ def compute_Q(ydeg, lam, gradient=False):
         H = compute_H(ydeg + 2, lam)
 
     # Allocate
-    Q = np.zeros((ydeg + 1) ** 2)
-    dQdlam = np.zeros(((ydeg + 1) ** 2, len(lam)))
+    Q = np.zeros(np.shape(lam)[:-1] + ((ydeg + 1) ** 2,))
+    dQdlam = np.zeros(np.shape(lam)[:-1] + ((ydeg + 1) ** 2, np.shape(lam)[-1]))
 
     # Note that the linear term is special
-    Q[2] = pairdiff(lam) / 3
-    dQdlam[2] = np.ones_like(lam) / 3
+    Q[..., 2] = pairdiff(lam, axis=-1) / 3
+    dQdlam[..., 2, :] = np.ones_like(lam) / 3
 
     # Easy!
     n = 0
@@ -385,15 +486,15 @@ def compute_Q(ydeg, lam, gradient=False):
             nu = l + m
             if nu % 2 == 0:
 
-                Q[n] = H[(mu + 4) // 2, nu // 2]
+                Q[..., n] = H[..., (mu + 4) // 2, nu // 2]
 
                 if gradient:
-                    dQdlam[n] = dH[(mu + 4) // 2, nu // 2]
+                    dQdlam[..., n, :] = dH[..., (mu + 4) // 2, nu // 2, :]
 
             n += 1
 
     # Enforce alternating signs for (lower, upper) limits
-    dQdlam *= np.repeat([-1, 1], len(lam) // 2).reshape(1, -1)
+    dQdlam *= np.repeat([-1, 1], np.shape(lam)[-1] // 2)
 
     if gradient:
         return Q, dQdlam
@@ -401,19 +502,198 @@ def compute_Q(ydeg, lam, gradient=False):
         return Q
 
 
+# Cache of the sparse tables used to compute T, keyed on `ydeg`
+_T_TABLES = {}
+
+
+def _T_table(ydeg):
+    """
+    Return the sparse table used to compute T in the general case
+    (sin(theta) != 0 and cos(theta) != 0).
+
+    The table is built once per `ydeg` by running the recursion for
+    cases 1, 3, 4 and 5 symbolically. Every term in those recursions is
+    a numerical coefficient times a monomial
+
+        b^i cos^j(theta) sin^k(theta) (1 - b^2)^(3l/2)
+
+    times an entry of H, so T is a sparse linear combination of products
+    of monomials and entries of H. Returns the exponents `(i, j, k, l)`
+    of the monomials, the monomial and H index of each term, and the
+    sparse matrix mapping the terms onto T.
+
+    """
+    table = _T_TABLES.get(ydeg, None)
+    if table is not None:
+        return table
+    from scipy.sparse import csr_matrix
+
+    # Symbolic variables, as (coefficient, exponents) pairs
+    one = (1.0, (0, 0, 0, 0))
+    bct = (1.0, (1, 1, 0, 0))
+    bst = (1.0, (1, 0, 1, 0))
+    ct = (1.0, (0, 1, 0, 0))
+    st = (1.0, (0, 0, 1, 0))
+    b2 = (1.0, (2, 0, 0, 0))
+    b32 = (1.0, (0, 0, 0, 1))
+    ttinvb = (1.0, (-1, -1, 1, 0))
+    invbtt = (1.0, (-1, 1, -1, 0))
+
+    def mul(*args):
+        coeff = 1.0
+        exps = (0, 0, 0, 0)
+        for c, e in args:
+            coeff *= c
+            exps = tuple(x + y for x, y in zip(exps, e))
+        return coeff, exps
+
+    def scale(x, fac):
+        return x[0] * fac, x[1]
+
+    terms = {}
+
+    def add(n, Z, p, q):
+        if Z[0] != 0:
+            key = (n, p, q) + Z[1]
+            terms[key] = terms.get(key, 0.0) + Z[0]
+
+    # Cases 1 and 5
+    jmax = 0
+    Z0 = one
+    for nu in range(0, 2 * ydeg + 1, 2):
+        kmax = 0
+        Z1 = Z0
+        for mu in range(0, 2 * ydeg - nu + 1, 2):
+            l = (mu + nu) // 2
+            n1 = l ** 2 + nu
+            n5 = (l + 2) ** 2 + nu + 1
+            Z2 = Z1
+            for j in range(jmax + 1):
+                Z_1 = mul(scale(bst, -1), Z2)
+                Z_5 = mul(b32, Z2)
+                for k in range(kmax + 1):
+                    p = j + k
+                    q = l + 1 - (j + k)
+                    fac = scale(invbtt, -1 / (k + 1))
+                    add(n1, mul(Z_1, bct), p + 1, q)
+                    add(n1, mul(Z_1, scale(st, -1)), p, q + 1)
+                    Z_1 = mul(Z_1, scale(fac, kmax + 1 - k))
+                    if n5 < (ydeg + 1) ** 2:
+                        add(n5, mul(Z_5, bct), p + 1, q + 2)
+                        add(n5, mul(Z_5, scale(st, -1)), p, q + 3)
+                        Z_5 = mul(Z_5, scale(fac, kmax - k))
+                add(n1, mul(Z_1, bct), p + 2, q - 1)
+                add(n1, mul(Z_1, scale(st, -1)), p + 1, q)
+                Z2 = mul(Z2, scale(ttinvb, (jmax - j) / (j + 1)))
+            kmax += 1
+            Z1 = mul(Z1, scale(bst, -1))
+        jmax += 1
+        Z0 = mul(Z0, bct)
+
+    # Cases 3 and 4
+    Z0 = b32
+    kmax = 0
+    for l in range(2, ydeg + 1, 2):
+        n3 = l ** 2 + 2 * l - 1
+        n4 = (l + 1) ** 2 + 2 * l + 1
+        Z = Z0
+        for k in range(kmax + 1):
+            p = k
+            q = l + 1 - k
+            add(n3, mul(Z, scale(bst, -1)), p + 1, q)
+            add(n3, mul(Z, scale(ct, -1)), p, q + 1)
+            if l < ydeg:
+                add(n4, mul(Z, scale(bst, -1), st), p + 2, q)
+                add(n4, mul(Z, scale(bct, -1), ct), p, q + 2)
+                add(n4, mul(Z, scale(st, -1), ct), p + 1, q + 1)
+                add(n4, mul(Z, scale(b2, -1), st, ct), p + 1, q + 1)
+            Z = mul(Z, scale(invbtt, -(kmax - k) / (k + 1)))
+        kmax += 2
+        Z0 = mul(Z0, bst, bst)
+
+    # Index the terms
+    keys = np.array(list(terms.keys()), dtype=int).reshape(-1, 7)
+    coeffs = np.array(list(terms.values()))
+    exps, mon = np.unique(keys[:, 3:], axis=0, return_inverse=True)
+    hidx = keys[:, 1] * (ydeg + 3) + keys[:, 2]
+    S = csr_matrix(
+        (coeffs, (np.arange(len(coeffs)), keys[:, 0])),
+        shape=(len(coeffs), (ydeg + 1) ** 2),
+    )
+    table = exps, mon.reshape(-1), hidx, S
+    _T_TABLES[ydeg] = table
+    return table
+
+
+def _compute_T_general(ydeg, b, ct, st, xi, H):
+    """
+    Compute T in the general case (sin(theta) != 0 and cos(theta) != 0)
+    for arrays of `N` geometries at once by contracting the precomputed
+    table against H, which has shape `(N, ydeg + 3, ydeg + 3)`.
+
+    """
+    exps, mon, hidx, S = _T_table(ydeg)
+    H = H.reshape(len(H), (ydeg + 3) ** 2)
+
+    # Evaluate the monomials
+    b32 = (1 - b ** 2) ** 1.5
+    powers = np.arange(exps.max() + 1)
+    M = (
+        (b[:, None] ** powers)[:, exps[:, 0]]
+        * (ct[:, None] ** powers)[:, exps[:, 1]]
+        * (st[:, None] ** powers)[:, exps[:, 2]]
+        * (b32[:, None] ** powers)[:, exps[:, 3]]
+    )
+
+    # Contract
+    T = np.asarray((M[:, mon] * H[:, hidx]) @ S)
+
+    # Case 2 (special)
+    T[:, 2] = np.sign(b) * pairdiff(_compute_T2_indef(np.abs(b)[:, None], xi), axis=-1)
+
+    return T
+
+
+@timed
 def compute_T(ydeg, b, theta, xi):
+    """
+    Compute the T integral. If `b` and `theta` have shape `(N,)` and `xi`
+    has shape `(N, 2k)`, the integrals for all `N` geometries are
+    computed at once.
+
+    """
+    # Vars
+    ct = np.cos(theta)
+    st = np.sin(theta)
+
+    # Batched call: only the special limits need to be done one at a time
+    if np.ndim(xi) > 1:
+        special = (np.abs(st) < STARRY_T_TOL) | (np.abs(ct) < STARRY_T_TOL)
+        T = np.empty((len(xi), (ydeg + 1) ** 2))
+        for n in np.flatnonzero(special):
+            T[n] = compute_T(ydeg, b[n], theta[n], xi[n])
+        general = ~special
+        T[general] = _compute_T_general(
+            ydeg,
+            b[general],
+            ct[general],
+            st[general],
+            xi[general],
+            compute_H(ydeg + 2, xi[general]),
+        )
+        return T
 
     # Pre-compute H
     H = compute_H(ydeg + 2, xi)
 
+    # General case
+    if np.abs(st) >= STARRY_T_TOL and np.abs(ct) >= STARRY_T_TOL:
+        return _compute_T_general(
+            ydeg, np.array([b]), np.array([ct]), np.array([st]), np.array([xi]), H[None]
+        )[0]
+
     # Vars
-    ct = np.cos(theta)
-    st = np.sin(theta)
-    ttinvb = st / (b * ct)
-    invbtt = ct / (b * st)
     b32 = (1 - b ** 2) ** 1.5
-    bct = b * ct
-    bst = b * st
 
     # Recurse
     T = np.zeros((ydeg + 1) ** 2)
@@ -447,7 +727,7 @@ def compute_T(ydeg, b, theta, xi):
         return T
 
     # Special limit: cos(theta) = 0
-    elif np.abs(ct) < STARRY_T_TOL:
+    else:
 
         sgnst = np.sign(st)
         n = 0
@@ -485,55 +765,62 @@ def compute_T(ydeg, b, theta, xi):
 
         return T
 
-    # Cases 1 and 5
-    jmax = 0
-    Z0 = 1
-    for nu in range(0, 2 * ydeg + 1, 2):
-        kmax = 0
-        Z1 = Z0
-        for mu in range(0, 2 * ydeg - nu + 1, 2):
-            l = (mu + nu) // 2
-            n1 = l ** 2 + nu
-            n5 = (l + 2) ** 2 + nu + 1
-            Z2 = Z1
-            for j in range(jmax + 1):
-                Z_1 = -bst * Z2
-                Z_5 = b32 * Z2
-                for k in range(kmax + 1):
-                    p = j + k
-                    q = l + 1 - (j + k)
-                    fac = -invbtt / (k + 1)
-                    T[n1] += Z_1 * (bct * H[p + 1, q] - st * H[p, q + 1])
-                    Z_1 *= (kmax + 1 - k) * fac
-                    if n5 < (ydeg + 1) ** 2:
-                        T[n5] += Z_5 * (bct * H[p + 1, q + 2] - st * H[p, q + 3])
-                        Z_5 *= (kmax - k) * fac
-                T[n1] += Z_1 * (bct * H[p + 2, q - 1] - st * H[p + 1, q])
-                Z2 *= (jmax - j) / (j + 1) * ttinvb
-            kmax += 1
-            Z1 *= -bst
-        jmax += 1
-        Z0 *= bct
 
-    # Cases 3 and 4
-    Z0 = b32
-    kmax = 0
-    for l in range(2, ydeg + 1, 2):
-        n3 = l ** 2 + 2 * l - 1
-        n4 = (l + 1) ** 2 + 2 * l + 1
-        Z = Z0
-        for k in range(kmax + 1):
-            p = k
-            q = l + 1 - k
-            T[n3] -= Z * (bst * H[p + 1, q] + ct * H[p, q + 1])
-            if l < ydeg:
-                T[n4] -= Z * (
-                    bst * st * H[p + 2, q]
-                    + bct * ct * H[p, q + 2]
-                    + (1 + b ** 2) * st * ct * H[p + 1, q + 1]
-                )
-            Z *= -(kmax - k) / (k + 1) * invbtt
-        kmax += 2
-        Z0 *= bst ** 2
+def _arc_nodes(limits):
+    """
+    Return the nodes and weights of the tanh-sinh rule along each of the
+    arcs delimited by the pairs of `limits`.
 
-    return T
+    """
+    t1 = limits[::2, None]
+    t2 = limits[1::2, None]
+    t = (t1 + (t2 - t1) * GRAD_QUAD_X).flatten()
+    w = ((t2 - t1) * GRAD_QUAD_W).flatten()
+    return t, w
+
+
+@timed
+def compute_P_grad(ydeg, bo, ro, kappa):
+    """
+    Compute the derivatives of the P integral with respect to `bo` and `ro`,
+    excluding the terms due to the motion of the endpoints of the arcs.
+
+    By Green's theorem, the derivative of the integral over a region is
+    the integral of the Green's basis over its boundary, weighted by the
+    normal velocity of the boundary; the endpoint terms of adjacent arcs
+    cancel. Since the boundary integrals are not elementary, we compute
+    them numerically.
+
+    """
+    phi, w = _arc_nodes(np.array(kappa) - np.pi / 2)
+    c = np.cos(phi)
+    s = np.sin(phi)
+    x = ro * c
+    y = bo + ro * s
+    z = np.sqrt(np.maximum(0, 1 - x ** 2 - y ** 2))
+    g = green_basis(ydeg, x, y, z)
+    dPdbo = ro * (w * s) @ g
+    dPdro = ro * w @ g
+    return dPdbo, dPdro
+
+
+@timed
+def compute_T_grad(ydeg, b, theta, xi):
+    """
+    Compute the derivatives of the T integral with respect to `b` and
+    `theta`, excluding the terms due to the motion of the endpoints of the
+    arcs. See `compute_P_grad` for details.
+
+    """
+    xi, w = _arc_nodes(np.array(xi))
+    c = np.cos(xi)
+    s = np.sin(xi)
+    ct = np.cos(theta)
+    st = np.sin(theta)
+    x = ct * c - b * st * s
+    y = st * c + b * ct * s
+    z = np.sqrt(np.maximum(0, 1 - x ** 2 - y ** 2))
+    g = green_basis(ydeg, x, y, z)
+    dTdb = (w * s ** 2) @ g
+    dTdtheta = (1 - b ** 2) * (w * s * c) @ g
+    return dTdb, dTdtheta
@@ -1,6 +1,5 @@
 from utils import *
-from mpmath import ellipe, ellipk, ellippi
-from scipy.integrate import quad
+from timing import timed
 import numpy as np
 
 
@@ -10,86 +9,163 @@ C3 = 3.0 / 22.0
 C4 = 3.0 / 26.0
 
 
+def tanh_sinh(h, n):
+    """Return the nodes and weights of the tanh-sinh rule on [0, 1]."""
+    t = h * np.arange(-n, n + 1)
+    s = 0.5 * np.pi * np.sinh(t)
+    x = 1.0 / (1.0 + np.exp(-2 * s))
+    w = 0.25 * np.pi * h * np.cosh(t) / np.cosh(s) ** 2
+    return x, w
+
+
+J_QUAD_X, J_QUAD_W = tanh_sinh(STARRY_J_QUAD_STEP, STARRY_J_QUAD_HALF_NODES)
+PAL_QUAD_X, PAL_QUAD_W = tanh_sinh(STARRY_PAL_QUAD_STEP, STARRY_PAL_QUAD_HALF_NODES)
+
+
+def _J_indef(N, k2, x, p=1.5):
+    """
+    Return the integral of
+
+        sin^(2N)(y) (1 - sin^2(y) / k2)^p
+
+    from 0 to `x`, where the integrand is zero wherever the term in
+    parentheses is negative. The integrand is even and has period pi, so
+    we only ever integrate over a subset of [0, pi / 2]. The upper limit
+    of each of those integrals is the point where the integrand is least
+    smooth (either pi / 2 or the point where it vanishes), which is where
+    the tanh-sinh nodes cluster. Inputs are broadcast against each other.
+
+    """
+    # The integrand vanishes beyond `ymax` in [0, pi / 2]
+    k2 = np.asarray(k2)
+    ymax = np.arcsin(np.sqrt(np.minimum(1.0, k2)))
+
+    def integral(y):
+        y = np.minimum(y, ymax)[..., None]
+        s2 = np.sin(y * J_QUAD_X) ** 2
+        f = s2 ** N * np.maximum(0.0, 1 - s2 / k2[..., None]) ** p
+        return y[..., 0] * np.dot(f, J_QUAD_W)
+
+    # Reduce to [0, pi / 2] using the symmetries of the integrand
+    n = np.floor(x / np.pi)
+    r = x - n * np.pi
+    upper = r > 0.5 * np.pi
+    half = integral(0.5 * np.pi)
+    res = integral(np.where(upper, np.pi - r, r))
+    return np.where(upper, 2 * (n + 1) * half - res, 2 * n * half + res)
+
+
+@timed
 def J(N, k2, kappa, gradient=False):
-    # We'll need to solve this with gaussian quadrature
-    func = (
-        lambda x: np.sin(x) ** (2 * N) * (np.maximum(0, 1 - np.sin(x) ** 2 / k2)) ** 1.5
-    )
-    res = 0.0
-    for i in range(0, len(kappa), 2):
-        res += quad(
-            func, 0.5 * kappa[i], 0.5 * kappa[i + 1], epsabs=1e-12, epsrel=1e-12,
-        )[0]
+    """
+    Return the integral of
+
+        sin^(2N)(x) (1 - sin^2(x) / k2)^(3/2)
+
+    summed over the pairs of limits `0.5 * kappa`. This is computed with
+    a fixed tanh-sinh rule, so `k2` may also be an array of shape `(n,)`
+    and `kappa` an array of shape `(n, 2m)`, in which case the integrals
+    for all `n` geometries are returned at once.
+
+    """
+    x = 0.5 * np.asarray(kappa)
+    k2_ = np.expand_dims(k2, -1)
+    F = _J_indef(N, k2_, x)
+    res = np.sum(F[..., 1::2] - F[..., ::2], axis=-1)
     if gradient:
         # Deriv w/ respect to kappa is analytic
+        s2 = np.sin(x) ** 2
         dJdkappa = (
             0.5
-            * (
-                np.sin(0.5 * kappa) ** (2 * N)
-                * (np.maximum(0, 1 - np.sin(0.5 * kappa) ** 2 / k2)) ** 1.5
-            )
-            * np.repeat([-1, 1], len(kappa) // 2).reshape(1, -1)
+            * s2 ** N
+            * np.maximum(0, 1 - s2 / k2_) ** 1.5
+            * np.tile([-1, 1], np.shape(kappa)[-1] // 2)
         )
+        if np.ndim(kappa) == 1:
+            dJdkappa = dJdkappa.reshape(1, -1)
 
         # Deriv w/ respect to k2 is tricky, need to integrate
-        func = (
-            lambda x: (1.5 / k2 ** 2)
-            * np.sin(x) ** (2 * N + 2)
-            * (np.maximum(0, 1 - np.sin(x) ** 2 / k2)) ** 0.5
-        )
-        dJdk2 = 0.0
-        for i in range(0, len(kappa), 2):
-            dJdk2 += quad(
-                func, 0.5 * kappa[i], 0.5 * kappa[i + 1], epsabs=1e-12, epsrel=1e-12,
-            )[0]
+        F = (1.5 / k2_ ** 2) * _J_indef(N + 1, k2_, x, p=0.5)
+        dJdk2 = np.sum(F[..., 1::2] - F[..., ::2], axis=-1)
 
         return res, (dJdk2, dJdkappa)
     else:
         return res
 
 
+def _pal_nodes(bo, ro, kappa):
+    """
+    Return the nodes and weights of the quadrature rule for the Pal
+    integral along each of the pairs of `kappa`. Each arc is split at the
+    points where the occultor crosses the limb and at multiples of pi,
+    where it can be tangent to it, so that the (near-)singular points of
+    the integrand are at the endpoints of the intervals, where the
+    tanh-sinh nodes cluster.
+
+    """
+    # The points where the integrand has a kink, modulo 2 pi
+    breaks = [0.0, np.pi]
+    if bo > 0 and ro > 0:
+        cosphi = (1 - ro ** 2 - bo ** 2) / (2 * bo * ro)
+        if np.abs(cosphi) < 1:
+            phil = np.arccos(cosphi)
+            breaks += [phil, 2 * np.pi - phil]
+    breaks = np.array(breaks)
+
+    a = []
+    b = []
+    sgn = []
+    for phi1, phi2 in np.reshape(kappa, (-1, 2)) - np.pi:
+        lo, hi = min(phi1, phi2), max(phi1, phi2)
+        n = np.arange(np.floor(lo / (2 * np.pi)), np.ceil(hi / (2 * np.pi)) + 1)
+        m = (2 * np.pi * n[:, None] + breaks[None, :]).flatten()
+        edges = np.concatenate(([lo], np.sort(m[(m > lo) & (m < hi)]), [hi]))
+        a.extend(edges[:-1])
+        b.extend(edges[1:])
+        sgn.extend([np.sign(phi2 - phi1)] * (len(edges) - 1))
+    a = np.array(a)[:, None]
+    b = np.array(b)[:, None]
+    sgn = np.array(sgn)[:, None]
+    phi = a + (b - a) * PAL_QUAD_X
+    w = sgn * (b - a) * PAL_QUAD_W
+    return phi.flatten(), w.flatten()
+
+
+@timed
 def pal(bo, ro, kappa, gradient=False):
+    """
+    Compute the linear term of the `P` integral (summed over the pairs of
+    `kappa`) numerically. This is used close to the singular points of the
+    analytic solution, `bo = ro`, `bo = ro - 1` and `bo = 1 - ro`.
 
-    # TODO
-    if len(kappa) != 2:
-        raise NotImplementedError("TODO!")
+    The integrand is evaluated on a fixed tanh-sinh grid along each arc,
+    which is accurate to close to machine precision even where the
+    integrand has a square root singularity (at the limb).
 
-    def func(phi):
-        c = np.cos(phi)
-        z = np.minimum(
-            1 - 1e-12, np.maximum(1e-12, 1 - ro ** 2 - bo ** 2 - 2 * bo * ro * c)
-        )
-        return (1.0 - z ** 1.5) / (1.0 - z) * (ro + bo * c) * ro / 3.0
+    """
+    phi, w = _pal_nodes(bo, ro, kappa)
+    c = np.cos(phi)
 
-    res, _ = quad(func, kappa[0] - np.pi, kappa[1] - np.pi, epsabs=1e-12, epsrel=1e-12,)
+    # NOTE: This is (1 - z^3) / (1 - z^2), written so it's stable for z -> 1
+    z2 = np.maximum(0, 1 - ro ** 2 - bo ** 2 - 2 * bo * ro * c)
+    z = np.sqrt(z2)
+    g = (1.0 + z + z2) / (1.0 + z)
+    h = (ro + bo * c) * ro / 3.0
+    res = np.dot(w, g * h)
 
     if gradient:
         # Deriv w/ respect to kappa is analytic
-        dpaldkappa = func(kappa - np.pi) * np.repeat([-1, 1], len(kappa) // 2).reshape(
-            1, -1
-        )
-
-        # Derivs w/ respect to b and r are tricky, need to integrate
-        def func_bo(phi):
-            c = np.cos(phi)
-            z = np.maximum(1e-12, 1 - ro ** 2 - bo ** 2 - 2 * bo * ro * c)
-            P = (1.0 - z ** 1.5) / (1.0 - z) * (ro + bo * c) * ro / 3.0
-            q = 3.0 * z ** 0.5 / (1.0 - z ** 1.5) - 2.0 / (1.0 - z)
-            return P * ((bo + ro * c) * q + 1.0 / (bo + ro / c))
-
-        dpaldbo, _ = quad(
-            func_bo, kappa[0] - np.pi, kappa[1] - np.pi, epsabs=1e-12, epsrel=1e-12,
-        )
-
-        def func_ro(phi):
-            c = np.cos(phi)
-            z = np.maximum(1e-12, 1 - ro ** 2 - bo ** 2 - 2 * bo * ro * c)
-            P = (1.0 - z ** 1.5) / (1.0 - z) * (ro + bo * c) * ro / 3.0
-            q = 3.0 * z ** 0.5 / (1.0 - z ** 1.5) - 2.0 / (1.0 - z)
-            return P * ((ro + bo * c) * q + 1.0 / ro + 1.0 / (ro + bo * c))
-
-        dpaldro, _ = quad(
-            func_ro, kappa[0] - np.pi, kappa[1] - np.pi, epsabs=1e-12, epsrel=1e-12,
+        ck = np.cos(kappa - np.pi)
+        zk2 = np.maximum(0, 1 - ro ** 2 - bo ** 2 - 2 * bo * ro * ck)
+        zk = np.sqrt(zk2)
+        func = (1.0 + zk + zk2) / (1.0 + zk) * (ro + bo * ck) * ro / 3.0
+        dpaldkappa = func * np.tile([-1, 1], len(kappa) // 2).reshape(1, -1)
+
+        # Derivs w/ respect to b and r are integrated on the same grid
+        dgdz2 = np.where(z2 > 0, (2.0 + z) / (2.0 * (1.0 + z) ** 2), 0.0)
+        dpaldbo = np.dot(w, dgdz2 * (-2 * bo - 2 * ro * c) * h + g * c * ro / 3.0)
+        dpaldro = np.dot(
+            w, dgdz2 * (-2 * ro - 2 * bo * c) * h + g * (2 * ro + bo * c) / 3.0
         )
 
         return res, (dpaldbo, dpaldro, dpaldkappa)
@@ -100,20 +176,43 @@ def pal(bo, ro, kappa, gradient=False):
 
 
 def hyp2f1(a, b, c, z, gradient=False):
+    """
+    Compute the hypergeometric function 2F1(a, b; c; z) from its series
+    expansion. The argument `z` may be an array, in which case the series
+    is summed for all elements at once, `STARRY_2F1_BLOCK` terms at a time,
+    and each element is frozen as soon as it has converged.
+
+    """
+    z = np.array(z, dtype=float)
+    shape = z.shape
+    z = z.reshape(-1)
     term = a * b * z / c
     value = 1.0 + term
+
+    # Indices of the elements that haven't converged yet
+    k = np.flatnonzero(np.abs(term) > STARRY_2F1_TOL)
+
     n = 1
-    while (np.abs(term) > STARRY_2F1_TOL) and (n < STARRY_2F1_MAXITER):
-        a += 1
-        b += 1
-        c += 1
-        n += 1
-        term *= a * b * z / c / n
-        value += term
-    if n == STARRY_2F1_MAXITER:
+    while len(k) and (n < STARRY_2F1_MAXITER):
+
+        # The next few terms are cumulative products of the ratios
+        m = np.arange(n, n + STARRY_2F1_BLOCK)
+        ratio = (a + m) * (b + m) / ((c + m) * (m + 1))
+        terms = term[k] * np.cumprod(ratio[:, None] * z[k], axis=0)
+
+        # Only add terms up to (and including) the first small one
+        small = np.abs(terms) <= STARRY_2F1_TOL
+        keep = np.cumsum(small, axis=0) - small == 0
+        value[k] += np.sum(terms * keep, axis=0)
+        term[k] = terms[-1]
+        k = k[~np.any(small, axis=0)]
+        n += STARRY_2F1_BLOCK
+
+    if len(k):
         raise ValueError("Series for 2F1 did not converge.")
+    value = value.reshape(shape)[()]
     if gradient:
-        dFdz = a * b / c * hyp2f1(a + 1, b + 1, c + 1, z)
+        dFdz = a * b / c * hyp2f1(a + 1, b + 1, c + 1, z.reshape(shape))
         return value, dFdz
     else:
         return value
@@ -122,12 +221,17 @@ def hyp2f1(a, b, c, z, gradient=False):
 def el2(x, kc, a, b):
     """
     Vectorized implementation of the `el2` function from
-    Bulirsch (1965). In this case, `x` is a *vector* of integration
-    limits. The halting condition does not depend on the value of `x`,
-    so it's much faster to evaluate all values of `x` at once!
+    Bulirsch (1965). The integration limits `x` and the parameters
+    `kc`, `a`, and `b` may all be arrays, which are broadcast against
+    each other. The Landen iteration is carried out for all elements
+    at once, and each element is frozen as soon as it has converged,
+    so a whole batch of geometries can be evaluated in one pass.
     
     """
-    if kc == 0:
+    x, kc, a, b = np.broadcast_arrays(x, kc, a, b)
+    shape = x.shape
+    x, kc, a, b = [np.array(arg, dtype=float).reshape(-1) for arg in (x, kc, a, b)]
+    if np.any(kc == 0):
         raise ValueError("Elliptic integral diverged because k = 1.")
 
     c = x * x
@@ -138,51 +242,141 @@ def el2(x, kc, a, b):
     z = a - b
     i = a
     a = (b + a) / 2
-    y = np.abs(1 / x)
-    f = 0
+    with np.errstate(divide="ignore"):
+        y = np.abs(1 / x)
+    f = np.zeros_like(x)
     l = np.zeros_like(x)
-    m = 1
+    m = np.ones_like(x)
     kc = np.abs(kc)
 
+    # Indices of the elements that haven't converged yet
+    k = np.arange(len(x))
+
     for n in range(STARRY_EL2_MAX_ITER):
 
-        b = i * kc + b
-        e = m * kc
-        g = e / p
-        d = f * g + d
-        f = c
-        i = a
-        p = g + p
-        c = (d / p + c) / 2
-        g = m
-        m = kc + m
-        a = (b / m + a) / 2
-        y = -e / y + y
+        b[k] = i[k] * kc[k] + b[k]
+        e = m[k] * kc[k]
+        g = e / p[k]
+        d[k] = f[k] * g + d[k]
+        f[k] = c[k]
+        i[k] = a[k]
+        p[k] = g + p[k]
+        c[k] = (d[k] / p[k] + c[k]) / 2
+        g = m[k]
+        m[k] = kc[k] + m[k]
+        a[k] = (b[k] / m[k] + a[k]) / 2
+        y[k] = -e / y[k] + y[k]
+
+        zero = y[k] == 0
+        y[k[zero]] = np.sqrt(e[zero]) * c[k[zero]] * b[k[zero]]
+
+        unconverged = np.abs(g - kc[k]) > STARRY_EL2_CA * g
+        e = e[unconverged]
+        k = k[unconverged]
+        kc[k] = np.sqrt(e) * 2
+        l[k] = l[k] * 2
+        l[k[y[k] < 0]] += 1
+
+        if len(k) == 0:
+            break
 
-        y[y == 0] = np.sqrt(e) * c[y == 0] * b
+    if len(k):
+        raise ValueError(
+            "Elliptic integral EL2 failed to converge after {} iterations.".format(
+                STARRY_EL2_MAX_ITER
+            )
+        )
+
+    l[y < 0] = 1 + l[y < 0]
+    e = (np.arctan(m / y) + np.pi * l) * a / m
+    e[x < 0] = -e[x < 0]
+
+    return (e + c * z).reshape(shape)
+
+
+def cel(kc, p, a, b):
+    """
+    Vectorized implementation of the `cel` function from
+    Bulirsch (1969), the general complete elliptic integral
 
-        if np.abs(g - kc) > STARRY_EL2_CA * g:
+        int_0^(pi/2) (a cos^2 + b sin^2) / ((cos^2 + p sin^2) sqrt(cos^2 + kc^2 sin^2))
 
-            kc = np.sqrt(e) * 2
-            l = l * 2
-            l[y < 0] = 1 + l[y < 0]
+    The arguments may be arrays, which are broadcast against each other.
+    In particular,
 
-        else:
+        K(m) = cel(kc, 1, 1, 1)
+        E(m) = cel(kc, 1, 1, kc^2)
+        PI(n, m) = cel(kc, 1 - n, 1, 1)
 
+    where kc = sqrt(1 - m).
+
+    """
+    if np.any(kc == 0):
+        raise ValueError("Elliptic integral diverged because k = 1.")
+
+    qc = np.abs(kc)
+    e = qc
+    m = 1.0
+
+    # Transform to a positive `p`
+    if np.all(p > 0):
+        p = np.sqrt(p)
+        b = b / p
+    else:
+        with np.errstate(invalid="ignore"):
+            f = qc * qc
+            g = 1 - p
+            q = (1 - f) * (b - a * p)
+            pneg = np.sqrt((f - p) / g)
+            aneg = (a - b) / g
+            bneg = -q / (g * g * pneg) + aneg * pneg
+            ppos = np.sqrt(p)
+        pos = p > 0
+        a = np.where(pos, a, aneg)
+        b = np.where(pos, b / ppos, bneg)
+        p = np.where(pos, ppos, pneg)
+
+    # Elements that have already converged are simply carried along,
+    # since each step leaves the value of the integral unchanged
+    for n in range(STARRY_EL2_MAX_ITER):
+
+        f = a
+        a = a + b / p
+        g = e / p
+        b = 2 * (b + f * g)
+        p = g + p
+        g = m
+        m = qc + m
+
+        if np.all(np.abs(g - qc) <= STARRY_EL2_CA * g):
             break
 
-    if n == STARRY_EL2_MAX_ITER - 1:
+        qc = 2 * np.sqrt(e)
+        e = qc * m
+
+    else:
         raise ValueError(
-            "Elliptic integral EL2 failed to converge after {} iterations.".format(
+            "Elliptic integral CEL failed to converge after {} iterations.".format(
                 STARRY_EL2_MAX_ITER
             )
         )
 
-    l[y < 0] = 1 + l[y < 0]
-    e = (np.arctan(m / y) + np.pi * l) * a / m
-    e[x < 0] = -e[x < 0]
+    return 0.5 * np.pi * (b + a * m) / (m * (m + p))
 
-    return e + c * z
+
+def cel_mpmath(kc, p, a, b):
+    """
+    Reference implementation of `cel` using arbitrary-precision
+    quadrature, for validation only. Requires `mpmath`.
+
+    """
+    import mpmath
+
+    func = lambda x: (a * mpmath.cos(x) ** 2 + b * mpmath.sin(x) ** 2) / (
+        (mpmath.cos(x) ** 2 + p * mpmath.sin(x) ** 2)
+        * mpmath.sqrt(mpmath.cos(x) ** 2 + kc ** 2 * mpmath.sin(x) ** 2)
+    )
+    return float(mpmath.quad(func, [0, 0.5 * mpmath.pi]))
 
 
 def EllipF(tanphi, k2, gradient=False):
@@ -235,36 +429,30 @@ def rj(x, y, z, p):
     
     https://people.sc.fsu.edu/~jburkardt/f77_src/toms577/toms577.f
 
+    The arguments may be arrays, which are broadcast against each other.
+    The duplication is carried out for all elements at once, and each
+    element is frozen as soon as it has converged.
+
     """
     # Limit checks
-    if x < STARRY_CRJ_LO_LIM:
-        x = STARRY_CRJ_LO_LIM
-    elif x > STARRY_CRJ_HI_LIM:
-        x = STARRY_CRJ_HI_LIM
-
-    if y < STARRY_CRJ_LO_LIM:
-        y = STARRY_CRJ_LO_LIM
-    elif y > STARRY_CRJ_HI_LIM:
-        y = STARRY_CRJ_HI_LIM
-
-    if z < STARRY_CRJ_LO_LIM:
-        z = STARRY_CRJ_LO_LIM
-    elif z > STARRY_CRJ_HI_LIM:
-        z = STARRY_CRJ_HI_LIM
-
-    if p < STARRY_CRJ_LO_LIM:
-        p = STARRY_CRJ_LO_LIM
-    elif p > STARRY_CRJ_HI_LIM:
-        p = STARRY_CRJ_HI_LIM
-
-    xn = x
-    yn = y
-    zn = z
-    pn = p
-    sigma = 0.0
-    power4 = 1.0
-
-    for k in range(STARRY_CRJ_MAX_ITER):
+    x, y, z, p = np.broadcast_arrays(x, y, z, p)
+    shape = x.shape
+    xn, yn, zn, pn = [
+        np.clip(
+            np.array(arg, dtype=float).reshape(-1),
+            STARRY_CRJ_LO_LIM,
+            STARRY_CRJ_HI_LIM,
+        )
+        for arg in (x, y, z, p)
+    ]
+    sigma = np.zeros_like(xn)
+    power4 = np.ones_like(xn)
+    value = np.empty_like(xn)
+
+    # Indices of the elements that haven't converged yet
+    k = np.arange(len(xn))
+
+    for n in range(STARRY_CRJ_MAX_ITER):
 
         mu = 0.2 * (xn + yn + zn + pn + pn)
         invmu = 1.0 / mu
@@ -272,10 +460,16 @@ def rj(x, y, z, p):
         yndev = (mu - yn) * invmu
         zndev = (mu - zn) * invmu
         pndev = (mu - pn) * invmu
-        eps = np.max([np.abs(xndev), np.abs(yndev), np.abs(zndev), np.abs(pndev)])
+        eps = np.max(np.abs([xndev, yndev, zndev, pndev]), axis=0, initial=0.0)
+        converged = eps < STARRY_CRJ_TOL
 
-        if eps < STARRY_CRJ_TOL:
+        if np.any(converged):
 
+            xndev = xndev[converged]
+            yndev = yndev[converged]
+            zndev = zndev[converged]
+            pndev = pndev[converged]
+            mu = mu[converged]
             ea = xndev * (yndev + zndev) + yndev * zndev
             eb = xndev * yndev * zndev
             ec = pndev * pndev
@@ -284,8 +478,21 @@ def rj(x, y, z, p):
             s1 = 1.0 + e2 * (-C1 + 0.75 * C3 * e2 - 1.5 * C4 * e3)
             s2 = eb * (0.5 * C2 + pndev * (-C3 - C3 + pndev * C4))
             s3 = pndev * ea * (C2 - pndev * C3) - C2 * pndev * ec
-            value = 3.0 * sigma + power4 * (s1 + s2 + s3) / (mu * np.sqrt(mu))
-            return value
+            value[k[converged]] = 3.0 * sigma[converged] + power4[converged] * (
+                s1 + s2 + s3
+            ) / (mu * np.sqrt(mu))
+
+            # Drop the converged elements
+            k = k[~converged]
+            xn = xn[~converged]
+            yn = yn[~converged]
+            zn = zn[~converged]
+            pn = pn[~converged]
+            sigma = sigma[~converged]
+            power4 = power4[~converged]
+
+        if len(k) == 0:
+            return value.reshape(shape)[()]
 
         xnroot = np.sqrt(xn)
         ynroot = np.sqrt(yn)
@@ -294,12 +501,20 @@ def rj(x, y, z, p):
         alpha = pn * (xnroot + ynroot + znroot) + xnroot * ynroot * znroot
         alpha = alpha * alpha
         beta = pn * (pn + lam) * (pn + lam)
-        if alpha < beta:
-            sigma += power4 * np.arccos(np.sqrt(alpha / beta)) / np.sqrt(beta - alpha)
-        elif alpha > beta:
-            sigma += power4 * np.arccosh(np.sqrt(alpha / beta)) / np.sqrt(alpha - beta)
-        else:
-            sigma = sigma + power4 / np.sqrt(beta)
+        lt = alpha < beta
+        gt = alpha > beta
+        eq = ~(lt | gt)
+        sigma[lt] += (
+            power4[lt]
+            * np.arccos(np.sqrt(alpha[lt] / beta[lt]))
+            / np.sqrt(beta[lt] - alpha[lt])
+        )
+        sigma[gt] += (
+            power4[gt]
+            * np.arccosh(np.sqrt(alpha[gt] / beta[gt]))
+            / np.sqrt(alpha[gt] - beta[gt])
+        )
+        sigma[eq] += power4[eq] / np.sqrt(beta[eq])
 
         power4 *= 0.25
         xn = 0.25 * (xn + lam)
@@ -307,12 +522,11 @@ def rj(x, y, z, p):
         zn = 0.25 * (zn + lam)
         pn = 0.25 * (pn + lam)
 
-    if k == STARRY_CRJ_MAX_ITER - 1:
-        raise ValueError(
-            "Elliptic integral RJ failed to converge after {} iterations.".format(
-                STARRY_CRJ_MAX_ITER
-            )
+    raise ValueError(
+        "Elliptic integral RJ failed to converge after {} iterations.".format(
+            STARRY_CRJ_MAX_ITER
         )
+    )
 
 
 def EllipJ(kappa, k2, p):
@@ -320,108 +534,140 @@ def EllipJ(kappa, k2, p):
     cx = np.cos(phi / 2)
     sx = np.sin(phi / 2)
     w = 1 - cx ** 2 / k2
-    J = np.zeros_like(phi)
-    for i in range(len(w)):
-        J[i] = (np.cos(phi[i]) + 1) * cx[i] * rj(w[i], sx[i] * sx[i], 1.0, p[i])
-    return J
+    w = np.where(np.abs(w) < STARRY_KAPPA_LIMB_TOL, 0.0, w)
+    return (np.cos(phi) + 1) * cx * rj(w, sx * sx, 1.0, p)
+
+
+def _rows(mask):
+    """
+    Return an index into the rows selected by the boolean `mask` (a slice,
+    so indexing returns a view, if they are all selected), or None if
+    there are none.
+
+    """
+    if mask.all():
+        return slice(None)
+    elif mask.any():
+        return mask
+    else:
+        return None
 
 
+@timed
 def ellip(bo, ro, kappa):
+    """
+    Return the definite elliptic integrals F, E and PIprime over the
+    pairs of limits `kappa`. If `bo` and `ro` have shape `(N,)` and `kappa`
+    has shape `(N, 2k)`, the integrals for all `N` geometries are computed
+    at once and each has shape `(N,)`.
+
+    """
+    batch = np.ndim(kappa) > 1
+    bo = np.atleast_1d(np.array(bo, dtype=float))
+    ro = np.atleast_1d(np.array(ro, dtype=float))
+    kappa = np.atleast_2d(kappa)
 
     # Helper variables
     k2 = (1 - ro ** 2 - bo ** 2 + 2 * bo * ro) / (4 * bo * ro)
-    if np.abs(1 - k2) < STARRY_K2_ONE_TOL:
-        if k2 == 1.0:
-            k2 = 1 + STARRY_K2_ONE_TOL
-        elif k2 < 1.0:
-            k2 = 1.0 - STARRY_K2_ONE_TOL
-        else:
-            k2 = 1.0 + STARRY_K2_ONE_TOL
+    k2 = np.where(
+        np.abs(1 - k2) < STARRY_K2_ONE_TOL,
+        np.where(k2 < 1.0, 1.0 - STARRY_K2_ONE_TOL, 1.0 + STARRY_K2_ONE_TOL),
+        k2,
+    )
     k = np.sqrt(k2)
     k2inv = 1 / k2
     kinv = np.sqrt(k2inv)
     kc2 = 1 - k2
+    F = np.empty_like(kappa)
+    E = np.empty_like(kappa)
+    RJ0 = np.zeros_like(bo)
 
-    # Complete elliptic integrals (we'll need them to compute offsets below)
-    if k2 < 1:
-        K0 = float(ellipk(k2))
-        E0 = float(ellipe(k2))
-        E0 = np.sqrt(k2inv) * (E0 - (1 - k2) * K0)
-        K0 *= np.sqrt(k2)
-        RJ0 = 0.0
-    else:
-        K0 = float(ellipk(k2inv))
-        E0 = float(ellipe(k2inv))
-        if (bo != 0) and (bo != ro):
-            p0 = (ro * ro + bo * bo + 2 * ro * bo) / (ro * ro + bo * bo - 2 * ro * bo)
-            PI0 = float(ellippi(1 - p0, k2inv))
-            RJ0 = -12.0 / (1 - p0) * (PI0 - K0)
-        else:
-            RJ0 = 0.0
+    i = _rows(k2 < 1)
+    if i is not None:
+
+        # Geometries with k^2 < 1
+        k2_, k_, kinv_, kc2_ = [x[i, None] for x in (k2, k, kinv, kc2)]
+        kappa_ = kappa[i]
 
-    if k2 < 1:
+        # Complete elliptic integrals (we'll need them to compute offsets below)
+        kc = np.sqrt(kc2_)
+        K0 = cel(kc, 1.0, 1.0, 1.0)
+        E0 = cel(kc, 1.0, 1.0, kc2_)
+        E0 = kinv_ * (E0 - kc2_ * K0)
+        K0 *= k_
 
         # Analytic continuation from (17.4.15-16) in Abramowitz & Stegun
         # A better format is here: https://dlmf.nist.gov/19.7#ii
 
         # Helper variables
-        arg = kinv * np.sin(kappa / 2)
-        tanphi = arg / np.sqrt(1 - arg ** 2)
+        arg = kinv_ * np.sin(kappa_ / 2)
+        limb = np.abs(np.abs(arg) - 1) < STARRY_KAPPA_LIMB_TOL
+        arg = np.where(limb, np.sign(arg), arg)
+        with np.errstate(divide="ignore"):
+            tanphi = arg / np.sqrt(1 - arg ** 2)
         tanphi[arg >= 1] = STARRY_HUGE_TAN
         tanphi[arg <= -1] = -STARRY_HUGE_TAN
 
         # Compute the elliptic integrals
-        F = EllipF(tanphi, k2) * k
-        E = kinv * (EllipE(tanphi, k2) - kc2 * kinv * F)
+        F_ = EllipF(tanphi, k2_) * k_
+        E_ = kinv_ * (EllipE(tanphi, k2_) - kc2_ * kinv_ * F_)
 
         # Add offsets to account for the limited domain of `el2`
-        for i in range(len(kappa)):
-            if kappa[i] > 3 * np.pi:
-                F[i] += 4 * K0
-                E[i] += 4 * E0
-            elif kappa[i] > np.pi:
-                F[i] = 2 * K0 - F[i]
-                E[i] = 2 * E0 - E[i]
-
-    else:
+        far = kappa_ > 3 * np.pi
+        near = ~far & (kappa_ > np.pi)
+        F[i] = np.where(far, F_ + 4 * K0, np.where(near, 2 * K0 - F_, F_))
+        E[i] = np.where(far, E_ + 4 * E0, np.where(near, 2 * E0 - E_, E_))
+
+    i = _rows(k2 >= 1)
+    if i is not None:
+
+        # Geometries with k^2 >= 1
+        bo_, ro_, k2inv_ = bo[i], ro[i], k2inv[i, None]
+        kappa_ = kappa[i]
+
+        # Complete elliptic integrals (we'll need them to compute offsets below)
+        kc = np.sqrt(1 - k2inv_)
+        K0 = cel(kc, 1.0, 1.0, 1.0)
+        E0 = cel(kc, 1.0, 1.0, 1 - k2inv_)
+        j = _rows((bo_ != 0) & (bo_ != ro_))
+        if j is not None:
+            b, r = bo_[j], ro_[j]
+            p0 = (r * r + b * b + 2 * r * b) / (r * r + b * b - 2 * r * b)
+            RJ0_ = np.zeros_like(bo_)
+            RJ0_[j] = -12.0 * cel(kc[j, 0], p0, 0.0, 1.0)
+            RJ0[i] = RJ0_
 
         # Helper variables
-        tanphi = np.tan(kappa / 2)
+        tanphi = np.tan(kappa_ / 2)
 
         # Compute the elliptic integrals
-        F = EllipF(tanphi, k2inv)  # el2(tanphi, kcinv, 1, 1)
-        E = EllipE(tanphi, k2inv)  # el2(tanphi, kcinv, 1, kc2inv)
+        F_ = EllipF(tanphi, k2inv_)  # el2(tanphi, kcinv, 1, 1)
+        E_ = EllipE(tanphi, k2inv_)  # el2(tanphi, kcinv, 1, kc2inv)
 
         # Add offsets to account for the limited domain of `el2`
-        for i in range(len(kappa)):
-            if kappa[i] > 3 * np.pi:
-                F[i] += 4 * K0
-                E[i] += 4 * E0
-            elif kappa[i] > np.pi:
-                F[i] += 2 * K0
-                E[i] += 2 * E0
+        offset = np.where(kappa_ > 3 * np.pi, 4, np.where(kappa_ > np.pi, 2, 0))
+        F[i] = F_ + offset * K0
+        E[i] = E_ + offset * E0
 
     # Must compute RJ separately
-    if np.abs(bo - ro) > STARRY_PAL_BO_EQUALS_RO_TOL:
-        p = (ro * ro + bo * bo - 2 * ro * bo * np.cos(kappa)) / (
-            ro * ro + bo * bo - 2 * ro * bo
-        )
-        RJ = EllipJ(kappa, k2, p)
+    RJ = np.zeros_like(kappa)
+    i = _rows(np.abs(bo - ro) > STARRY_PAL_BO_EQUALS_RO_TOL)
+    if i is not None:
+        b, r, kappa_ = bo[i, None], ro[i, None], kappa[i]
+        p = (r * r + b * b - 2 * r * b * np.cos(kappa_)) / (r * r + b * b - 2 * r * b)
+        RJ_ = EllipJ(kappa_, k2[i, None], p)
 
         # Add offsets to account for the limited domain of `rj`
-        if RJ0 != 0.0:
-            for i in range(len(kappa)):
-                if kappa[i] > 3 * np.pi:
-                    RJ[i] += 2 * RJ0
-                elif kappa[i] > np.pi:
-                    RJ[i] += RJ0
-
-    else:
-        RJ = np.zeros_like(kappa)
+        RJ_ += (kappa_ > np.pi) * RJ0[i, None]
+        RJ_ += (kappa_ > 3 * np.pi) * RJ0[i, None]
+        RJ[i] = RJ_
 
     # Compute the *definite* elliptic integrals
-    F = pairdiff(F)
-    E = pairdiff(E)
-    PIprime = pairdiff(RJ)
+    F = pairdiff(F, axis=-1)
+    E = pairdiff(E, axis=-1)
+    PIprime = pairdiff(RJ, axis=-1)
 
-    return F, E, PIprime
+    if batch:
+        return F, E, PIprime
+    else:
+        return F[0], E[0], PIprime[0]
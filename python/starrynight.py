@@ -1,115 +1,205 @@
 from utils import *
-from geometry import get_angles
+from geometry import get_angles, get_angles_batch
 from primitive import compute_P, compute_T, compute_Q
-import starry
-from starry._c_ops import Ops
-from starry._core.ops.rotation import dotROp
-from scipy.integrate import quad
-from scipy.special import binom
-import theano
+from primitive import compute_P_grad, compute_T_grad
+from basis import get_basis, get_illum_basis
+from cache import LRUCache
+import timing
 import numpy as np
 
 __all__ = ["StarryNight"]
 
 
+# Coefficients of the terms (Xs, Xd, Xn, X) in the design
+# matrix for each of the integration codes. This mirrors the
+# branches in `StarryNight.design_matrix`.
+TERMS = {
+    FLUX_ZERO: (0, 0, 0, 0),
+    FLUX_SIMPLE_OCC: (1, 0, 0, 0),
+    FLUX_SIMPLE_REFL: (0, 1, 0, 0),
+    FLUX_SIMPLE_OCC_REFL: (1, 0, -1, 0),
+    FLUX_DAY_OCC: (0, 1, 0, -1),
+    FLUX_NIGHT_OCC: (1, 0, -1, 1),
+    FLUX_DAY_VIS: (0, 0, 0, 1),
+    FLUX_NIGHT_VIS: (1, 0, 0, -1),
+    FLUX_TRIP_DAY_OCC: (0, 1, 0, -1),
+    FLUX_TRIP_NIGHT_OCC: (1, 0, -1, 1),
+    FLUX_QUAD_DAY_VIS: (0, 0, 0, 1),
+    FLUX_QUAD_NIGHT_VIS: (1, 0, 0, -1),
+}
+
+
 class StarryNight(object):
-    def __init__(self, ydeg):
+    def __init__(self, ydeg, cache_dir=None, cache_size=0, cache_tol=1e-10):
+        """
+        A reflected light solver for maps of degree `ydeg`. If `cache_size`
+        is nonzero, the results of `precompute` (and, separately, the
+        illumination matrices) for up to that many geometries are kept in
+        least-recently-used caches keyed on `(b, theta, bo, ro)` (and
+        `(b, theta)`) rounded to `cache_tol`. See `cache_stats` and
+        `clear_cache`. The caches are only used by the scalar
+        `design_matrix` (and its gradient); `design_matrix_batch` always
+        computes everything from scratch.
+
+        """
         # Load kwargs
         self.ydeg = ydeg
 
-        # Instantiate the ops
-        self.ops = Ops(self.ydeg + 1, 0, 0, 0)
-
-        # Basis transform from poly to Green's
-        self.A2 = np.array(theano.sparse.dot(self.ops.A, self.ops.A1Inv).eval())
-
-        # Basis transform from Ylms to poly and back
-        N = (self.ydeg + 1) ** 2
-        self.A1 = np.array(self.ops.A1.todense())[:N, :N]
-        self.A1Inv = np.array(self.ops.A1Inv.todense())
-
-        # Z-rotation matrix (for degree ydeg + 1)
-        theta = theano.tensor.dscalar()
-        self.Rz = theano.function(
-            [theta],
-            dotROp(self.ops.dotR)(
-                np.eye((self.ydeg + 2) ** 2),
-                np.array(0.0),
-                np.array(0.0),
-                np.array(1.0),
-                theta,
-            ),
+        # Opt-in caches of the precomputed quantities & of the
+        # illumination matrices
+        self._cache = LRUCache(cache_size, cache_tol)
+        self._illum_cache = LRUCache(cache_size, cache_tol)
+
+        # Sparse basis transforms from Ylms to poly and back, and from
+        # poly to Green's. These are cached and shared across instances.
+        self.A1, self.A1Inv, self.A2 = get_basis(self.ydeg, cache_dir=cache_dir)
+
+        # The illumination matrix is linear in the source position, so we
+        # tabulate its basis (and the product of the basis with A1)
+        self.I = get_illum_basis(self.ydeg)
+        self.IA1_basis = np.array([I @ self.A1 for I in self.I])
+
+        # Green's basis integrals over the entire disk
+        self.sT0 = compute_Q(self.ydeg + 1, np.array([0.0, 2 * np.pi]))
+
+    def source(self, b=None, theta=None, gradient=False):
+        """
+        Return the coefficients of the polynomial illumination profile,
+        `1.5 * [xs, zs, ys]`, for a source at impact parameter `b` and
+        angle `theta`. If these are arrays, the result has shape `(N, 3)`.
+        If `gradient` is True, also return the derivatives with respect
+        to `b` and `theta`.
+
+        """
+        if b is None:
+            b = self.b
+        if theta is None:
+            theta = self.theta
+        y0 = np.sqrt(1 - b ** 2)
+        x = -y0 * np.sin(theta)
+        y = y0 * np.cos(theta)
+        z = -b * np.ones_like(x)
+        # NOTE: 3 / 2 is the starry normalization for reflected light maps
+        p = np.stack((x, z, y), axis=-1) * 1.5
+        if gradient:
+            dpdb = np.stack((-b * x / y0 ** 2, -np.ones_like(x), -b * y / y0 ** 2), -1)
+            dpdb *= 1.5
+            dpdtheta = np.stack((-y, np.zeros_like(x), x), axis=-1) * 1.5
+            return p, (dpdb, dpdtheta)
+        else:
+            return p
+
+    def illum(self, b=None, theta=None):
+        """
+        Return the illumination matrix. If `b` and `theta` are arrays, the
+        result has shape `(N, (ydeg + 2) ** 2, (ydeg + 1) ** 2)`.
+
+        """
+        return np.tensordot(self.source(b, theta), self.I, axes=1)
+
+    def illum_A1(self, b=None, theta=None):
+        """
+        Return the product of the illumination matrix and `A1`. If `b` and
+        `theta` are arrays, the result has shape
+        `(N, (ydeg + 2) ** 2, (ydeg + 1) ** 2)`.
+
+        """
+        return np.tensordot(self.source(b, theta), self.IA1_basis, axes=1)
+
+    def occulted_arcs(self, bo, ro):
+        """
+        Return the limits of the arcs bounding the occulted portion of the
+        disk for occultors at `xo = 0`, `yo = bo` of radius `ro`: `kappa`
+        along the limb of the occultor and `lam` along the limb of the
+        disk, each of shape `(N, 2)`. Rows for which there is no such
+        arc are NaN.
+
+        """
+        bo, ro = np.broadcast_arrays(
+            *[np.atleast_1d(np.array(arg, dtype=float)) for arg in (bo, ro)]
         )
+        bo = np.maximum(bo, STARRY_BO_ZERO_TOL)
+        kappa = np.full((len(bo), 2), np.nan)
+        lam = np.full((len(bo), 2), np.nan)
+        visible = bo > ro - 1
+
+        # Occultor entirely inside the disk: a full circle
+        # (any period of `kappa` will do, but we avoid kappa = 0)
+        kappa[visible & (bo <= 1 - ro)] = [np.pi, 3 * np.pi]
+
+        # Partial occultation: the arc of the occultor inside the disk
+        # and the arc of the limb inside the occultor
+        idx = visible & (bo > 1 - ro) & (bo < 1 + ro)
+        bo_, ro_ = bo[idx], ro[idx]
+        phi = np.arcsin(np.clip((1 - ro_ ** 2 - bo_ ** 2) / (2 * bo_ * ro_), -1, 1))
+        lam_ = np.arcsin(np.clip((1 - ro_ ** 2 + bo_ ** 2) / (2 * bo_), -1, 1))
+        kappa[idx] = np.transpose([1.5 * np.pi - phi, 2.5 * np.pi + phi])
+        lam[idx] = np.transpose([lam_, np.pi - lam_])
+
+        return kappa, lam
+
+    def sT_emitted(self, bo, ro):
+        """
+        Return the Green's basis integrals over the visible portion of the
+        disk for occultors at `xo = 0`, `yo = bo` of radius `ro`. These are
+        computed for arrays of `bo` and `ro` and have shape
+        `(N, (ydeg + 2) ** 2)`.
 
-        # Design matrix for emitted light (with occultation)
-        xo = theano.tensor.dscalar()
-        yo = theano.tensor.dscalar()
-        ro = theano.tensor.dscalar()
-        map = starry.Map(ydeg=self.ydeg + 1)
-        self.Xe = theano.function(
-            [xo, yo, ro], map.design_matrix(xo=xo, yo=yo, ro=ro)[0]
+        """
+        bo, ro = np.broadcast_arrays(
+            *[np.atleast_1d(np.array(arg, dtype=float)) for arg in (bo, ro)]
         )
+        bo = np.maximum(bo, STARRY_BO_ZERO_TOL)
+        sT = np.zeros((len(bo), (self.ydeg + 2) ** 2))
 
-        # Design matrix for reflected light (no occultation)
-        xs = theano.tensor.dscalar()
-        ys = theano.tensor.dscalar()
-        zs = theano.tensor.dscalar()
-        map_refl = starry.Map(ydeg=self.ydeg, reflected=True)
-        self.Xr = theano.function(
-            [xs, ys, zs], map_refl.design_matrix(xs=xs, ys=ys, zs=zs)[0]
+        # Complete occultations contribute nothing; everything else
+        # is the full disk minus the occulted portion
+        sT[bo > ro - 1] = self.sT0
+        kappa, lam = self.occulted_arcs(bo, ro)
+        idx = np.flatnonzero(~np.isnan(kappa[:, 0]))
+        if len(idx):
+            sT[idx] -= compute_P(self.ydeg + 1, bo[idx], ro[idx], kappa[idx])
+        idx = np.flatnonzero(~np.isnan(lam[:, 0]))
+        if len(idx):
+            sT[idx] -= compute_Q(self.ydeg + 1, lam[idx])
+
+        return sT
+
+    def sT_reflected(self, b, theta, night=False):
+        """
+        Return the Green's basis integrals over the dayside (or the
+        nightside, if `night` is True) of the unocculted disk. These are
+        computed for arrays of `b` and `theta` and have shape
+        `(N, (ydeg + 2) ** 2)`.
+
+        """
+        b, theta = np.broadcast_arrays(
+            *[np.atleast_1d(np.array(arg, dtype=float)) for arg in (b, theta)]
         )
 
-    def illum(self):
-        # Illumination matrix
-        y0 = np.sqrt(1 - self.b ** 2)
-        x = -y0 * np.sin(self.theta)
-        y = y0 * np.cos(self.theta)
-        z = -self.b
-        # NOTE: 3 / 2 is the starry normalization for reflected light maps
-        p = np.array([0, x, z, y]) * 1.5
-        n1 = 0
-        n2 = 0
-        I = np.zeros(((self.ydeg + 2) ** 2, (self.ydeg + 1) ** 2))
-        for l1 in range(self.ydeg + 1):
-            for m1 in range(-l1, l1 + 1):
-                if (l1 + m1) % 2 == 0:
-                    odd1 = False
-                else:
-                    odd1 = True
-                n2 = 0
-                for l2 in range(2):
-                    for m2 in range(-l2, l2 + 1):
-                        l = l1 + l2
-                        n = l * l + l + m1 + m2
-                        if odd1 and ((l2 + m2) % 2 != 0):
-                            I[n - 4 * l + 2, n1] += p[n2]
-                            I[n - 2, n1] -= p[n2]
-                            I[n + 2, n1] -= p[n2]
-                        else:
-                            I[n, n1] += p[n2]
-                        n2 += 1
-                n1 += 1
-        return I
+        # The boundary is half the limb, from one end of the
+        # terminator to the other, and the terminator itself
+        if night:
+            lam = theta[:, None] + np.array([np.pi, 2 * np.pi])
+            xi = np.tile([0.0, np.pi], (len(b), 1))
+        else:
+            lam = theta[:, None] + np.array([0.0, np.pi])
+            xi = np.tile([np.pi, 0.0], (len(b), 1))
+        return compute_Q(self.ydeg + 1, lam) + compute_T(self.ydeg + 1, b, theta, xi)
 
     def Xs(self):
-        return self.Xe(0.0, self.bo, self.ro).dot(self.A1Inv.dot(self.IA1))
+        return (self.sT_emitted(self.bo, self.ro)[0] @ self.A2).dot(self.IA1)
 
     def Xd(self):
-        y0 = np.sqrt(1 - self.b ** 2)
-        xs = -y0 * np.sin(self.theta)
-        ys = y0 * np.cos(self.theta)
-        zs = -self.b
-        return self.Xr(xs, ys, zs)
+        return (self.sT_reflected(self.b, self.theta)[0] @ self.A2).dot(self.IA1)
 
     def Xn(self):
-        y0 = np.sqrt(1 - self.b ** 2)
-        xs = -y0 * np.sin(self.theta)
-        ys = y0 * np.cos(self.theta)
-        zs = -self.b
-        return -self.Xr(-xs, -ys, -zs)
+        return (self.sT_reflected(self.b, self.theta, night=True)[0] @ self.A2).dot(
+            self.IA1
+        )
 
     def X(self):
-        return (self.P + self.Q + self.T).dot(self.A2).dot(self.IA1)
+        return ((self.P + self.Q + self.T) @ self.A2).dot(self.IA1)
 
     def ingest(self, b, theta, bo, ro):
         self.b = b
@@ -119,12 +209,41 @@ class StarryNight(object):
         self.bo = bo
         self.ro = ro
 
+    def cache_stats(self):
+        """Return the hit/miss statistics of the `precompute` & `illum` caches."""
+        return dict(precompute=self._cache.stats(), illum=self._illum_cache.stats())
+
+    def clear_cache(self):
+        """Empty the `precompute` & `illum` caches and reset their statistics."""
+        self._cache.clear()
+        self._illum_cache.clear()
+
     def precompute(self, b, theta, bo, ro):
         # Ingest
         self.ingest(b, theta, bo, ro)
 
+        # Have we seen this geometry before?
+        key = self._cache.key(self.b, self.theta, self.bo, self.ro)
+        cached = self._cache.get(key)
+        if cached is not None:
+            (
+                self.IA1,
+                self.kappa,
+                self.lam,
+                self.xi,
+                self.code,
+                self.P,
+                self.Q,
+                self.T,
+            ) = cached
+            return
+
         # Illumination matrix
-        self.IA1 = self.illum().dot(self.A1)
+        illum_key = key[:2]
+        self.IA1 = self._illum_cache.get(illum_key)
+        if self.IA1 is None:
+            self.IA1 = self.illum_A1()
+            self._illum_cache.put(illum_key, self.IA1)
 
         # Get integration code & limits
         self.kappa, self.lam, self.xi, self.code = get_angles(
@@ -146,38 +265,192 @@ class StarryNight(object):
             self.Q = None
             self.T = None
 
+        # Cache the results
+        self._cache.put(
+            key,
+            (
+                self.IA1,
+                self.kappa,
+                self.lam,
+                self.xi,
+                self.code,
+                self.P,
+                self.Q,
+                self.T,
+            ),
+        )
+
     def design_matrix(self, b, theta, bo, ro):
 
+        # Vectorized call?
+        if np.ndim(b) or np.ndim(theta) or np.ndim(bo) or np.ndim(ro):
+            return self.design_matrix_batch(b, theta, bo, ro)
+
+        # Time the call under the name of its branch, if profiling
+        with timing.timer() as timer:
+
+            # Pre-compute expensive stuff
+            self.precompute(b, theta, bo, ro)
+            timer.name = FLUX_NAMES.get(self.code, None)
+
+            # All branches
+            if self.code == FLUX_ZERO:
+                return np.zeros((self.ydeg + 1) ** 2)
+            elif self.code == FLUX_SIMPLE_OCC:
+                return self.Xs()
+            elif self.code == FLUX_SIMPLE_REFL:
+                return self.Xd()
+            elif self.code == FLUX_SIMPLE_OCC_REFL:
+                return self.Xs() - self.Xn()
+            elif self.code == FLUX_DAY_OCC:
+                return self.Xd() - self.X()
+            elif self.code == FLUX_NIGHT_OCC:
+                return self.Xs() - (self.Xn() - self.X())
+            elif self.code == FLUX_DAY_VIS:
+                return self.X()
+            elif self.code == FLUX_NIGHT_VIS:
+                return self.Xs() - self.X()
+            elif self.code == FLUX_TRIP_DAY_OCC:
+                return self.Xd() - self.X()
+            elif self.code == FLUX_TRIP_NIGHT_OCC:
+                return self.Xs() - (self.Xn() - self.X())
+            elif self.code == FLUX_QUAD_DAY_VIS:
+                return self.X()
+            elif self.code == FLUX_QUAD_NIGHT_VIS:
+                return self.Xs() - self.X()
+            else:
+                raise NotImplementedError("Unexpected branch.")
+
+    def design_matrix_and_grad(self, b, theta, bo, ro):
+        """
+        Return the design matrix and a tuple with its derivatives with
+        respect to `b`, `theta`, `bo`, and `ro`.
+
+        Each term in the design matrix is an integral over a region of the
+        disk (see `design_matrix`). Its derivatives are the sum of the
+        derivatives of the illumination matrix and of the boundary integrals
+        along the arcs of the boundary that move: those along the limb of the
+        occultor (for `bo` and `ro`) and along the terminator (for `b` and
+        `theta`). The limits of the arcs do not need to be differentiated,
+        since their contributions cancel around each closed boundary.
+
+        """
         # Pre-compute expensive stuff
         self.precompute(b, theta, bo, ro)
+        cs, cd, cn, cx = TERMS[self.code]
+        ydeg = self.ydeg + 1
+        sT = np.zeros((ydeg + 1) ** 2)
+        dsT = np.zeros((4, (ydeg + 1) ** 2))
 
-        # All branches
-        if self.code == FLUX_ZERO:
-            return np.zeros((self.ydeg + 1) ** 2)
-        elif self.code == FLUX_SIMPLE_OCC:
-            return self.Xs()
-        elif self.code == FLUX_SIMPLE_REFL:
-            return self.Xd()
-        elif self.code == FLUX_SIMPLE_OCC_REFL:
-            return self.Xs() - self.Xn()
-        elif self.code == FLUX_DAY_OCC:
-            return self.Xd() - self.X()
-        elif self.code == FLUX_NIGHT_OCC:
-            return self.Xs() - (self.Xn() - self.X())
-        elif self.code == FLUX_DAY_VIS:
-            return self.X()
-        elif self.code == FLUX_NIGHT_VIS:
-            return self.Xs() - self.X()
-        elif self.code == FLUX_TRIP_DAY_OCC:
-            return self.Xd() - self.X()
-        elif self.code == FLUX_TRIP_NIGHT_OCC:
-            return self.Xs() - (self.Xn() - self.X())
-        elif self.code == FLUX_QUAD_DAY_VIS:
-            return self.X()
-        elif self.code == FLUX_QUAD_NIGHT_VIS:
-            return self.Xs() - self.X()
-        else:
-            raise NotImplementedError("Unexpected branch.")
+        # Visible portion of the disk
+        if cs:
+            bo = max(self.bo, STARRY_BO_ZERO_TOL)
+            sT += cs * self.sT_emitted(bo, self.ro)[0]
+            kappa, _ = self.occulted_arcs(bo, self.ro)
+            if not np.isnan(kappa[0, 0]):
+                dsT[2:] -= cs * np.array(compute_P_grad(ydeg, bo, self.ro, kappa[0]))
+
+        # Dayside and nightside of the unocculted disk
+        if cd:
+            sT += cd * self.sT_reflected(self.b, self.theta)[0]
+            dsT[:2] += cd * np.array(
+                compute_T_grad(ydeg, self.b, self.theta, np.array([np.pi, 0.0]))
+            )
+        if cn:
+            sT += cn * self.sT_reflected(self.b, self.theta, night=True)[0]
+            dsT[:2] += cn * np.array(
+                compute_T_grad(ydeg, self.b, self.theta, np.array([0.0, np.pi]))
+            )
+
+        # The region bounded by the arcs computed in `precompute`
+        if cx:
+            sT += cx * (self.P + self.Q + self.T)
+            dsT[:2] += cx * np.array(compute_T_grad(ydeg, self.b, self.theta, self.xi))
+            dsT[2:] += cx * np.array(compute_P_grad(ydeg, self.bo, self.ro, self.kappa))
+
+        # Weight by the illumination
+        poly = sT @ self.A2
+        dpoly = dsT @ self.A2
+        _, dp = self.source(gradient=True)
+        X = poly.dot(self.IA1)
+        dX = dpoly.dot(self.IA1)
+        for i in range(2):
+            dX[i] += poly.dot(np.tensordot(dp[i], self.IA1_basis, axes=1))
+
+        return X, tuple(dX)
+
+    @timing.timed
+    def design_matrix_batch(self, b, theta, bo, ro, track=False):
+        """
+        Return the design matrix for arrays of `b`, `theta`, `bo`, and `ro`.
+
+        The points are grouped by integration code, so that the terms common
+        to each group (`Xs`, `Xd`, `Xn` and `X`) are evaluated in bulk. Unlike
+        `design_matrix`, this does not modify the state of the instance.
+        The result has shape `(N, (ydeg + 1) ** 2)`, where `N` is the size of
+        the broadcasted inputs. If the points are ordered in time (as in a
+        light curve), set `track` to True to warm-start the root solver at
+        each point with the roots at the previous one. The primitive
+        integrals are computed in bulk for each group of points with the same
+        integration code and number of integration limits; when profiling
+        (see `timing`), each group is timed under the name of its integration
+        code, followed by "(batch)". The caches used by `precompute` are
+        bypassed, since looking up each point separately would defeat the
+        bulk evaluation; call `design_matrix` on scalars to use them.
+
+        """
+        # Ingest
+        b, theta, bo, ro = np.broadcast_arrays(
+            *[np.atleast_1d(np.array(arg, dtype=float)) for arg in (b, theta, bo, ro)]
+        )
+        b = b.flatten()
+        theta = theta.flatten() % (2 * np.pi)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        bo = bo.flatten()
+        ro = ro.flatten()
+        npts = len(b)
+
+        # Get integration codes & limits
+        kappa, lam, xi, code = get_angles_batch(
+            b, theta, costheta, sintheta, bo, ro, track=track
+        )
+
+        # Coefficients of each of the terms
+        cs, cd, cn, cx = np.array([TERMS[c] for c in code], dtype=int).reshape(-1, 4).T
+
+        # Accumulate all the terms in the polynomial basis
+        sT = np.zeros((npts, (self.ydeg + 2) ** 2))
+        idx = np.flatnonzero(cs)
+        if len(idx):
+            sT[idx] += cs[idx, None] * self.sT_emitted(bo[idx], ro[idx])
+        idx = np.flatnonzero(cd)
+        if len(idx):
+            sT[idx] += cd[idx, None] * self.sT_reflected(b[idx], theta[idx])
+        idx = np.flatnonzero(cn)
+        if len(idx):
+            sT[idx] += cn[idx, None] * self.sT_reflected(b[idx], theta[idx], night=True)
+
+        # The occultation terms are computed in bulk for each group of points
+        # with the same integration code and number of integration limits
+        groups = {}
+        for i in np.flatnonzero(cx):
+            key = (code[i], len(kappa[i]), len(lam[i]), len(xi[i]))
+            groups.setdefault(key, []).append(i)
+        for (c, nkappa, nlam, nxi), idx in groups.items():
+            idx = np.array(idx)
+            kappa_ = np.reshape([kappa[i] for i in idx], (len(idx), nkappa))
+            lam_ = np.reshape([lam[i] for i in idx], (len(idx), nlam))
+            xi_ = np.reshape([xi[i] for i in idx], (len(idx), nxi))
+            with timing.timer(FLUX_NAMES[c] + " (batch)"):
+                P = compute_P(self.ydeg + 1, bo[idx], ro[idx], kappa_)
+                Q = compute_Q(self.ydeg + 1, lam_)
+                T = compute_T(self.ydeg + 1, b[idx], theta[idx], xi_)
+                sT[idx] += cx[idx, None] * (P + Q + T)
+        poly = sT @ self.A2
+
+        # Weight by the illumination
+        return np.einsum("nk,knj->nj", self.source(b, theta), poly @ self.IA1_basis)
 
     def flux(self, y, b, theta, bo, ro):
         return self.design_matrix(b, theta, bo, ro).dot(y)
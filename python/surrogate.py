@@ -0,0 +1,453 @@
+"""
+A surrogate for `StarryNight.design_matrix` at fixed `ydeg`.
+
+Within each region of parameter space (labeled by the `FLUX_*` code and
+by whether the occultor is inside, on, or outside the limb), the design
+matrix is a smooth function of `(b, theta, bo, ro)`, so it can be
+tabulated once and interpolated many times (e.g., in an MCMC run at fixed
+`ydeg`). The parameter box is split into a grid of cells, each of which is
+refined adaptively (by bisection along the parameters that need it) until
+the design matrix can be approximated to within a tolerance `tol` by a
+tensor product of Chebyshev polynomials. Cells that lie within a single
+region are interpolated at the Chebyshev nodes. Cells that are crossed by
+the boundary of a region are fit separately in each of the regions, by
+least squares over the nodes that fall inside it. Regions that can't be
+fit by the maximum refinement depth are evaluated exactly, as are points
+outside the box. Looking up the fit for a point is cheap in cells that lie
+within a single region, but in cells crossed by a boundary the region of
+each point must be found with `get_angles_batch`, which is almost as
+expensive as the root finding in the exact solver::
+
+    S = Surrogate(2, file="surrogate.npz")
+    X = S.design_matrix(b, theta, bo, ro)
+
+Parameters whose bounds are equal (such as `ro` by default) are not
+tabulated, which makes the tables much cheaper to build. The cells are
+uniform in `arcsin(b)` rather than `b`: the design matrix depends on the
+latter through `sqrt(1 - b^2)`, whose branch points at `|b| = 1` would
+otherwise spoil the convergence of the cells at the edges of the box.
+After the build, `coverage` is the fraction of the box in which the
+surrogate is used (rather than the exact solver); a warning is issued if
+it is less than `STARRY_SURROGATE_MIN_COVERAGE`.
+
+"""
+from utils import *
+from geometry import get_angles_batch
+from starrynight import StarryNight
+from itertools import product
+import numpy as np
+import warnings
+import os
+
+__all__ = ["Surrogate"]
+
+
+def _cheb_nodes(n):
+    """Return the `n` Chebyshev nodes of the first kind on [-1, 1]."""
+    return np.cos(np.pi * (np.arange(n)[::-1] + 0.5) / n)
+
+
+def _cheb_vander(x, n):
+    """Return the Chebyshev polynomials `T_0 .. T_{n - 1}` evaluated at `x`."""
+    return np.polynomial.chebyshev.chebvander(x, n - 1)
+
+
+class Surrogate(object):
+
+    # The settings that determine the tables
+    _SETTINGS = ["ydeg", "bounds", "order", "shape", "max_depth", "tol", "ntest"]
+
+    def __init__(
+        self,
+        ydeg,
+        bounds=[(-1, 1), (0, 2 * np.pi), (0, 2), (0.1, 0.1)],
+        order=(12, 10, 6, 6),
+        shape=(4, 8, 20, 4),
+        max_depth=0,
+        tol=1e-6,
+        ntest=16,
+        seed=0,
+        file=None,
+        cache_dir=None,
+    ):
+        """
+        Tabulate the design matrix for a map of degree `ydeg` over the box
+        `bounds` on `(b, theta, bo, ro)`, using `order` Chebyshev nodes
+        along each parameter in each cell (the order may also be given for
+        each parameter separately). The box is initially split into a grid
+        of `shape` cells, each of which is bisected at most `max_depth`
+        times. A fit is accepted if it agrees with the exact design matrix
+        to within `tol` (in absolute terms) at `ntest` random points in
+        its region of the cell. Since `theta` is reduced modulo 2 pi, its
+        bounds should be within [0, 2 pi]. If `file` is given, the tables
+        are saved to (and subsequently loaded from) that `.npz` file; if
+        the file was computed with different settings (other than `seed`),
+        the tables are rebuilt and the file is overwritten.
+
+        The defaults cover about two thirds of the default box to within
+        `tol` (for `ydeg = 1`, the tables take about 20 seconds to build).
+        The cells along `bo` are 0.1 wide, so the points of contact
+        `bo = 1 +/- ro` lie on their edges; most of the rest of the box is
+        in cells crossed by the terminator. Increasing `max_depth` to 1
+        raises the coverage to about four fifths, at roughly eight times
+        the cost.
+
+        """
+        self.ydeg = ydeg
+        self.map = StarryNight(ydeg, cache_dir=cache_dir)
+
+        # Settings
+        self.bounds = np.array(bounds, dtype=float).reshape(4, 2)
+        fixed = self.bounds[:, 1] == self.bounds[:, 0]
+        self.order = np.where(fixed, 1, np.broadcast_to(order, 4)).astype(int)
+        self.shape = np.where(fixed, 1, np.broadcast_to(shape, 4)).astype(int)
+        self.max_depth = int(max_depth)
+        self.tol = float(tol)
+        self.ntest = int(ntest)
+        self._rng = np.random.default_rng(seed)
+
+        # Load the tables from disk?
+        if file is not None and os.path.exists(file):
+            with np.load(file) as data:
+                stale = [
+                    name
+                    for name in self._SETTINGS
+                    if name not in data
+                    or not np.array_equal(data[name], getattr(self, name))
+                ]
+            if not stale:
+                self.load(file)
+                return
+            warnings.warn(
+                "File `{}` was computed with different settings ({}); "
+                "rebuilding the tables.".format(file, ", ".join(stale))
+            )
+        self._init_grid()
+
+        # Fit each of the cells, refining them as needed
+        self.index = -np.ones(self._nfine, dtype=int)
+        self.lo = []
+        self.hi = []
+        self.cells = []
+        self.regions = []
+        self.coeffs = []
+        self.single = []
+        size = np.where(fixed, 1, 2 ** self.max_depth)
+        for corner in product(*[range(n) for n in self.shape]):
+            self._refine(np.array(corner) * size, size, 0, self.ntest)
+        self.lo = np.array(self.lo).reshape(-1, 4)
+        self.hi = np.array(self.hi).reshape(-1, 4)
+        self.single = np.array(self.single, dtype=bool)
+        self.cells = np.array(self.cells, dtype=int)
+        self.regions = np.array(self.regions, dtype=int)
+        self.coeffs = np.array(self.coeffs).reshape(
+            (-1,) + tuple(self.order) + ((self.ydeg + 1) ** 2,)
+        )
+        self._init_lookup()
+
+        # Fraction of the box in which the surrogate is used
+        q = self.bounds[:, 0] + (self.bounds[:, 1] - self.bounds[:, 0]) * (
+            self._rng.uniform(size=(STARRY_SURROGATE_COVERAGE_POINTS, 4))
+        )
+        self.coverage = np.mean(self._find(*q.T)[0] >= 0)
+        if self.coverage < STARRY_SURROGATE_MIN_COVERAGE:
+            warnings.warn(
+                "The surrogate only covers {:.0f}% of the box; consider "
+                "increasing `order`, `shape`, or `max_depth`.".format(
+                    100 * self.coverage
+                )
+            )
+
+        # Save them
+        if file is not None:
+            self.save(file)
+
+    def _init_grid(self):
+        # The box in the coordinates of the grid
+        self._box = self._transform(self.bounds.T).T
+
+        # Size of the finest grid & spacing of its cells along each parameter
+        fixed = self.bounds[:, 1] == self.bounds[:, 0]
+        self._nfine = tuple(np.where(fixed, 1, self.shape * 2 ** self.max_depth))
+        self._step = (self._box[:, 1] - self._box[:, 0]) / self._nfine
+        self._scale = np.where(fixed, 0.0, 1.0 / np.where(fixed, 1.0, self._step))
+
+        # Inverse Vandermonde matrices at the Chebyshev nodes
+        self._nodes = [_cheb_nodes(n) for n in self.order]
+        self._vinv = [
+            np.linalg.inv(_cheb_vander(x, n)) for x, n in zip(self._nodes, self.order)
+        ]
+
+        # Vandermonde matrix of the tensor basis at all the nodes & the
+        # degree along each parameter of each of the basis functions
+        self._vander = _cheb_vander(self._nodes[0], self.order[0])
+        for x, n in zip(self._nodes[1:], self.order[1:]):
+            self._vander = np.kron(self._vander, _cheb_vander(x, n))
+        self._degree = np.indices(self.order).reshape(4, -1)
+
+        # Masks of the highest-order Chebyshev coefficients along each parameter
+        self._last = [
+            ((i == n - 1) & (n > 1)).reshape(self.order)
+            for i, n in zip(self._degree, self.order)
+        ]
+
+    def _init_lookup(self):
+        # Index of the fit for each cell & region
+        nregions = 3 * (max(FLUX_NAMES) + 1)
+        self._lookup = -np.ones((len(self.lo), nregions), dtype=int)
+        self._lookup[self.cells, self.regions] = np.arange(len(self.regions))
+
+        # Index of the fit for the cells that lie within a single region
+        self._only = -np.ones(len(self.lo), dtype=int)
+        self._only[self.cells[self.single[self.cells]]] = np.flatnonzero(
+            self.single[self.cells]
+        )
+
+    def _transform(self, p):
+        """Map points `(b, theta, bo, ro)` to the coordinates of the grid."""
+        x = np.array(p, dtype=float)
+        x[..., 0] = np.arcsin(np.clip(x[..., 0], -1, 1))
+        return x
+
+    def _untransform(self, x):
+        """Map points from the coordinates of the grid to `(b, theta, bo, ro)`."""
+        p = np.array(x, dtype=float)
+        p[..., 0] = np.sin(p[..., 0])
+        return p
+
+    def _region(self, b, theta, bo, ro):
+        """
+        Return the regions containing arrays of points. These are labeled by
+        the integration code and by whether the occultor lies inside the
+        disk, straddles its limb, or lies outside it, since the design
+        matrix has a kink at the points of contact even if the code doesn't
+        change there.
+
+        """
+        theta = theta % (2 * np.pi)
+        code = get_angles_batch(b, theta, np.cos(theta), np.sin(theta), bo, ro)[3]
+        contact = (np.abs(bo) > 1 - ro).astype(int) + (np.abs(bo) > 1 + ro)
+        return code + (max(FLUX_NAMES) + 1) * contact
+
+    def _refine(self, corner, size, depth, ntest):
+        """Fit a cell, or bisect it and recurse if the fit isn't good enough."""
+        lo = self._box[:, 0] + corner * self._step
+        hi = lo + size * self._step
+        regions, fits, split = self._fit(lo, hi, ntest)
+        if len(fits) < len(regions) and depth < self.max_depth:
+            half = np.where(split, size // 2, 0)
+            for offset in product(*[(0, h) if h else (0,) for h in half]):
+                self._refine(corner + offset, size - half, depth + 1, ntest)
+        elif len(fits):
+            cell = tuple(slice(c, c + s) for c, s in zip(corner, size))
+            self.index[cell] = len(self.lo)
+            for region, coeffs in fits.items():
+                self.cells.append(len(self.lo))
+                self.regions.append(region)
+                self.coeffs.append(coeffs)
+            self.lo.append(lo)
+            self.hi.append(hi)
+            self.single.append(len(regions) == 1)
+
+    def _fit(self, lo, hi, ntest):
+        """
+        Return the regions in the cell spanning `lo` to `hi` (in the
+        coordinates of the grid), a dictionary mapping each of the regions
+        that could be fit to the Chebyshev coefficients of the fit, and a
+        mask of the parameters along which the cell should be bisected if
+        the fit isn't good enough.
+
+        """
+        # Regions at the nodes and at random test points
+        x = [l + 0.5 * (h - l) * (1 + n) for l, h, n in zip(lo, hi, self._nodes)]
+        x = np.transpose([g.flatten() for g in np.meshgrid(*x, indexing="ij")])
+        p = self._untransform(x).T
+        region = self._region(*p)
+        q = lo + (hi - lo) * self._rng.uniform(size=(ntest, 4))
+        qregion = self._region(*self._untransform(q).T)
+        regions = np.union1d(region, qregion)
+        fits = {}
+        split = self.order > 1
+
+        # If the cell lies within a single region, interpolate at the nodes
+        X = self.map.design_matrix(*p)
+        if len(regions) == 1:
+            coeffs = X.reshape(tuple(self.order) + (-1,))
+            for axis, vinv in enumerate(self._vinv):
+                coeffs = np.tensordot(vinv, coeffs, axes=(1, axis))
+                coeffs = np.moveaxis(coeffs, 0, axis)
+
+            # The highest-order coefficients along each parameter are an
+            # estimate of the error; this is sensitive to kinks that may be
+            # missed by the test points. If the cell needs to be refined, it
+            # is only bisected along the parameters that don't converge.
+            tail = np.array(
+                [np.max(np.sum(np.abs(coeffs[last]), axis=0)) for last in self._last]
+            )
+            if np.sum(tail) <= self.tol:
+                Xq = self.map.design_matrix(*self._untransform(q).T)
+                err = self._evaluate(coeffs, lo, hi, q) - Xq
+                if np.max(np.abs(err)) <= self.tol:
+                    fits[regions[0]] = coeffs
+            else:
+                split &= tail > self.tol / np.count_nonzero(split)
+            return regions, fits, split
+
+        # Otherwise, fit each region separately, with a basis small enough
+        # to be constrained by the nodes in the region, and check it at
+        # (more) test points in the region. If the cell needs to be refined,
+        # it is only bisected along the parameters the boundaries cross.
+        grid = region.reshape(self.order)
+        crossed = np.array([np.any(np.diff(grid, axis=i)) for i in range(4)])
+        if np.any(crossed):
+            split = crossed
+        q = lo + (hi - lo) * self._rng.uniform(size=(ntest * len(regions), 4))
+        qregion = self._region(*self._untransform(q).T)
+        Xq = self.map.design_matrix(*self._untransform(q).T)
+        nfree = np.count_nonzero(self.order > 1)
+        for c in regions:
+            k = region == c
+            kq = qregion == c
+            if np.count_nonzero(kq) < ntest:
+                continue
+            n = int(np.floor((0.5 * np.count_nonzero(k)) ** (1 / nfree)))
+            if n < 2:
+                continue
+            basis = np.all(self._degree < np.minimum(n, self.order)[:, None], axis=0)
+            coeffs = np.zeros((self._vander.shape[1], X.shape[1]))
+            coeffs[basis] = np.linalg.lstsq(
+                self._vander[np.ix_(k, basis)], X[k], rcond=None
+            )[0]
+            coeffs = coeffs.reshape(tuple(self.order) + (-1,))
+            err = self._evaluate(coeffs, lo, hi, q[kq]) - Xq[kq]
+            if np.max(np.abs(err)) <= self.tol:
+                fits[c] = coeffs
+        return regions, fits, split
+
+    def _evaluate(self, coeffs, lo, hi, p):
+        """
+        Evaluate the interpolant in a cell at the points `p` (in the
+        coordinates of the grid).
+
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = np.where(hi > lo, (2 * p - lo - hi) / (hi - lo), 0.0)
+        T = [_cheb_vander(x[:, i], n) for i, n in enumerate(self.order)]
+        basis = (
+            T[0][:, :, None, None, None]
+            * T[1][:, None, :, None, None]
+            * T[2][:, None, None, :, None]
+            * T[3][:, None, None, None, :]
+        )
+        return basis.reshape(len(p), -1) @ coeffs.reshape(basis[0].size, -1)
+
+    def _find(self, b, theta, bo, ro):
+        """
+        Return the index of the fit for each of the points (or -1 if they
+        must be evaluated exactly) and the points in the coordinates of the
+        grid, as an array of shape `(N, 4)`. The (expensive) regions of the
+        points are only computed for the cells crossed by a boundary.
+
+        """
+        theta = theta % (2 * np.pi)
+        p = np.transpose([b, theta, bo, ro])
+
+        # Find the cell containing each point
+        inside = np.all((p >= self.bounds[:, 0]) & (p <= self.bounds[:, 1]), axis=1)
+        p = self._transform(p)
+        cell = -np.ones(len(p), dtype=int)
+        if np.any(inside):
+            idx = np.floor((p[inside] - self._box[:, 0]) * self._scale)
+            idx = np.minimum(idx.astype(int), np.array(self._nfine) - 1)
+            cell[inside] = self.index[tuple(idx.T)]
+
+        # Find the fit for the region of the cell containing each point
+        fit = -np.ones(len(p), dtype=int)
+        k = np.flatnonzero(cell >= 0)
+        single = self.single[cell[k]]
+        fit[k[single]] = self._only[cell[k[single]]]
+        k = k[~single]
+        if len(k):
+            region = self._region(b[k], theta[k], bo[k], ro[k])
+            fit[k] = self._lookup[cell[k], region]
+        return fit, p
+
+    def save(self, file):
+        """Save the tables to the `.npz` file `file`."""
+        np.savez(
+            file,
+            ydeg=self.ydeg,
+            bounds=self.bounds,
+            order=self.order,
+            shape=self.shape,
+            max_depth=self.max_depth,
+            tol=self.tol,
+            ntest=self.ntest,
+            coverage=self.coverage,
+            index=self.index,
+            lo=self.lo,
+            hi=self.hi,
+            cells=self.cells,
+            regions=self.regions,
+            coeffs=self.coeffs,
+            single=self.single,
+        )
+
+    def load(self, file):
+        """Load the tables from the `.npz` file `file`."""
+        data = np.load(file)
+        if int(data["ydeg"]) != self.ydeg:
+            raise ValueError(
+                "File `{}` was computed for `ydeg = {}`.".format(
+                    file, int(data["ydeg"])
+                )
+            )
+        self.bounds = data["bounds"]
+        self.order = data["order"]
+        self.shape = data["shape"]
+        self.max_depth = int(data["max_depth"])
+        self.tol = float(data["tol"])
+        self.ntest = int(data["ntest"])
+        self.coverage = float(data["coverage"])
+        self.index = data["index"]
+        self.lo = data["lo"]
+        self.hi = data["hi"]
+        self.cells = data["cells"]
+        self.regions = data["regions"]
+        self.coeffs = data["coeffs"]
+        self.single = data["single"]
+        self._init_grid()
+        self._init_lookup()
+
+    def design_matrix(self, b, theta, bo, ro):
+        """
+        Return the (interpolated) design matrix for `b`, `theta`, `bo`, and
+        `ro`, which may be arrays. As in `StarryNight.design_matrix`, the
+        result has shape `((ydeg + 1) ** 2,)` for scalar inputs and
+        `(N, (ydeg + 1) ** 2)` otherwise.
+
+        """
+        scalar = not (np.ndim(b) or np.ndim(theta) or np.ndim(bo) or np.ndim(ro))
+        b, theta, bo, ro = [
+            np.array(arg, dtype=float).flatten()
+            for arg in np.broadcast_arrays(b, theta, bo, ro)
+        ]
+        fit, p = self._find(b, theta, bo, ro)
+
+        # Interpolate where we can and use the exact solver elsewhere
+        X = np.empty((len(p), (self.ydeg + 1) ** 2))
+        for f in np.unique(fit[fit >= 0]):
+            k = np.flatnonzero(fit == f)
+            c = self.cells[f]
+            X[k] = self._evaluate(self.coeffs[f], self.lo[c], self.hi[c], p[k])
+        k = np.flatnonzero(fit < 0)
+        if len(k):
+            X[k] = self.map.design_matrix(b[k], theta[k], bo[k], ro[k])
+
+        if scalar:
+            return X[0]
+        else:
+            return X
+
+    def flux(self, y, b, theta, bo, ro):
+        return self.design_matrix(b, theta, bo, ro).dot(y)
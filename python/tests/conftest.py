@@ -0,0 +1,74 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# The modules use flat imports, so put them on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geometry import get_angles_batch
+from scipy.sparse import csr_matrix, save_npz
+import basis
+
+
+def sample_geometries(npts=10, nsamples=100000, seed=0, limb=False):
+    """
+    Return a dictionary mapping each integration code to an array of shape
+    `(n, 4)` of up to `npts` random geometries `(b, theta, bo, ro)` with
+    that code. If `limb` is True, only geometries in which the occultor
+    crosses the limb of the body are drawn. Codes that are not found among
+    the `nsamples` random draws are absent from the dictionary.
+
+    """
+    rng = np.random.default_rng(seed)
+    b = rng.uniform(-1, 1, nsamples)
+    theta = rng.uniform(0, 2 * np.pi, nsamples)
+    ro = rng.uniform(0.01, 2, nsamples)
+    if limb:
+        bo = np.abs(1 - ro) + rng.uniform(0, 1, nsamples) * (1 + ro - np.abs(1 - ro))
+    else:
+        bo = rng.uniform(0, 1, nsamples) * (1 + 2 * ro)
+    _, _, _, code = get_angles_batch(b, theta, np.cos(theta), np.sin(theta), bo, ro)
+    geometries = {}
+    for c in np.unique(code):
+        idx = np.flatnonzero(code == c)[:npts]
+        geometries[int(c)] = np.transpose([b[idx], theta[idx], bo[idx], ro[idx]])
+    return geometries
+
+
+@pytest.fixture(scope="session")
+def geometries():
+    """Up to 20 random geometries for each integration code."""
+    return sample_geometries(npts=20)
+
+
+@pytest.fixture(scope="session")
+def limb_geometries():
+    """Up to 5 random geometries for each code, with the occultor on the limb."""
+    return sample_geometries(npts=5, limb=True)
+
+
+@pytest.fixture(scope="session")
+def baseline():
+    """
+    Reference values computed with the original implementation, in which
+    `Xs` was the starry design matrix `Map(ydeg + 1).design_matrix` and
+    `Xd` and `Xn` were the starry reflected light design matrices, along
+    with the change of basis matrices from starry. The geometries are
+    drawn as in `sample_geometries` (three random and two limb-crossing
+    geometries for each integration code).
+
+    """
+    path = os.path.dirname(os.path.abspath(__file__))
+    return dict(np.load(os.path.join(path, "data", "baseline.npz")))
+
+
+@pytest.fixture
+def basis_dir(baseline, tmp_path, monkeypatch):
+    """A `cache_dir` holding the starry change of basis matrices."""
+    monkeypatch.setattr(basis, "_BASIS", {})
+    for ydeg in [1, 2]:
+        for name in ["A1", "A1Inv", "A2"]:
+            matrix = csr_matrix(baseline["{}_{}".format(name, ydeg)])
+            save_npz(str(tmp_path / "{}_{}.npz".format(name, ydeg)), matrix)
+    return str(tmp_path)
@@ -0,0 +1,17 @@
+from starrynight import StarryNight
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("ydeg", [1, 2])
+def test_baseline(ydeg, baseline, basis_dir):
+    map = StarryNight(ydeg, cache_dir=basis_dir)
+    geometries = baseline["geometries"]
+    X = map.design_matrix(*geometries.T)
+    assert np.allclose(X, baseline["X_{}".format(ydeg)], atol=1e-7)
+    for n, args in enumerate(geometries):
+        map.design_matrix(*args)
+        assert map.code == baseline["code_{}".format(ydeg)][n]
+        for name in ["Xs", "Xd", "Xn"]:
+            expected = baseline["{}_{}".format(name, ydeg)][n]
+            assert np.allclose(getattr(map, name)(), expected, atol=1e-8)
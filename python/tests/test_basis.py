@@ -0,0 +1,26 @@
+from basis import get_basis
+from starrynight import StarryNight
+import basis
+import numpy as np
+import os
+import sys
+
+
+def test_shared():
+    A1, A1Inv, A2 = get_basis(2)
+    assert get_basis(2)[2] is A2
+    assert StarryNight(2).A2 is StarryNight(2).A2 is A2
+    assert A1.shape == (9, 9) and A1Inv.shape == A2.shape == (16, 16)
+
+
+def test_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(basis, "_BASIS", {})
+    matrices = get_basis(2, cache_dir=str(tmp_path))
+    for name in ["A1", "A1Inv", "A2"]:
+        assert os.path.exists(str(tmp_path / "{}_2.npz".format(name)))
+
+    # A new process loads them from disk, without starry
+    monkeypatch.setattr(basis, "_BASIS", {})
+    monkeypatch.setitem(sys.modules, "starry._c_ops", None)
+    for A, A0 in zip(get_basis(2, cache_dir=str(tmp_path)), matrices):
+        assert np.all(A.toarray() == A0.toarray())
@@ -0,0 +1,30 @@
+from benchmark import benchmark, compare, import_times
+from starrynight import TERMS
+from utils import FLUX_NAMES
+import json
+
+
+def test_benchmark():
+    results = json.loads(json.dumps(benchmark(ydegs=[1], npts=1, repeat=1)))
+    assert list(results) == ["1"]
+    for code, stages in results["1"].items():
+        assert code in FLUX_NAMES.values()
+        assert "design_matrix" in stages and "illum" in stages
+        assert all(t > 0 for t in stages.values())
+    code = [c for c in TERMS if TERMS[c][3]][0]
+    assert "compute_P" in results["1"][FLUX_NAMES[code]]
+
+
+def test_import_times():
+    results = import_times(modules=["utils"], repeat=1)
+    assert results["imports"]["utils"]["import"] > 0
+
+
+def test_compare():
+    baseline = {"2": {"DAY_OCC": {"compute_P": 1.0, "compute_Q": 1.0}}}
+    results = {
+        "2": {"DAY_OCC": {"compute_P": 1.5, "compute_Q": 1.1, "compute_T": 9.0}},
+        "5": {"DAY_OCC": {"compute_P": 9.0}},
+    }
+    assert compare(results, baseline) == [("2", "DAY_OCC", "compute_P", 1.5, 1.0)]
+    assert len(compare(results, baseline, tolerance=0.05)) == 2
@@ -0,0 +1,50 @@
+from cache import LRUCache
+
+
+def test_hits_and_misses():
+    cache = LRUCache(2)
+    key = cache.key(0.1, 0.2)
+    assert cache.get(key) is None
+    cache.put(key, "a")
+    assert cache.get(key) == "a"
+    assert cache.stats() == dict(hits=1, misses=1, evictions=0, size=1, maxsize=2)
+
+
+def test_eviction_order():
+    cache = LRUCache(2)
+    cache.put((1,), "a")
+    cache.put((2,), "b")
+    # Using (1,) makes (2,) the least recently used entry
+    assert cache.get((1,)) == "a"
+    cache.put((3,), "c")
+    assert (1,) in cache and (3,) in cache and (2,) not in cache
+    cache.evict()
+    assert (1,) not in cache and len(cache) == 1
+    cache.evict((3,))
+    assert len(cache) == 0
+    assert cache.evictions == 3
+
+
+def test_key_tol():
+    cache = LRUCache(1, tol=1e-6)
+    assert cache.key(0.3, 1.0) == cache.key(0.3 + 1e-9, 1.0 - 1e-9)
+    assert cache.key(0.3, 1.0) != cache.key(0.3 + 1e-5, 1.0)
+    assert LRUCache(1, tol=0).key(0.3) == (0.3,)
+
+
+def test_disabled():
+    cache = LRUCache(0)
+    cache.put((1,), "a")
+    assert cache.get((1,)) is None
+    assert len(cache) == 0
+    assert cache.stats()["misses"] == 0
+
+
+def test_clear():
+    cache = LRUCache(2)
+    cache.put((1,), "a")
+    cache.get((1,))
+    cache.clear(stats=False)
+    assert len(cache) == 0 and cache.hits == 1
+    cache.clear()
+    assert cache.hits == 0
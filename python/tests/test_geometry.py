@@ -0,0 +1,84 @@
+from utils import *
+from geometry import get_angles, get_angles_batch, get_roots, get_roots_batch
+import geometry
+import numpy as np
+import pytest
+
+
+def test_get_angles_batch(geometries, limb_geometries):
+    b, theta, bo, ro = np.concatenate(
+        list(geometries.values()) + list(limb_geometries.values())
+    ).T
+    args = (b, theta, np.cos(theta), np.sin(theta), bo, ro)
+    kappa, lam, xi, code = get_angles_batch(*args)
+    for n in range(len(b)):
+        kappa0, lam0, xi0, code0 = get_angles(*[arg[n] for arg in args])
+        assert code[n] == code0
+        for x, x0 in zip((kappa[n], lam[n], xi[n]), (kappa0, lam0, xi0)):
+            assert np.allclose(x, x0)
+
+
+@pytest.mark.parametrize("gradient", [False, True])
+def test_get_roots_batch(gradient, geometries, limb_geometries):
+    b, theta, bo, ro = np.concatenate(
+        list(geometries.values()) + list(limb_geometries.values())
+    ).T
+    b[::7] = 0
+    args = (b, theta, np.cos(theta), np.sin(theta), bo, ro)
+    res = get_roots_batch(*args, gradient=gradient)
+    for n in range(len(b)):
+        res0 = get_roots(*[arg[n] for arg in args], gradient=gradient)
+        x0 = res0[0] if gradient else res0
+        assert res[1][n] == len(x0)
+        order = np.argsort(x0)
+        assert np.allclose(np.sort(res[0][n, : res[1][n]]), x0[order])
+        if gradient:
+            for dx, dx0 in zip(res[2], res0[1]):
+                k = np.argsort(res[0][n, : res[1][n]])
+                assert np.allclose(dx[n, k], np.array(dx0)[order])
+
+
+def _trajectory(nroots):
+    """
+    A light curve of 40 cadences in which only the last `nroots` need the
+    root solver; the occultor is far from the disk at all the others.
+
+    """
+    rng = np.random.default_rng(0)
+    npts = 40
+    b = np.full(npts, 0.5)
+    theta = np.full(npts, 0.5)
+    bo = np.full(npts, 3.0)
+    ro = np.full(npts, 0.2)
+    if nroots:
+        bo[-nroots:] = np.linspace(0.6, 0.65, nroots)
+        theta[-nroots:] += 0.01 * rng.uniform(size=nroots)
+    return b, theta, np.cos(theta), np.sin(theta), bo, ro
+
+
+@pytest.mark.parametrize("nroots", [0, 1, 3, STARRY_TRACK_STRIDE - 1])
+def test_track_few_roots(nroots, monkeypatch):
+    monkeypatch.setattr(geometry, "STARRY_TRACK_MIN_POINTS", 0)
+    args = _trajectory(nroots)
+    kappa0, lam0, xi0, code0 = get_angles_batch(*args)
+    kappa, lam, xi, code = get_angles_batch(*args, track=True)
+    assert np.all(code == code0)
+    assert np.count_nonzero(code == FLUX_SIMPLE_REFL) == len(code) - nroots
+    for x, x0 in zip(kappa + lam + xi, kappa0 + lam0 + xi0):
+        assert np.allclose(x, x0)
+
+
+@pytest.mark.parametrize("min_points", [0, 10 ** 9])
+def test_track(min_points, monkeypatch):
+    # An occultor sweeping across the terminator; `min_points` turns
+    # the tracking on and off
+    monkeypatch.setattr(geometry, "STARRY_TRACK_MIN_POINTS", min_points)
+    t = np.linspace(-1, 1, 500)
+    theta = 0.4 + 0.2 * t
+    bo = np.hypot(1.5 * t, 0.1)
+    args = (0.3, theta, np.cos(theta), np.sin(theta), bo, 0.3)
+    kappa0, lam0, xi0, code0 = get_angles_batch(*args)
+    kappa, lam, xi, code = get_angles_batch(*args, track=True)
+    assert np.all(code == code0)
+    for x, x0 in zip(kappa + lam + xi, kappa0 + lam0 + xi0):
+        assert np.allclose(x, x0)
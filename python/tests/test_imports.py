@@ -0,0 +1,18 @@
+import os
+import pytest
+import subprocess
+import sys
+
+
+@pytest.mark.parametrize(
+    "module", ["utils", "special", "linear", "geometry", "primitive", "starrynight"]
+)
+def test_lazy_imports(module):
+    # Only NumPy is imported at module level
+    code = (
+        "import sys, {}; "
+        "heavy = ['scipy', 'starry', 'theano', 'matplotlib', 'mpmath']; "
+        "assert not [m for m in sys.modules if m.split('.')[0] in heavy]"
+    ).format(module)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call([sys.executable, "-c", code], cwd=path)
@@ -0,0 +1,36 @@
+from numerical import Brute, Numerical
+import gc
+import multiprocessing
+import numpy as np
+
+
+def test_pool_is_closed():
+    nchildren = len(multiprocessing.active_children())
+    with Numerical(1, order=50, processes=2) as map:
+        X = map.design_matrix(0.5, 0.3, 0.7, 0.4)
+        assert map.pool is not None
+    assert map.pool is None
+    assert len(multiprocessing.active_children()) == nchildren
+    assert np.allclose(X, Numerical(1, order=50).design_matrix(0.5, 0.3, 0.7, 0.4))
+
+
+def test_pool_is_terminated():
+    nchildren = len(multiprocessing.active_children())
+    map = Numerical(1, order=50, processes=2)
+    map.design_matrix(0.5, 0.3, 0.7, 0.4)
+    assert len(multiprocessing.active_children()) > nchildren
+    del map
+    gc.collect()
+    assert len(multiprocessing.active_children()) == nchildren
+
+
+def test_brute(baseline, basis_dir):
+    # The grid is coarse, so the agreement is only to ~1e-2
+    geometries = baseline["geometries"][::5]
+    map = Brute(1, res=299, cache_dir=basis_dir)
+    X = np.array([map.design_matrix(*args) for args in geometries])
+    assert np.allclose(X, baseline["X_1"][::5], atol=1e-2)
+
+    # Processing the grid three rows at a time doesn't change the result
+    map = Brute(1, res=299, max_memory=2 ** 16, cache_dir=basis_dir)
+    assert np.allclose([map.design_matrix(*args) for args in geometries], X)
@@ -0,0 +1,62 @@
+from primitive import compute_P, compute_H, compute_W
+from scipy.special import hyp2f1
+from geometry import get_angles_batch
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("ydeg", [1, 4])
+def test_compute_P_batch(ydeg, geometries):
+    # Points with a single pair of limits, including some at which the
+    # linear term is solved numerically
+    b, theta, bo, ro = np.concatenate(list(geometries.values())).T
+    kappa = get_angles_batch(b, theta, np.cos(theta), np.sin(theta), bo, ro)[0]
+    idx = [n for n in range(len(b)) if len(kappa[n]) == 2]
+    bo = np.append(bo[idx], [0.5, 0.3, 0.6])
+    ro = np.append(ro[idx], [0.5, 0.7, 0.4 + 1e-9])
+    kappa = np.append([kappa[n] for n in idx], [[0.3, 2.5]] * 3, axis=0)
+    P = compute_P(ydeg, bo, ro, kappa)
+    for n in range(len(bo)):
+        assert np.allclose(P[n], compute_P(ydeg, bo[n], ro[n], kappa[n]))
+
+
+def test_compute_H_batch():
+    rng = np.random.default_rng(0)
+    uvmax = 6
+    xi = np.sort(rng.uniform(0, 2 * np.pi, (5, 4)), axis=1)
+    H, dH = compute_H(uvmax, xi, gradient=True)
+    x, w = np.polynomial.legendre.leggauss(50)
+
+    # Only the entries with u + v <= uvmax are defined
+    u, v = np.nonzero(np.add.outer(range(uvmax + 1), range(uvmax + 1)) <= uvmax)
+    for n in range(len(xi)):
+        H0, dH0 = compute_H(uvmax, xi[n], gradient=True)
+        assert np.all(H[n][u, v] == H0[u, v]) and np.all(dH[n][u, v] == dH0[u, v])
+
+        # H[u, v] is the integral of cos^u sin^v over the pairs of limits
+        for xi1, xi2 in xi[n].reshape(-1, 2):
+            t = 0.5 * (xi2 - xi1) * x + 0.5 * (xi2 + xi1)
+            wt = 0.5 * (xi2 - xi1) * w
+            f = np.cos(t) ** u[:, None] * np.sin(t) ** v[:, None]
+            H0[u, v] -= f @ wt
+        assert np.allclose(H0[u, v], 0)
+
+
+def test_compute_W_batch():
+    # A mix of limits recursed upward (q^2 < 1/2) and downward (q^2 > 1/2)
+    rng = np.random.default_rng(0)
+    nmax = 8
+    s2 = rng.uniform(0.05, 0.95, (10, 4))
+    q2 = rng.uniform(0, 1, (10, 4))
+    q3 = q2 ** 1.5
+    W = compute_W(nmax, s2, q2, q3)
+    assert W.shape == (10, nmax + 1)
+
+    # The closed form, summed over the pairs of limits
+    n = np.arange(nmax + 1)[:, None, None]
+    f = hyp2f1(-0.5, n + 1, n + 2, 1 - q2)
+    W0 = s2 ** (n + 1) * (3 / (n + 1) * f + 2 * q3) / (2 * n + 5)
+    W0 = np.sum(W0[..., 1::2] - W0[..., ::2], axis=-1).T
+    assert np.allclose(W, W0, rtol=1e-10, atol=1e-14)
+    for k in range(len(s2)):
+        assert np.allclose(W[k], compute_W(nmax, s2[k], q2[k], q3[k]))
@@ -0,0 +1,154 @@
+from special import J, EllipF, EllipE, EllipJ, rj, cel, cel_mpmath, pal, hyp2f1
+from scipy.integrate import quad
+from scipy.special import ellipk, ellipe, ellipkinc, ellipeinc
+from scipy.special import hyp2f1 as scipy_hyp2f1
+import numpy as np
+import os
+import pytest
+import subprocess
+import sys
+
+
+def test_J_gradient_batch():
+    rng = np.random.default_rng(0)
+    k2 = rng.uniform(0.1, 2.0, 5)
+    kappa = np.sort(rng.uniform(0, 4 * np.pi, (5, 4)), axis=1)
+    res, (dJdk2, dJdkappa) = J(4, k2, kappa, gradient=True)
+    assert dJdkappa.shape == kappa.shape
+    for i in range(len(k2)):
+        res0, (dJdk20, dJdkappa0) = J(4, k2[i], kappa[i], gradient=True)
+        assert np.allclose(res[i], res0)
+        assert np.allclose(dJdk2[i], dJdk20)
+        assert np.allclose(dJdkappa[i], dJdkappa0[0])
+
+
+def test_J_gradient_kappa():
+    k2 = 0.7
+    kappa = np.array([0.3, 1.2, 2.0, 5.5])
+    _, (_, dJdkappa) = J(3, k2, kappa, gradient=True)
+    eps = 1e-6
+    for i in range(len(kappa)):
+        dk = np.zeros_like(kappa)
+        dk[i] = eps
+        num = (J(3, k2, kappa + dk) - J(3, k2, kappa - dk)) / (2 * eps)
+        assert np.allclose(dJdkappa[0, i], num, atol=1e-8)
+
+
+def test_ellip_batch():
+    rng = np.random.default_rng(0)
+    k2 = rng.uniform(0.01, 0.99, 50)
+    phi = rng.uniform(0.01, 0.5 * np.pi - 0.01, 50)
+    F = EllipF(np.tan(phi), k2)
+    E = EllipE(np.tan(phi), k2)
+    assert np.allclose(F, ellipkinc(phi, k2), atol=1e-14)
+    assert np.allclose(E, ellipeinc(phi, k2), atol=1e-14)
+
+    # Each element converges on its own, so batching doesn't change them
+    for n in range(len(k2)):
+        assert EllipF(np.tan(phi[n]), k2[n]) == F[n]
+        assert EllipE(np.tan(phi[n]), k2[n]) == E[n]
+
+    # The limits & the moduli are broadcast against each other
+    F = EllipF(np.tan(phi)[:, None], k2[None, :5])
+    assert np.allclose(F, ellipkinc(phi[:, None], k2[None, :5]), atol=1e-14)
+
+
+def test_rj_batch():
+    try:
+        from scipy.special import elliprj
+    except ImportError:
+        pytest.skip("requires scipy >= 1.8")
+    rng = np.random.default_rng(0)
+    x, y, z, p = rng.uniform(0.01, 3, (4, 100))
+    res = rj(x, y, z, p)
+    assert np.allclose(res, elliprj(x, y, z, p), rtol=1e-9, atol=0)
+    for n in range(len(x)):
+        assert rj(x[n], y[n], z[n], p[n]) == res[n]
+
+
+def test_EllipJ_batch():
+    rng = np.random.default_rng(1)
+    kappa = rng.uniform(0, 4 * np.pi, (10, 4))
+    k2 = rng.uniform(0.1, 0.9, (10, 1))
+    p = rng.uniform(0.5, 2, (10, 1))
+    res = EllipJ(kappa, k2, p)
+    for n in range(len(kappa)):
+        assert np.all(EllipJ(kappa[n], k2[n, 0], p[n, 0]) == res[n])
+
+
+@pytest.mark.parametrize("n", [0, 1, 5])
+def test_hyp2f1_batch(n):
+    # The arguments of the upper boundary condition for W
+    a, b, c = -0.5, n + 1, n + 2
+    z = np.linspace(-0.5, 0.5, 24).reshape(2, 3, 4)
+    F, dFdz = hyp2f1(a, b, c, z, gradient=True)
+    assert F.shape == dFdz.shape == z.shape
+    assert np.allclose(F, scipy_hyp2f1(a, b, c, z), rtol=1e-12, atol=0)
+    assert np.allclose(
+        dFdz, a * b / c * scipy_hyp2f1(a + 1, b + 1, c + 1, z), rtol=1e-12, atol=0
+    )
+    for zn, Fn in zip(z.reshape(-1), F.reshape(-1)):
+        assert np.ndim(hyp2f1(a, b, c, zn)) == 0 and hyp2f1(a, b, c, zn) == Fn
+
+
+def test_cel():
+    m = np.array([1e-14, 0.1, 0.5, 0.9, 1 - 1e-10])
+    kc = np.sqrt(1 - m)
+    assert np.allclose(cel(kc, 1.0, 1.0, 1.0), ellipk(m), rtol=1e-14, atol=0)
+    assert np.allclose(cel(kc, 1.0, 1.0, kc ** 2), ellipe(m), rtol=1e-14, atol=0)
+
+    # The complete integral of the third kind & the RJ offset in `ellip`
+    pytest.importorskip("mpmath")
+    for kc_, p in zip(kc, [3.0, 0.7, 0.3, 0.05, 1.5]):
+        for a, b in [(1.0, 1.0), (0.0, 1.0)]:
+            assert np.isclose(cel(kc_, p, a, b), cel_mpmath(kc_, p, a, b), rtol=1e-12)
+
+
+def test_no_mpmath():
+    code = "import special, sys; assert 'mpmath' not in sys.modules"
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call([sys.executable, "-c", code], cwd=path)
+
+
+def _pal(bo, ro, kappa):
+    """The linear term of `P` computed with adaptive quadrature."""
+
+    def func(phi):
+        c = np.cos(phi)
+        z2 = max(0.0, 1 - ro ** 2 - bo ** 2 - 2 * bo * ro * c)
+        return (1 - z2 ** 1.5) / (1 - z2) * (ro + bo * c) * ro / 3.0
+
+    # Split the arcs where they cross the limb
+    phi0 = np.arccos(np.clip((1 - ro ** 2 - bo ** 2) / (2 * bo * ro), -1, 1))
+    n = 2 * np.pi * np.arange(-2, 3)
+    limb = np.sort(np.concatenate((n + phi0, n - phi0)))
+    res = 0
+    for phi1, phi2 in np.reshape(kappa, (-1, 2)) - np.pi:
+        points = limb[(limb > phi1) & (limb < phi2)]
+        res += quad(func, phi1, phi2, points=points, epsabs=0, epsrel=1e-13)[0]
+    return res
+
+
+@pytest.mark.parametrize(
+    "bo,ro,kappa",
+    [
+        (0.5, 0.5 + 1e-5, [0.3, 2.9]),
+        (0.6, 0.4 + 1e-4, [1.0, 5.0]),
+        (0.7, 0.3 - 1e-4, [np.pi, 3 * np.pi]),
+        (0.5, 1.5 - 1e-4, [2.0, 4.0]),
+        (0.5, 0.5, [0.3, 1.0, 2.0, 2.9]),
+    ],
+)
+def test_pal(bo, ro, kappa):
+    kappa = np.array(kappa)
+    res, (dbo, dro, dkappa) = pal(bo, ro, kappa, gradient=True)
+    assert np.isclose(res, _pal(bo, ro, kappa), rtol=1e-13)
+    h = 1e-6
+    num = (_pal(bo + h, ro, kappa) - _pal(bo - h, ro, kappa)) / (2 * h)
+    assert np.isclose(dbo, num, rtol=1e-6)
+    num = (_pal(bo, ro + h, kappa) - _pal(bo, ro - h, kappa)) / (2 * h)
+    assert np.isclose(dro, num, rtol=1e-6)
+    for i in range(len(kappa)):
+        dk = h * (np.arange(len(kappa)) == i)
+        num = (_pal(bo, ro, kappa + dk) - _pal(bo, ro, kappa - dk)) / (2 * h)
+        assert np.isclose(dkappa[0, i], num, rtol=1e-6)
@@ -0,0 +1,98 @@
+from starrynight import StarryNight
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("ydeg", [1, 3])
+def test_design_matrix_batch(ydeg, geometries):
+    geometries = [g[:5] for g in geometries.values()]
+    geometries.append([[0.5, 0.0, 0.7, 0.4], [0.5, 0.5 * np.pi, 0.7, 0.4]])
+    b, theta, bo, ro = np.concatenate(geometries).T
+    map = StarryNight(ydeg)
+    X = map.design_matrix_batch(b, theta, bo, ro)
+    for n in range(len(b)):
+        assert np.allclose(X[n], map.design_matrix(b[n], theta[n], bo[n], ro[n]))
+
+
+@pytest.mark.parametrize("ydeg", [1, 2])
+def test_design_matrix_and_grad(ydeg, geometries, limb_geometries):
+    map = StarryNight(ydeg)
+    geometries = [g[:5] for g in geometries.values()]
+    geometries += list(limb_geometries.values())
+    h = 1e-6
+    for p in np.concatenate(geometries):
+        # The derivatives are singular where the limbs are tangent
+        b, theta, bo, ro = p
+        if np.min(np.abs([bo - ro, bo - np.abs(1 - ro), bo - 1 - ro])) < 1e-3:
+            continue
+        X, dX = map.design_matrix_and_grad(*p)
+        assert np.allclose(X, map.design_matrix(*p))
+        for i in range(4):
+            dp = np.zeros(4)
+            dp[i] = h
+            num = map.design_matrix(*(p + dp)) - map.design_matrix(*(p - dp))
+            num /= 2 * h
+            assert np.allclose(dX[i], num, rtol=1e-4, atol=1e-4)
+
+
+def test_precompute_cache():
+    args = (0.5, 0.3, 0.7, 0.4)
+    map = StarryNight(2, cache_size=2)
+    X = map.design_matrix(*args)
+    assert map.cache_stats()["precompute"]["misses"] == 1
+    assert np.allclose(map.design_matrix(*args), X)
+    assert np.allclose(map.design_matrix(0.5, 0.3 + 1e-12, 0.7, 0.4), X)
+    assert map.cache_stats()["precompute"]["hits"] == 2
+
+    # A new occultor position reuses the illumination matrix only
+    map.design_matrix(0.5, 0.3, 0.8, 0.4)
+    stats = map.cache_stats()
+    assert stats["precompute"]["misses"] == 2 and stats["illum"]["hits"] == 1
+
+    # The batch evaluation doesn't touch the caches
+    map.design_matrix_batch([0.5], [0.3], [0.7], [0.4])
+    assert map.cache_stats() == stats
+
+    # Caching doesn't change the result
+    assert np.allclose(StarryNight(2).design_matrix(*args), X)
+    map.clear_cache()
+    assert map.cache_stats()["precompute"]["size"] == 0
+
+
+def _illum(ydeg, b, theta):
+    """The illumination matrix, computed term by term."""
+    y0 = np.sqrt(1 - b ** 2)
+    p = np.array([0, -y0 * np.sin(theta), -b, y0 * np.cos(theta)]) * 1.5
+    I = np.zeros(((ydeg + 2) ** 2, (ydeg + 1) ** 2))
+    n1 = 0
+    for l1 in range(ydeg + 1):
+        for m1 in range(-l1, l1 + 1):
+            odd1 = (l1 + m1) % 2 != 0
+            n2 = 0
+            for l2 in range(2):
+                for m2 in range(-l2, l2 + 1):
+                    l = l1 + l2
+                    n = l * l + l + m1 + m2
+                    if odd1 and ((l2 + m2) % 2 != 0):
+                        I[n - 4 * l + 2, n1] += p[n2]
+                        I[n - 2, n1] -= p[n2]
+                        I[n + 2, n1] -= p[n2]
+                    else:
+                        I[n, n1] += p[n2]
+                    n2 += 1
+            n1 += 1
+    return I
+
+
+@pytest.mark.parametrize("ydeg", [1, 4])
+def test_illum(ydeg):
+    map = StarryNight(ydeg)
+    b = np.array([-0.9, -0.2, 0.0, 0.5, 1.0])
+    theta = np.array([0.1, 2.0, 3.5, 5.0, 6.2])
+    I = map.illum(b, theta)
+    IA1 = map.illum_A1(b, theta)
+    for n in range(len(b)):
+        assert np.allclose(I[n], _illum(ydeg, b[n], theta[n]))
+        assert np.allclose(IA1[n], I[n] @ map.A1)
+    map.b, map.theta = b[1], theta[1]
+    assert np.allclose(map.illum(), I[1])
@@ -0,0 +1,82 @@
+from surrogate import Surrogate
+from utils import STARRY_SURROGATE_MIN_COVERAGE
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="module")
+def surrogate(tmp_path_factory):
+    file = str(tmp_path_factory.mktemp("surrogate") / "surrogate.npz")
+    return Surrogate(1, file=file), file
+
+
+def test_coverage(surrogate):
+    S, _ = surrogate
+    assert S.coverage >= STARRY_SURROGATE_MIN_COVERAGE
+
+
+def test_tol(surrogate):
+    S, _ = surrogate
+    rng = np.random.default_rng(1)
+    p = S.bounds[:, 0] + (S.bounds[:, 1] - S.bounds[:, 0]) * rng.uniform(
+        size=(500, 4)
+    )
+    b, theta, bo, ro = p.T
+    X = S.design_matrix(b, theta, bo, ro)
+    assert np.max(np.abs(X - S.map.design_matrix(b, theta, bo, ro))) <= S.tol
+
+
+def test_load(surrogate):
+    S, file = surrogate
+    b, theta, bo, ro = np.linspace(-0.9, 0.9, 20), 1.0, np.linspace(0, 2.5, 20), 0.1
+    assert np.allclose(
+        Surrogate(1, file=file).design_matrix(b, theta, bo, ro),
+        S.design_matrix(b, theta, bo, ro),
+    )
+
+
+def test_tol_on_boundaries(surrogate):
+    # Bisect along `bo` to the boundaries between the regions
+    S, _ = surrogate
+    rng = np.random.default_rng(2)
+    b = np.repeat(rng.uniform(-1, 1, 20), 1001)
+    theta = np.repeat(rng.uniform(0, 2 * np.pi, 20), 1001)
+    bo = np.tile(np.linspace(0, 2, 1001), 20)
+    ro = np.full_like(b, S.bounds[3, 0])
+    region = S._region(b, theta, bo, ro)
+    k = np.flatnonzero((np.diff(region) != 0) & (np.diff(b) == 0))
+    assert len(k) > 20
+    b, theta, ro, region = b[k], theta[k], ro[k], region[k]
+    lo, hi = bo[k], bo[k + 1]
+    for i in range(40):
+        mid = 0.5 * (lo + hi)
+        same = S._region(b, theta, mid, ro) == region
+        lo = np.where(same, mid, lo)
+        hi = np.where(same, hi, mid)
+
+    # Check the surrogate on both sides
+    for bo in (lo, hi):
+        X = S.design_matrix(b, theta, bo, ro)
+        assert np.max(np.abs(X - S.map.design_matrix(b, theta, bo, ro))) <= S.tol
+
+
+def test_settings(tmp_path):
+    # A small box in which the occultor doesn't touch the body
+    file = str(tmp_path / "surrogate.npz")
+    bounds = [(0.2, 0.3), (1.0, 1.1), (1.5, 1.6), (0.1, 0.1)]
+    kwargs = dict(bounds=bounds, order=6, shape=1)
+    S = Surrogate(1, file=file, **kwargs)
+    assert S.coverage == 1
+    assert np.all(Surrogate(1, file=file, **kwargs).coeffs == S.coeffs)
+
+    # Different settings trigger a rebuild
+    with pytest.warns(UserWarning, match="tol"):
+        S = Surrogate(1, tol=1e-5, file=file, **kwargs)
+    assert S.tol == 1e-5 and Surrogate(1, tol=1e-5, file=file, **kwargs).tol == 1e-5
+    with pytest.warns(UserWarning, match="ydeg"):
+        S = Surrogate(2, tol=1e-5, file=file, **kwargs)
+    assert S.coeffs.shape[-1] == 9
+
+    # Loading tables for a different degree by hand is an error
+    with pytest.raises(ValueError):
+        Surrogate(1, **kwargs).load(file)
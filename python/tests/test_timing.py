@@ -0,0 +1,42 @@
+from utils import *
+from starrynight import StarryNight
+import timing
+import numpy as np
+
+
+@timing.timed
+def _countdown(n):
+    return n if n == 0 else _countdown(n - 1)
+
+
+def test_timed():
+    timing.reset()
+    _countdown(3)
+    assert timing.stats() == {}
+    with timing.profiling():
+        _countdown(3)
+        _countdown(1)
+
+    # Nested calls are only counted once
+    count, elapsed = timing.stats()["_countdown"]
+    assert count == 2 and elapsed > 0
+    assert not timing._ENABLED
+    assert "_countdown" in timing.summary(sort="name")
+
+
+def test_profiling(geometries):
+    map = StarryNight(1)
+    args = geometries[FLUX_DAY_OCC][0]
+    with timing.profiling():
+        map.design_matrix(*args)
+        map.design_matrix(*geometries[FLUX_DAY_OCC][:2].T)
+    stats = timing.stats()
+    for name in ["get_angles", "compute_P", "FLUX_DAY_OCC", "FLUX_DAY_OCC (batch)"]:
+        assert name in stats
+    assert stats["FLUX_DAY_OCC"][0] == 1
+
+    # Profiling again starts from scratch
+    with timing.profiling():
+        map.design_matrix(*args)
+    assert "FLUX_DAY_OCC (batch)" not in timing.stats()
+    timing.reset()
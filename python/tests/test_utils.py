@@ -0,0 +1,35 @@
+from utils import solve_tridiagonal
+import numpy as np
+
+
+def _dense(lower, diag, upper):
+    return np.diag(diag) + np.diag(lower[1:], -1) + np.diag(upper[:-1], 1)
+
+
+def test_solve_tridiagonal():
+    rng = np.random.default_rng(0)
+    n = 12
+    lower, upper = rng.uniform(-1, 1, (2, n))
+    diag = 3 + rng.uniform(0, 1, n)
+    rhs = rng.uniform(-1, 1, n)
+    x = solve_tridiagonal(lower, diag, upper, rhs)
+    assert np.allclose(x, np.linalg.solve(_dense(lower, diag, upper), rhs))
+
+
+def test_solve_tridiagonal_batch():
+    rng = np.random.default_rng(1)
+    n, m = 12, 5
+    lower, upper = rng.uniform(-1, 1, (2, n))
+    diag = 3 + rng.uniform(0, 1, (n, m))
+    rhs = rng.uniform(-1, 1, (n, m))
+
+    # Coefficients shared by all the right-hand sides
+    x = solve_tridiagonal(lower, diag[:, 0], upper, rhs)
+    A = _dense(lower, diag[:, 0], upper)
+    assert np.allclose(x, np.linalg.solve(A, rhs))
+
+    # A different diagonal for each of them
+    x = solve_tridiagonal(lower, diag, upper, rhs)
+    for j in range(m):
+        A = _dense(lower, diag[:, j], upper)
+        assert np.allclose(x[:, j], np.linalg.solve(A, rhs[:, j]))
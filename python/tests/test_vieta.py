@@ -0,0 +1,22 @@
+from vieta import vieta_table
+from scipy.special import binom
+import numpy as np
+
+
+def test_vieta_table():
+    ydeg = 5
+    delta = np.array([-0.7, 0.1, 2.3])
+    A = vieta_table(ydeg, delta)
+    for u in range(ydeg // 2 + 2):
+        for v in range(ydeg + 1):
+            for i in range(u + v + 1):
+                # A_{i, u, v} straight from its definition (D36)
+                expected = sum(
+                    binom(u, j)
+                    * binom(v, u + v - i - j)
+                    * (-1) ** (u + j)
+                    * delta ** (u + v - i - j)
+                    for j in range(max(0, u - i), min(u + v - i, u) + 1)
+                )
+                assert np.allclose(A[:, u, v, i], expected)
+    assert np.allclose(vieta_table(ydeg, delta[1]), A[1])
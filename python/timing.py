@@ -0,0 +1,160 @@
+"""
+Opt-in instrumentation of the solver.
+
+When enabled, the functions decorated with `timed` (root finding, the
+primitive integrals, the elliptic integrals, the Pal fallback, ...) and
+the integration code branches of `StarryNight.design_matrix` record the
+number of times they were called and the cumulative (inclusive) time
+spent in them. When disabled (the default), the overhead is a single
+check per call::
+
+    import timing
+
+    with timing.profiling():
+        map.design_matrix(b, theta, bo, ro)
+    print(timing.summary())
+
+"""
+from contextlib import contextmanager
+from functools import wraps
+import time
+
+__all__ = [
+    "timed",
+    "timer",
+    "record",
+    "profiling",
+    "enable",
+    "disable",
+    "reset",
+    "stats",
+    "summary",
+]
+
+
+# Are we recording?
+_ENABLED = False
+
+# Number of calls and cumulative time for each timer, keyed on name
+_STATS = {}
+
+# Timers currently running; nested calls to these are not recorded
+# separately, so that recursive functions are not double counted
+_ACTIVE = set()
+
+
+def enable():
+    """Start recording."""
+    global _ENABLED
+    _ENABLED = True
+
+
+def disable():
+    """Stop recording."""
+    global _ENABLED
+    _ENABLED = False
+
+
+def reset():
+    """Discard everything recorded so far."""
+    _STATS.clear()
+
+
+def stats():
+    """Return a dictionary mapping each timer to its `(count, seconds)`."""
+    return {name: tuple(value) for name, value in _STATS.items()}
+
+
+def record(name, elapsed):
+    """Record a call to `name` that took `elapsed` seconds."""
+    value = _STATS.setdefault(name, [0, 0.0])
+    value[0] += 1
+    value[1] += elapsed
+
+
+class _Timer(object):
+    """The object yielded by `timer`; its `name` may be set in the block."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+@contextmanager
+def timer(name=None):
+    """
+    Record the time spent in a block of code. The name of the timer may
+    also be set (or changed) within the block via the `name` attribute of
+    the yielded object, which is useful when it is not known in advance.
+
+    """
+    t = _Timer(name)
+    if not _ENABLED:
+        yield t
+        return
+    start = time.perf_counter()
+    try:
+        yield t
+    finally:
+        if t.name is not None:
+            record(t.name, time.perf_counter() - start)
+
+
+def timed(func):
+    """Decorator that records the calls to `func` under its name."""
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _ENABLED or name in _ACTIVE:
+            return func(*args, **kwargs)
+        _ACTIVE.add(name)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+            _ACTIVE.discard(name)
+
+    return wrapper
+
+
+@contextmanager
+def profiling(reset=True):
+    """
+    Record everything within a block. Unless `reset` is False, the
+    statistics recorded previously are discarded first.
+
+    """
+    global _ENABLED
+    enabled = _ENABLED
+    if reset:
+        _STATS.clear()
+    _ENABLED = True
+    try:
+        yield
+    finally:
+        _ENABLED = enabled
+
+
+def summary(sort="time"):
+    """
+    Return a table with the number of calls, the cumulative time and the
+    time per call of each of the timers, sorted by cumulative `time`,
+    by `count` or by `name`.
+
+    """
+    key = {
+        "time": lambda item: -item[1][1],
+        "count": lambda item: -item[1][0],
+        "name": lambda item: item[0],
+    }[sort]
+    lines = [
+        "{:28s} {:>10s} {:>12s} {:>12s}".format("name", "calls", "total", "per call")
+    ]
+    for name, (count, elapsed) in sorted(_STATS.items(), key=key):
+        lines.append(
+            "{:28s} {:>10d} {:>11.4e}s {:>11.4e}s".format(
+                name, count, elapsed, elapsed / count
+            )
+        )
+    return "\n".join(lines)
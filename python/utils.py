@@ -14,7 +14,12 @@ FLUX_TRIP_NIGHT_OCC = 9
 FLUX_QUAD_DAY_VIS = 10
 FLUX_QUAD_NIGHT_VIS = 11
 
-# Maximum number of iterations when computing `el2` and `rj`
+# Names of the integration codes
+FLUX_NAMES = {
+    value: name for name, value in list(globals().items()) if name.startswith("FLUX_")
+}
+
+# Maximum number of iterations when computing `el2`, `cel` and `rj`
 STARRY_EL2_MAX_ITER = 100
 STARRY_CRJ_MAX_ITER = 100
 
@@ -27,7 +32,25 @@ STARRY_CRJ_TOL = 2e-2
 STARRY_2F1_MAXITER = 200
 STARRY_2F1_TOL = 1e-15
 
-# Square root of the desired precision in `el2`
+# Number of terms of the 2F1 series that are summed at a time
+STARRY_2F1_BLOCK = 64
+
+# Step size and number of nodes on either side of the midpoint of the
+# tanh-sinh rule used to compute the upper boundary condition for `J`
+STARRY_J_QUAD_STEP = 0.0625
+STARRY_J_QUAD_HALF_NODES = 60
+
+# Same, for the rule used to compute the boundary integrals in the
+# gradients of the `P` and `T` integrals
+STARRY_GRAD_QUAD_STEP = 0.0625
+STARRY_GRAD_QUAD_HALF_NODES = 60
+
+# Same, for the rule used to compute the Pal integral (on each arc
+# between consecutive multiples of pi)
+STARRY_PAL_QUAD_STEP = 0.0625
+STARRY_PAL_QUAD_HALF_NODES = 60
+
+# Square root of the desired precision in `el2` and `cel`
 STARRY_EL2_CA = 1e-8
 
 # Replace `inf` with this value in argument to `el2`
@@ -47,9 +70,22 @@ STARRY_ROOT_TOL_DUP = 1e-8
 # Maximum number of root polishing iterations
 STARRY_ROOT_MAX_ITER = 50
 
+# When tracking roots along a time series, solve the quartic
+# from scratch at least once every this many points
+STARRY_TRACK_STRIDE = 16
+
+# Only track roots along a time series if at least this many points
+# need them. Each of the interleaved chains costs a call to the batched
+# root solver, and that overhead only pays off for long series.
+STARRY_TRACK_MIN_POINTS = 50000
+
 # If |b| is less than this value, set = 0
 STARRY_B_ZERO_TOL = 1e-8
 
+# If bo is less than this value, set = this value
+# (the P integral is singular at bo = 0)
+STARRY_BO_ZERO_TOL = 1e-10
+
 # Tolerance for various functions that calculate phi, xi, and lam
 STARRY_ANGLE_TOL = 1e-13
 
@@ -62,6 +98,10 @@ STARRY_COMPLETE_OCC_TOL = 1e-8
 STARRY_NO_OCC_TOL = 1e-8
 STARRY_GRAZING_TOL = 1e-8
 
+# Occultors closer than this to the terminator are always sent
+# to the root solver when classifying many points at once
+STARRY_TERMINATOR_TOL = 1e-8
+
 # Tolerance for the Pal (2012) solver, which is very unstable
 STARRY_PAL_BO_EQUALS_RO_TOL = 1e-3
 STARRY_PAL_BO_EQUALS_RO_MINUS_ONE_TOL = 1e-3
@@ -70,17 +110,34 @@ STARRY_PAL_BO_EQUALS_ONE_MINUS_RO_TOL = 1e-3
 # Nudge k^2 away from 1 when it gets this close
 STARRY_K2_ONE_TOL = 1e-12
 
+# Limits along the limb of the occultor closer than this (in units of
+# k^2) to the limb of the body are snapped onto it, since several of the
+# integrals have square root branch points there
+STARRY_KAPPA_LIMB_TOL = 1e-12
+
+# Number of random points used to estimate the fraction of its box that
+# a `Surrogate` covers, and the fraction below which a warning is issued
+STARRY_SURROGATE_COVERAGE_POINTS = 4096
+STARRY_SURROGATE_MIN_COVERAGE = 0.5
+
 
 def parity(i):
     return -1 if (i % 2) == 0 else 1
 
 
-def pairdiff(x):
+def pairdiff(x, axis=0):
     """Return the sum over pairwise differences of an array.
 
     This is used to evaluate a (series of) definite integral(s) given
-    the antiderivatives at each of the integration limits.
+    the antiderivatives at each of the integration limits. The limits
+    run along `axis`, so many sets of integrals can be evaluated at once.
     """
+    if axis != 0 and np.ndim(x) > 1:
+        if axis % np.ndim(x) != np.ndim(x) - 1:
+            x = np.moveaxis(x, axis, -1)
+        if np.shape(x)[-1] % 2 != 0:
+            raise ValueError("Array length must be even.")
+        return np.sum(x[..., 1::2] - x[..., ::2], axis=-1)
     if len(x) > 1:
         if len(x) % 2 == 0:
             return sum(-np.array(x)[::2] + np.array(x)[1::2])
@@ -90,3 +147,37 @@ def pairdiff(x):
         return 0.0
     else:
         return x
+
+
+def solve_tridiagonal(lower, diag, upper, rhs):
+    """Solve a tridiagonal linear system with the Thomas algorithm.
+
+    The system has sub-diagonal `lower`, diagonal `diag` and super-diagonal
+    `upper`, each of length `n` along the first axis (`lower[0]` and
+    `upper[-1]` are ignored). Any trailing axes of `rhs` are treated as
+    independent right-hand sides; the coefficients may either be shared
+    across them or have the same trailing shape, so many systems can be
+    solved in a single call.
+    """
+    rhs = np.asarray(rhs, dtype=float)
+    lower, diag, upper = [
+        np.reshape(x, np.shape(x) + (1,) * (rhs.ndim - np.ndim(x)))
+        for x in (lower, diag, upper)
+    ]
+    shape = np.broadcast(lower, diag, upper, rhs).shape
+
+    # Forward sweep
+    cp = np.empty(shape)
+    dp = np.empty(shape)
+    cp[0] = upper[0] / diag[0]
+    dp[0] = rhs[0] / diag[0]
+    for i in range(1, shape[0]):
+        denom = diag[i] - lower[i] * cp[i - 1]
+        cp[i] = upper[i] / denom
+        dp[i] = (rhs[i] - lower[i] * dp[i - 1]) / denom
+
+    # Back substitution
+    x = dp
+    for i in range(shape[0] - 2, -1, -1):
+        x[i] -= cp[i] * x[i + 1]
+    return x
@@ -1,19 +1,50 @@
-from scipy.special import binom
-
-__all__ = ["Vieta"]
-
-
-def Vieta(i, u, v, delta):
-    """Compute the Vieta coefficient A_{i, u, v}."""
-    # TODO: Do recursively
-    j1 = max(0, u - i)
-    j2 = min(u + v - i, u)
-    return sum(
-        [
-            float(binom(u, j))
-            * float(binom(v, u + v - i - j))
-            * (-1) ** (u + j)
-            * delta ** (u + v - i - j)
-            for j in range(j1, j2 + 1)
-        ]
-    )
+import numpy as np
+
+__all__ = ["vieta_coeffs", "vieta_table"]
+
+
+# Cache of the Vieta coefficient tensors, keyed on `ydeg`
+_VIETA_COEFFS = {}
+
+
+def vieta_coeffs(ydeg):
+    """
+    Return the tensor `C` of polynomial coefficients of the Vieta
+    coefficients needed to compute the `P` integral at degree `ydeg`, s.t.
+
+        A_{i, u, v} = sum_p C[u, v, i, p] delta^p
+
+    for `0 <= u <= ydeg // 2 + 1` and `0 <= v <= ydeg`. The tensor is
+    computed once per `ydeg` and cached.
+
+    """
+    C = _VIETA_COEFFS.get(ydeg, None)
+    if C is None:
+        from scipy.special import binom
+
+        umax = ydeg // 2 + 1
+        vmax = ydeg
+        C = np.zeros((umax + 1, vmax + 1, umax + vmax + 1, umax + vmax + 1))
+        for u in range(umax + 1):
+            for v in range(vmax + 1):
+                for i in range(u + v + 1):
+                    for j in range(max(0, u - i), min(u + v - i, u) + 1):
+                        C[u, v, i, u + v - i - j] += (
+                            binom(u, j) * binom(v, u + v - i - j) * (-1) ** (u + j)
+                        )
+        _VIETA_COEFFS[ydeg] = C
+    return C
+
+
+def vieta_table(ydeg, delta):
+    """
+    Return the array `A[u, v, i]` of all Vieta coefficients A_{i, u, v}
+    needed at degree `ydeg`, evaluated at `delta`. If `delta` has shape
+    `(N,)`, the result has shape `(N, ...)`.
+
+    """
+    C = vieta_coeffs(ydeg)
+    A = np.dot(C, np.power.outer(delta, np.arange(C.shape[-1])).T)
+    if np.ndim(delta):
+        A = np.moveaxis(A, -1, 0)
+    return A